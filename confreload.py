@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# 設定ファイル（config.json）の再読み込み。再起動せずに新しい設定を反映する
+
+import sys
+import json
+import threading
+import traceback
+
+import log
+
+# 再起動するまで反映されない設定（起動時に一度だけ使うもの）
+RESTART_KEYS: list[tuple[str, ...]] = [
+	("app_name",),
+	("sockinfo",),
+	("paths", "feedctl"),
+	("paths", "postqueue"),
+	("paths", "lease"),
+	("paths", "log"),
+	("standby", "enabled"),
+	("standby", "instance"),
+	("websub", "enabled"),
+	("websub", "host"),
+	("websub", "port"),
+]
+
+def ValidateConfig(current: dict, new: dict, prefix: str = "") -> list[str]:
+	"""
+		新しい設定が、現在の設定と同じ構造（キーと値の型）を持つかを調べ、問題点のリストを返す。問題がなければ空のリストを返す。
+		リストの中身（フィード、配信先など）は個数が変わりうるので、構造は調べない。
+		current: 現在の設定
+		new:     新しい設定
+		prefix:  エラー表示用のキーの経路
+	"""
+	errors = []
+	for key, value in current.items():
+		name = prefix + key
+		if key not in new:
+			errors.append(f"{name} がありません")
+		elif isinstance(value, dict):
+			if isinstance(new[key], dict):	errors += ValidateConfig(value, new[key], name + ".")
+			else:							errors.append(f"{name} は辞書である必要があります")
+		elif not SameType(value, new[key]):
+			errors.append(f"{name} の型が違います（{type(value).__name__} -> {type(new[key]).__name__}）")
+
+	# 値の検査は構造が正しい場合のみ行う
+	if prefix == "" and len(errors) == 0: errors += CheckValues(new)
+	return errors
+
+def SameType(a, b) -> bool:
+	""" 設定値の型が同じかどうか。整数と小数は区別しない """
+	if isinstance(a, bool) or isinstance(b, bool): return type(a) is type(b)
+	if isinstance(a, (int, float)): return isinstance(b, (int, float))
+	return type(a) is type(b)
+
+def CheckValues(config: dict) -> list[str]:
+	""" 構造だけでは確かめられない設定値を調べる。 """
+	from fanout import SINKS
+
+	errors = []
+	if config["interval_sec"] <= 0:
+		errors.append("interval_sec は正の数である必要があります")
+	if config["xmlfeed"]["request"]["error_count"] < 1:
+		errors.append("xmlfeed.request.error_count は 1 以上である必要があります")
+	if config["xmlfeed"]["priority"]["aging_sec"] <= 0:
+		errors.append("xmlfeed.priority.aging_sec は正の数である必要があります")
+	if config["xmlfeed"]["priority"]["max_pending"] < 1:
+		errors.append("xmlfeed.priority.max_pending は 1 以上である必要があります")
+	if config["standby"]["lease_sec"] <= 0:
+		errors.append("standby.lease_sec は正の数である必要があります")
+	if config["mailinfo"]["max_per_hour"] < 1:
+		errors.append("mailinfo.max_per_hour は 1 以上である必要があります")
+	if config["xmlfeed"]["coalesce"] not in ("latest", "first_last", "none"):
+		errors.append(f"xmlfeed.coalesce が不正です（{config['xmlfeed']['coalesce']}）")
+	if config["xmlfeed"]["xml_backend"] not in ("auto", "etree", "lxml"):
+		errors.append(f"xmlfeed.xml_backend が不正です（{config['xmlfeed']['xml_backend']}）")
+	if config["render"]["engine"] not in ("matplotlib", "cv2", "raster"):
+		errors.append(f"render.engine が不正です（{config['render']['engine']}）")
+
+	for i, f in enumerate(config["xmlfeed"]["feeds"]):
+		if not isinstance(f, dict) or "name" not in f or "address" not in f:
+			errors.append(f"xmlfeed.feeds[{i}] には name と address が必要です")
+	for i, s in enumerate(config["post"]["sinks"]):
+		if not isinstance(s, dict) or s.get("type") not in SINKS:
+			errors.append(f"post.sinks[{i}] の type が不正です（{s.get('type') if isinstance(s, dict) else s}）")
+
+	return errors
+
+def GetPath(config: dict, keys: tuple[str, ...]):
+	""" 入れ子の辞書から値を取り出す。ない場合は None """
+	for k in keys:
+		if not isinstance(config, dict): return None
+		config = config.get(k)
+	return config
+
+### class ConfigReloader BEGIN ###
+
+class ConfigReloader:
+	"""
+		config.json を読み直し、検証してから稼働中の各部に反映する。
+		反映はポーリング（GetJMAXMLFeeds）の実行中を避けて一度に行う（Scheduler.reconfigure）ので、
+		1 回のポーリングの途中で新旧の設定が混ざることはない。
+		設定の辞書は中身を入れ替えるので、同じ辞書を参照している箇所（描画クラスの生成など）には次の利用時から反映される。
+		読み込み済みの地図データ・配信先の接続などは、それを作るのに使った設定が変わっていなければそのまま使い続ける。
+	"""
+	def __init__(self, config_path: str, conf_enctype: str, config: dict, ns: dict, mhd: log.MailHandler, sched, components: dict) -> None:
+		"""
+			config_path / conf_enctype: 設定ファイルのパスと文字コード
+			config:     稼働中の設定情報（中身を入れ替える）
+			ns:         稼働中の XML 名前空間（config の xmlfeed.xml_ns.feed。中身を入れ替える）
+			mhd:        メール送信ハンドラ
+			sched:      GetJMAXMLFeeds を定期実行している Scheduler
+			components: 設定を反映する各部。feedctl, fetcher, publisher, meter, queue, lease, subscriber（None 可）
+		"""
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		self.config_path: str	= config_path
+		self.conf_enctype: str	= conf_enctype
+		self.config: dict		= config
+		self.ns: dict			= ns
+		self.mhd: log.MailHandler = mhd
+		self.sched = sched
+		self.components: dict	= components
+		self.__lock = threading.Lock()
+
+	def Reload(self) -> tuple[bool, str]:
+		""" 設定を読み直して反映する。(反映したか, 結果の説明) を返す。 """
+		with self.__lock:
+			try:
+				with open(self.config_path, "r", encoding=self.conf_enctype) as f:
+					new = json.load(f)
+			except (OSError, json.JSONDecodeError) as e:
+				return self.__Result(False, f"設定ファイルを読み込めませんでした：{e}")
+
+			errors = ValidateConfig(self.config, new)
+			if len(errors) > 0:
+				return self.__Result(False, "設定に誤りがあるため、反映しませんでした：\n" + "\n".join("  " + e for e in errors))
+
+			changed = [k for k in new.keys() if new[k] != self.config.get(k)]
+			if len(changed) == 0:
+				return self.__Result(True, "設定に変更はありません")
+			restart = [".".join(k) for k in RESTART_KEYS if GetPath(new, k) != GetPath(self.config, k)]
+
+			try:
+				self.sched.reconfigure(new["interval_sec"], lambda: self.__Apply(new))
+			except Exception:
+				return self.__Result(False, "設定の反映に失敗しました。設定は変更していません\n" + traceback.format_exc())
+
+			msg = "設定を再読み込みしました（変更：" + ", ".join(changed) + "）"
+			if len(restart) > 0:
+				msg += "\n次の設定は再起動するまで反映されません：" + ", ".join(restart)
+			return self.__Result(True, msg)
+
+	def __Apply(self, new: dict) -> None:
+		c = self.components
+
+		# 作り直しに失敗しうる配信先から反映する。失敗した場合はここで中断し、他の設定も変更しない
+		c["publisher"].LoadConfig(new)
+
+		self.config.clear()
+		self.config.update(new)
+		self.ns.clear()
+		self.ns.update(new["xmlfeed"]["xml_ns"]["feed"])
+
+		for name in ("fetcher", "meter", "queue", "lease", "subscriber"):
+			if c.get(name) is not None: c[name].LoadConfig(self.config)
+
+		seeninfo: dict = self.config["xmlfeed"]["seen_index"]
+		c["feedctl"].seen.max_entries = seeninfo["max_entries"]
+		c["feedctl"].seen.max_age_sec = seeninfo["max_age_sec"]
+		c["feedctl"].seen.Evict()
+
+		log.ReloadLogger(self.mhd, self.config)
+
+		# 使わなくなった地図データを解放する（読み込み済みでなければ何もしない）
+		mapdata = sys.modules.get("mapdata")
+		if mapdata is not None:
+			mapdata.RetainCached([p for p in self.config["paths"].values() if isinstance(p, str)])
+
+	def __Result(self, ok: bool, msg: str) -> tuple[bool, str]:
+		if ok:	self.logger.info(msg)
+		else:	self.logger.warning(msg)
+		return (ok, msg)
+
+### class ConfigReloader END ###
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# 電文の種別ごとの処理（EQPlotter）の登録簿
+
+import re
+import dataclasses
+from collections.abc import Callable
+
+### class EntryHandler BEGIN ###
+
+@dataclasses.dataclass(frozen=True)
+class EntryHandler:
+	"""
+		電文の種別 1 つに対する処理の登録内容。
+		code:    電文コード（VXSE51 など）。エントリ ID に含まれるものと照合する
+		name:    投稿文に使う情報の名称
+		factory: config を受け取り、その電文を処理する EQPlotter を返す関数
+	"""
+	code: str
+	name: str
+	factory: Callable[[dict], object]
+
+### class EntryHandler END ###
+
+
+# 電文コード -> EntryHandler
+_HANDLERS: dict[str, EntryHandler] = {}
+
+# エントリ ID（電文の URL）に含まれる電文コード。例：.../20240101000000_0_VXSE53_010000.xml
+_CODE_PATTERN = re.compile(r"_([A-Z]{4}\d{2})_")
+
+def Register(code: str, name: str, factory: Callable[[dict], object]) -> None:
+	"""
+		電文コードに対する処理を登録する。同じ電文コードを再び登録した場合は置き換える。
+		code:    電文コード
+		name:    投稿文に使う情報の名称
+		factory: config を受け取り、その電文を処理する EQPlotter を返す関数
+	"""
+	_HANDLERS[code] = EntryHandler(code, name, factory)
+
+def Find(entry_id: str) -> EntryHandler | None:
+	"""
+		エントリ ID から電文コードを取り出し、登録されている処理を返す。登録がなければ None を返す。
+		entry_id: XML フィードのエントリ ID
+	"""
+	for code in _CODE_PATTERN.findall(entry_id):
+		if code in _HANDLERS: return _HANDLERS[code]
+
+	# 想定外の形式の ID は、従来どおり部分一致で判定する
+	for code, handler in _HANDLERS.items():
+		if code in entry_id: return handler
+	return None
+
+def PlotterFactory(clsname: str) -> Callable[[dict], object]:
+	"""
+		report モジュールの EQPlotter を作る関数を返す。
+		report は読み込みが重いので、実際に電文を処理するときまで読み込まない。
+		clsname: report モジュール内の EQPlotter のクラス名
+	"""
+	def factory(config: dict):
+		import report
+		return getattr(report, clsname)(config)
+	return factory
+
+
+# 「震源に関する情報」（VXSE52）は、直後に震度と一緒に情報が再送されるため登録しない
+Register("VXSE51", "震度速報", PlotterFactory("EQPlotter_VXSE51"))	# 震度速報
+Register("VXSE53", "地震情報", PlotterFactory("EQPlotter_VXSE53"))	# 震源・震度に関する情報
@@ -15,9 +15,12 @@ class IntensityHolder:
 			"7" : [],	"6+": [],	"6-": [],	"5+": [],	"5-": [],
 			"4" : [],	"3" : [],	"2" : [],	"1" : [],	"-" : [], # intensity_max 用の番兵
 		}
+		# 名前に対応するコード（市町村等コードなど）。コードが与えられた場合のみ記録する
+		self.code: dict = { k: [] for k in self.intensity.keys() }
 	
-	def AddIntensity(self, intensity: str, name: str):
+	def AddIntensity(self, intensity: str, name: str, code: str = None):
 		self.intensity[intensity].append(name)
+		if code is not None: self.code[intensity].append(code)
 
 	def PrintIntensity(self) -> str:
 		""" self.intensity をもとに、震度情報文を出力する。 """
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+# 描画した震度地図と情報文の配信。X のほか、Webhook・共有ディレクトリ・まとめメールへ同じ内容を並行して配信する
+
+import os
+import json
+import time
+import hashlib
+import threading
+import traceback
+import dataclasses
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import log
+import post
+import debugdef
+from jmafetch import LatencyWindow
+
+### class Publication BEGIN ###
+
+@dataclasses.dataclass
+class Publication:
+	""" 配信する 1 件分の震度地図と情報文 """
+	image: Future				# report.EncodedImage を返す Future（DrawMap の戻り値）
+	report_id: str	= ""		# 電文のエントリ ID（配信先でのファイル名などに使う）
+	code: str		= ""		# 電文コード（VXSE51 など）
+	text: str		= ""		# 情報文（全文）
+	short_text: str	= ""		# X の文字数制限に合わせて切り詰めた情報文
+	started: float	= dataclasses.field(default_factory=time.perf_counter)	# 配信を始めた時刻。配信にかかった時間の基準
+	prepared: dict	= dataclasses.field(default_factory=dict)				# 配信先の名前 -> 配信先ごとの先行処理の結果
+
+### class Publication END ###
+
+### class Sink BEGIN ###
+
+class Sink:
+	"""
+		配信先の基底クラス。配信先ごとに 1 つ作り、SinkWorker が別スレッドから Deliver を呼び出す。
+		sinkinfo: config.json の post.sinks の要素
+			name:        配信先の名前（ログ・計測用）
+			concurrency: 同時に配信する数。1 なら配信順を保つ
+			batch_sec:   0 より大きければ、この秒数の間に届いたものをまとめて 1 回で配信する
+			retry:       失敗時の再試行（max_attempts 回まで、base_sec から倍々に max_sec まで待つ）
+	"""
+	def __init__(self, sinkinfo: dict, config: dict) -> None:
+		self.name: str			= sinkinfo.get("name", sinkinfo["type"])
+		self.concurrency: int	= sinkinfo.get("concurrency", 1)
+		self.batch_sec: float	= sinkinfo.get("batch_sec", 0)
+		self.retryinfo: dict	= sinkinfo.get("retry", config["post"]["retry"])
+		self.signature: str		= self.Signature(sinkinfo, config)
+
+	@classmethod
+	def Signature(cls, sinkinfo: dict, config: dict) -> str:
+		""" 配信先を作るのに使う設定。設定の再読み込み時にこれが変わった配信先だけを作り直す。 """
+		return json.dumps({ "sink": sinkinfo, "retry": sinkinfo.get("retry", config["post"]["retry"]) }, sort_keys=True)
+
+	def LoadConfig(self, config: dict) -> None:
+		""" 作り直さなかった配信先に、新しい設定を反映する。 """
+		pass
+
+	def Prepare(self, pub: Publication) -> None:
+		""" 情報文ができる前に始めておく処理（画像のアップロードなど）。結果は pub.prepared[self.name] に入れる。 """
+		pass
+
+	def Deliver(self, pubs: list[Publication]) -> bool:
+		"""
+			配信する。失敗した場合は例外を送出する（SinkWorker が再試行する）。
+			配信先が自前で再試行するため配信完了を確認できない場合は False を返す。
+			pubs: 配信するもの。batch_sec が 0 なら常に 1 件
+		"""
+		raise NotImplementedError
+
+	def RetryPending(self) -> None:
+		""" 配信先が自前で持つ再試行を進める。ポーリングごとに呼び出す。 """
+		pass
+
+	def Close(self) -> None:
+		pass
+
+### class Sink END ###
+
+### class XSink BEGIN ###
+
+class XSink(Sink):
+	""" X への投稿。再試行は XPublisher の再試行キュー（再起動しても引き継ぐ）に任せる。 """
+	def __init__(self, sinkinfo: dict, config: dict) -> None:
+		super().__init__(sinkinfo, config)
+		self.publisher = post.XPublisher(config)
+
+	@classmethod
+	def Signature(cls, sinkinfo: dict, config: dict) -> str:
+		# 認証情報・再試行の設定は作り直さずに反映する（再試行キューを引き継ぐ）
+		return json.dumps(sinkinfo, sort_keys=True)
+
+	def LoadConfig(self, config: dict) -> None:
+		self.publisher.LoadConfig(config)
+
+	def Prepare(self, pub: Publication) -> None:
+		# 画像のアップロードは情報文の作成と並行して進める
+		pub.prepared[self.name] = self.publisher.UploadMedia(pub.image)
+
+	def Deliver(self, pubs: list[Publication]) -> bool:
+		ok = True
+		for pub in pubs:
+			# 先行処理の後に設定の再読み込みで配信先が入れ替わった場合などは、ここでアップロードする
+			media = pub.prepared.get(self.name) or self.publisher.UploadMedia(pub.image)
+			ok = self.publisher.Post(pub.short_text, media, pub.image) and ok
+		return ok
+
+	def RetryPending(self) -> None:
+		self.publisher.RetryPending()
+
+	def Close(self) -> None:
+		self.publisher.Close()
+
+### class XSink END ###
+
+### class WebhookSink BEGIN ###
+
+class WebhookSink(Sink):
+	""" Webhook への配信。情報文と画像を multipart/form-data で POST する。 """
+	def __init__(self, sinkinfo: dict, config: dict) -> None:
+		super().__init__(sinkinfo, config)
+		import requests
+		self.url: str			= sinkinfo["url"]
+		self.timeout_sec: float	= sinkinfo.get("timeout_sec", 10)
+		self.session = requests.Session()
+
+	def Deliver(self, pubs: list[Publication]) -> bool:
+		for pub in pubs:
+			encoded = pub.image.result()
+
+			# デバッグ時、配信は封じられる
+			if debugdef.fDebug: continue
+
+			response = self.session.post(
+				self.url,
+				data={ "text": pub.text },
+				files={ "image": (os.path.basename(encoded.path), encoded.data) },
+				timeout=self.timeout_sec
+			)
+			response.raise_for_status()
+		return True
+
+	def Close(self) -> None:
+		self.session.close()
+
+### class WebhookSink END ###
+
+### class DirectorySink BEGIN ###
+
+class DirectorySink(Sink):
+	"""
+		共有ディレクトリへの配信。画像と、情報文を書いた同名のテキストファイル（.txt）を置く。
+		ファイル名は 出力画像の名前（地震発生時刻）_電文コード_エントリ ID のハッシュ とし、同じ地震の別の電文で上書きしない。
+		一時ファイルに書いてから名前を変えるので、読み取り側が書きかけのファイルを読むことはない。
+	"""
+	def __init__(self, sinkinfo: dict, config: dict) -> None:
+		super().__init__(sinkinfo, config)
+		self.dir: str = sinkinfo["dir"]
+		os.makedirs(self.dir, exist_ok=True)
+
+	def Deliver(self, pubs: list[Publication]) -> bool:
+		for pub in pubs:
+			encoded = pub.image.result()
+			stem, ext = os.path.splitext(os.path.basename(encoded.path))
+			stem = f"{stem}_{pub.code}_{hashlib.sha1(pub.report_id.encode('utf-8')).hexdigest()[:8]}"
+			self.__Write(stem + ext, encoded.data)
+			self.__Write(stem + ".txt", pub.text.encode("utf-8"))
+		return True
+
+	def __Write(self, filename: str, data: bytes) -> None:
+		path = os.path.join(self.dir, filename)
+		with open(path + ".tmp", "wb") as f:
+			f.write(data)
+		os.replace(path + ".tmp", path)
+
+### class DirectorySink END ###
+
+### class MailDigestSink BEGIN ###
+
+class MailDigestSink(Sink):
+	"""
+		まとめメールでの配信。batch_sec 秒の間に届いたものを 1 通にまとめ、画像を添付して送る。
+		送信先・SMTP サーバは mailinfo を使う（addr_to は配信先ごとに上書きできる）。
+	"""
+	subject: str = "I-Maplot 地震情報"
+
+	def __init__(self, sinkinfo: dict, config: dict) -> None:
+		super().__init__(sinkinfo, config)
+		mailinfo: dict = config["mailinfo"]
+		self.addr_from: str	= mailinfo["addr_from"]
+		self.addr_to: str	= sinkinfo.get("addr_to") or mailinfo["addr_to"]
+		self.__conn = log.SMTPConnection(
+			mailinfo["server"]["addr"], mailinfo["server"]["port"],
+			mailinfo["addr_from"], mailinfo["password"]
+		)
+
+	@classmethod
+	def Signature(cls, sinkinfo: dict, config: dict) -> str:
+		return super().Signature(sinkinfo, config) + json.dumps(config["mailinfo"], sort_keys=True)
+
+	def Deliver(self, pubs: list[Publication]) -> bool:
+		images = [pub.image.result() for pub in pubs]
+
+		# デバッグ時、配信は封じられる
+		if debugdef.fDebug: return True
+
+		subject = self.subject if len(pubs) == 1 else f"{self.subject}（{len(pubs)} 件）"
+		body = "\n\n----\n\n".join(pub.text for pub in pubs)
+		self.__conn.Send(
+			self.addr_from, self.addr_to, subject, body,
+			[(os.path.basename(e.path), e.data) for e in images]
+		)
+		return True
+
+	def Close(self) -> None:
+		self.__conn.Close()
+
+### class MailDigestSink END ###
+
+# config.json の post.sinks[].type -> 配信先のクラス
+SINKS: dict[str, type[Sink]] = {
+	"x":		XSink,
+	"webhook":	WebhookSink,
+	"directory":	DirectorySink,
+	"mail":		MailDigestSink,
+}
+
+### class SinkWorker BEGIN ###
+
+class SinkWorker:
+	"""
+		1 つの配信先への配信を、その配信先専用のスレッドで行う。遅い・止まっている配信先が他の配信先を待たせることはない。
+		失敗した配信は待ち時間を倍々に延ばしながら再試行し、配信にかかった時間（配信開始から完了まで）を記録する。
+	"""
+	def __init__(self, sink: Sink, logger: log.Logger) -> None:
+		self.sink: Sink = sink
+		self.logger: log.Logger = logger
+		self.latency = LatencyWindow(100)
+
+		self.__executor = ThreadPoolExecutor(max_workers=sink.concurrency, thread_name_prefix=f"Sink-{sink.name}")
+		self.__batch: list[Publication] = []
+		self.__timers: set[threading.Timer] = set()
+		self.__closed: bool = False
+		self.__lock = threading.Lock()
+
+	def Submit(self, pub: Publication) -> None:
+		""" 配信を依頼する。直ちに戻る。 """
+		if self.sink.batch_sec <= 0:
+			self.__executor.submit(self.__Deliver, [pub], 0)
+			return
+
+		with self.__lock:
+			self.__batch.append(pub)
+			if len(self.__batch) == 1:
+				self.__Later(self.sink.batch_sec, self.__Flush)
+
+	def Close(self) -> None:
+		""" まとめ待ちのものを配信し、配信中のものが終わるのを待つ。再試行を待っているものは破棄する。 """
+		with self.__lock:
+			self.__closed = True
+			timers, self.__timers = self.__timers, set()
+		for t in timers: t.cancel()
+
+		self.__Flush()
+		self.__executor.shutdown(wait=True)
+		self.sink.Close()
+
+	def __Flush(self) -> None:
+		with self.__lock:
+			pubs, self.__batch = self.__batch, []
+		if len(pubs) > 0:
+			self.__executor.submit(self.__Deliver, pubs, 0)
+
+	def __Later(self, sec: float, func, *args) -> None:
+		def run() -> None:
+			with self.__lock:
+				self.__timers.discard(timer)
+				if self.__closed: return
+			func(*args)
+
+		timer = threading.Timer(sec, run)
+		timer.daemon = True
+		self.__timers.add(timer)
+		timer.start()
+
+	def __Deliver(self, pubs: list[Publication], attempts: int) -> None:
+		try:
+			delivered = self.sink.Deliver(pubs)
+		except Exception:
+			attempts += 1
+			retryinfo = self.sink.retryinfo
+			if attempts >= retryinfo["max_attempts"] or self.__closed:
+				self.logger.error(f"{self.sink.name} への配信を {attempts} 回試みましたが失敗しました。配信を破棄します。\n" + traceback.format_exc())
+				return
+
+			sec = min(retryinfo["base_sec"] * (2 ** (attempts - 1)), retryinfo["max_sec"])
+			self.logger.warning(f"{self.sink.name} への配信に失敗しました。{sec:.0f} 秒後に再試行します（{attempts} 回目）\n" + traceback.format_exc())
+			with self.__lock:
+				self.__Later(sec, self.__executor.submit, self.__Deliver, pubs, attempts)
+			return
+
+		if not delivered: return
+
+		now = time.perf_counter()
+		for pub in pubs:
+			self.latency.Add(now - pub.started)
+		self.logger.info(
+			f"配信：{self.sink.name} {(now - pubs[-1].started) * 1000:.0f} ms" +\
+			f"（直近 {len(self.latency)} 件の中央値 {self.latency.Percentile(50) * 1000:.0f} ms, 95% {self.latency.Percentile(95) * 1000:.0f} ms）"
+		)
+
+### class SinkWorker END ###
+
+### class FanoutPublisher BEGIN ###
+
+class FanoutPublisher:
+	"""
+		設定された配信先（post.sinks）すべてに、同じ震度地図と情報文を配信する。
+		Begin で画像を渡して配信先ごとの先行処理（X へのアップロードなど）を始め、情報文ができたら Publish で配信を依頼する。
+		配信は配信先ごとのスレッドで行うので、Publish はすぐに戻り、ポーリングを止めない。
+	"""
+	def __init__(self, config: dict) -> None:
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		self.workers: list[SinkWorker] = []
+
+		for sinkinfo in config["post"]["sinks"]:
+			if not sinkinfo.get("enabled", True): continue
+			try:
+				sink = SINKS[sinkinfo["type"]](sinkinfo, config)
+			except Exception:
+				self.logger.error(f"配信先 {sinkinfo.get('name', sinkinfo['type'])} を準備できませんでした。この配信先には配信しません\n" + traceback.format_exc())
+				continue
+			self.workers.append(SinkWorker(sink, self.logger))
+
+	def LoadConfig(self, config: dict) -> None:
+		"""
+			設定を読み直す。設定の変わっていない配信先はそのまま使い（接続・再試行中の配信を引き継ぐ）、変わった配信先だけを作り直す。
+			作り直しに失敗した場合は例外を送出し、配信先は変更しない。
+			config: 新しい設定情報
+		"""
+		current = { w.sink.name: w for w in self.workers }
+		workers: list[SinkWorker] = []
+		created: list[SinkWorker] = []
+
+		try:
+			for sinkinfo in config["post"]["sinks"]:
+				if not sinkinfo.get("enabled", True): continue
+				cls = SINKS[sinkinfo["type"]]
+				w = current.get(sinkinfo.get("name", sinkinfo["type"]))
+
+				if w is not None and type(w.sink) is cls and w.sink.signature == cls.Signature(sinkinfo, config):
+					workers.append(w)
+				else:
+					w = SinkWorker(cls(sinkinfo, config), self.logger)
+					created.append(w)
+					workers.append(w)
+		except Exception:
+			for w in created: w.Close()
+			raise
+
+		for w in workers:
+			if w not in created: w.sink.LoadConfig(config)
+		removed = [w for w in self.workers if w not in workers]
+		self.workers = workers
+
+		if len(created) > 0 or len(removed) > 0:
+			self.logger.info("配信先を変更しました：" + (", ".join(w.sink.name for w in workers) or "なし"))
+
+		# 外した配信先は、配信中のものが終わるのを待ってから閉じる
+		if len(removed) > 0:
+			threading.Thread(target=lambda: [w.Close() for w in removed], name="SinkClose", daemon=True).start()
+
+	def Begin(self, image: Future, report_id: str = "", code: str = "") -> Publication:
+		"""
+			配信を始める。情報文の作成と並行して、配信先ごとの先行処理を進める。
+			image:     EQPlotter の DrawMap（OutputImage）の戻り値
+			report_id: 電文のエントリ ID
+			code:      電文コード（VXSE51 など）
+		"""
+		pub = Publication(image, report_id, code)
+		for w in self.workers:
+			w.sink.Prepare(pub)
+		return pub
+
+	def Publish(self, pub: Publication, text: str, short_text: str) -> None:
+		"""
+			すべての配信先に配信を依頼する。
+			pub:        Begin の戻り値
+			text:       情報文（全文）
+			short_text: X の文字数制限に合わせて切り詰めた情報文
+		"""
+		pub.text, pub.short_text = text, short_text
+		for w in self.workers:
+			w.Submit(pub)
+
+	def RetryPending(self) -> None:
+		""" 配信先が自前で持つ再試行（X の再試行キュー）を進める。 """
+		for w in self.workers:
+			try:
+				w.sink.RetryPending()
+			except Exception:
+				self.logger.error(traceback.format_exc())
+
+	def Close(self) -> None:
+		""" 配信中のものが終わるのを待ち、配信先を閉じる。 """
+		for w in self.workers:
+			w.Close()
+
+	def LatencySummary(self) -> str:
+		""" 配信先ごとの配信時間の要約（alive の応答用） """
+		return ", ".join(
+			f"{w.sink.name} p50 {w.latency.Percentile(50) * 1000:.0f} ms / p95 {w.latency.Percentile(95) * 1000:.0f} ms"
+			for w in self.workers if len(w.latency) > 0
+		) or "-"
+
+### class FanoutPublisher END ###
@@ -1,6 +1,101 @@
 import datetime
+import dataclasses
+import hashlib
 import pickle
 
+from collections import OrderedDict
+
+### class SeenIndex BEGIN ###
+
+class SeenIndex:
+	"""
+		処理済みエントリの索引。エントリ ID と、電文を解析した後は内容ハッシュ（ContentHash）でも照合する。
+		同じ updated 秒に複数のエントリが並ぶ場合や、ID を変えて再送された同一内容の電文も取りこぼし・二重処理なく判別できる。
+		保持件数（LRU）と保持期間の両方で古いものから追い出すので、索引の大きさは一定以下に保たれる。
+	"""
+	def __init__(self, max_entries: int = 2048, max_age_sec: int = 7 * 24 * 3600) -> None:
+		# キー（ID または内容ハッシュ） -> エントリの更新時刻。挿入順 = 古い順
+		self.__index: OrderedDict[str, datetime.datetime] = OrderedDict()
+		self.max_entries: int	= max_entries
+		self.max_age_sec: int	= max_age_sec
+		self.seeded: bool		= False	# 初回起動時の時刻による種まきが済んでいるか
+
+	def __len__(self) -> int:
+		return len(self.__index)
+
+	def Contains(self, entry, content_hash: str = None) -> bool:
+		"""
+			エントリが処理済みかどうかを O(1) で判定する。
+			保持期間より古いエントリは索引から追い出された後も処理済みとみなす。
+			entry:        main.EntryData
+			content_hash: 電文の内容ハッシュ（ContentHash）。解析前なら None（ID だけで照合する）
+		"""
+		if entry.updated_time < self.__Cutoff(): return True
+
+		for key in (entry.id, content_hash):
+			if key is None: continue
+			if key in self.__index:
+				self.__index.move_to_end(key)
+				return True
+		return False
+
+	def Add(self, entry, content_hash: str = None) -> None:
+		"""
+			エントリを処理済みとして記録する。
+			entry:        main.EntryData
+			content_hash: 電文の内容ハッシュ（ContentHash）。なければ None
+		"""
+		for key in (entry.id, content_hash):
+			if key is None: continue
+			self.__index[key] = entry.updated_time
+			self.__index.move_to_end(key)
+		self.Evict()
+
+	def Seed(self, entries: list, until: datetime.datetime) -> None:
+		"""
+			索引が空の状態（初回起動、旧形式の FeedControl からの移行）で、until 以前のエントリを処理済みとして登録する。
+			これにより索引導入前の時刻による判定を引き継ぎ、起動直後にフィード内の過去情報を再送出することを防ぐ。
+			entries: main.EntryData のリスト
+			until:   この時刻以前のエントリを処理済みとする
+		"""
+		if self.seeded: return
+
+		for e in entries:
+			if e.updated_time <= until: self.Add(e)
+		self.seeded = True
+
+	def Evict(self) -> None:
+		""" 保持件数・保持期間を超えた古いキーを追い出す。 """
+		cutoff = self.__Cutoff()
+
+		while len(self.__index) > 0:
+			key, updated = next(iter(self.__index.items()))
+			if len(self.__index) <= self.max_entries and updated >= cutoff: break
+			del self.__index[key]
+
+	def __Cutoff(self) -> datetime.datetime:
+		return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.max_age_sec)
+
+### class SeenIndex END ###
+
+
+### class FeedState BEGIN ###
+
+@dataclasses.dataclass
+class FeedState:
+	"""
+		XML フィード 1 本ごとの取得状況。
+		If-Modified-Since に使う最終更新時刻と、更新の有無の判定に使うフィードの ID を保持する。
+	"""
+	last_update: datetime.datetime	= datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+	xmlid: str						= ""
+	reqerr_count: int				= 0
+
+### class FeedState END ###
+
+
+### class FeedControl BEGIN ###
+
 class FeedControl:
 	"""
 		I-Maplot を動かすにあたり必要な情報、特に地震情報の更新に関する情報を保存しておく。
@@ -12,12 +107,50 @@ class FeedControl:
 		self.last_eq: datetime.datetime		 = datetime.datetime.now(datetime.timezone.utc)
 		self.last_access: datetime.datetime	 = datetime.datetime.now(datetime.timezone.utc)
 		self.last_update: datetime.datetime	 = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
-		
-		self.reqerr_count: int	= 0
+
 		self.pkl_path: str		= pickle_path
-		self.xmlid: str			= ""
 		self.last_msg: str		= "地震情報はありません"
-		
+		self.last_render: str	= ""	# 直近の描画のメモリ使用量の要約
+		self.seen: SeenIndex	= SeenIndex()
+		self.feeds: dict[str, FeedState] = {}	# フィード名 -> 取得状況
+
+	def __setstate__(self, state: dict) -> None:
+		# 旧バージョンで保存された pickle には後から追加したメンバが存在しないので、既定値で補う
+		self.__init__(state.get("pkl_path", ""))
+		self.__dict__.update(state)
+
+		# フィードごとの取得状況を持たない旧形式からは、eqvol の状況として引き継ぐ
+		if "feeds" not in state:
+			self.feeds["eqvol"] = FeedState(
+				state.get("last_update", self.last_update),
+				state.pop("xmlid", ""),
+				state.pop("reqerr_count", 0)
+			)
+			self.__dict__.pop("xmlid", None)
+			self.__dict__.pop("reqerr_count", None)
+
+	def Feed(self, name: str) -> FeedState:
+		"""
+			フィードの取得状況を返す。初めてのフィードであれば作成する。
+			name: フィード名（config.json の xmlfeed.feeds[].name）
+		"""
+		if name not in self.feeds:
+			self.feeds[name] = FeedState()
+		return self.feeds[name]
+
 	def PickleMyself(self):
 		with open(self.pkl_path, "wb") as f:
 			pickle.dump(self, f)
+
+### class FeedControl END ###
+
+
+def ContentHash(entry, report_key: str) -> str:
+	"""
+		電文の内容ハッシュを計算する。同じ電文が別の ID（と URL・更新時刻）で再送されても同じ値になる。
+		再送で変わるエントリ ID・電文の URL・更新時刻は含めず、表題・本文と、電文の識別情報から計算する。
+		entry:      main.EntryData
+		report_key: 電文の識別情報（EQPlotter の report_key。InfoKind, EventID, ReportDateTime）
+	"""
+	s = "\n".join((entry.title, entry.content or "", report_key))
+	return "sha1:" + hashlib.sha1(s.encode("utf-8")).hexdigest()
@@ -19,6 +19,14 @@ class Scheduler:
 		self.args_: tuple	= args
 		self.fexec_: bool	= False
 
+		# 定期実行と即時実行（trigger）が重ならないようにするためのロック
+		self.lock_			= threading.Lock()
+		# 即時実行の要求を受け付けるためのロック（実行中でも待たずに受け付けられるよう lock_ とは分ける）
+		self.state_lock_	= threading.Lock()
+		self.retrigger_: bool	= False		# 即時実行が要求されているか
+		self.on_done_: list		= []		# 即時実行の完了時に呼び出す関数
+		self.triggering_: bool	= False		# 即時実行のスレッドが動いているか
+
 	def caller_(self) -> None:
 		"""
 			スケジューラによって呼び出される実際の関数。
@@ -40,13 +48,80 @@ class Scheduler:
 				self.timer_.daemon = True
 				self.timer_.start()
 
-				if isinstance(self.args_, tuple):
-					self.callback_(*self.args_)
+				# 前回の実行（または即時実行）が終わっていない場合は今回の分を飛ばす
+				if self.lock_.acquire(blocking=False):
+					try:
+						self.call_()
+					finally:
+						self.lock_.release()
+					self.rerun_()
 				else:
-					self.callback_()
+					self.logger_.warning("前回の実行が終わっていないため、今回の定期実行を省略します")
 		except Exception:
 			self.logger_.error(traceback.format_exc())
+
+	def call_(self) -> None:
+		""" 登録した関数を呼び出す。 """
+		if isinstance(self.args_, tuple):
+			self.callback_(*self.args_)
+		else:
+			self.callback_()
+
+	def rerun_(self, triggered: bool = False) -> None:
+		"""
+			即時実行が要求されていれば、もう一度実行する。要求がなくなるまで繰り返す。
+			完了を待っている関数は、要求の後に始めた実行が終わってから呼び出す。
+			triggered: 即時実行のスレッドから呼び出したか
+		"""
+		while True:
+			with self.state_lock_:
+				if not self.retrigger_:
+					if triggered: self.triggering_ = False
+					return
+				self.retrigger_ = False
+				on_done, self.on_done_ = self.on_done_, []
+
+			with self.lock_:
+				try:
+					self.call_()
+				except Exception:
+					self.logger_.error(traceback.format_exc())
+
+			for f in on_done:
+				try:
+					f()
+				except Exception:
+					self.logger_.error(traceback.format_exc())
+
+	def trigger(self, on_done = None) -> None:
+		"""
+			次の定期実行を待たずに、登録した関数を（別スレッドで）直ちに実行する。
+			実行中であれば、その実行が終わった後にもう一度実行する。
+			即時実行のスレッドは同時に 1 本だけ動かし、その間に来た要求はまとめて 1 回の実行で済ませる。
+			on_done: 実行が完了した後に呼び出す関数（省略可）
+		"""
+		if not self.fexec_: return
+
+		with self.state_lock_:
+			self.retrigger_ = True
+			if on_done is not None: self.on_done_.append(on_done)
+			if self.triggering_: return
+			self.triggering_ = True
+
+		# 実行中の場合は、その実行が終わるのを待って（実行中のスレッドか、このスレッドのどちらかが）再実行する
+		threading.Thread(target=self.rerun_, args=(True,), name="SchedulerTrigger", daemon=True).start()
 	
+	def reconfigure(self, sec: int, apply = None) -> None:
+		"""
+			実行間隔を変更する。変更は次回の定期実行の予約から反映される。
+			apply を指定した場合は、登録した関数が実行中でないとき（実行中なら終わるのを待って）に呼び出す。
+			sec:   新しい実行間隔 [秒]
+			apply: 登録した関数の実行と重ならないように呼び出す関数（省略可）
+		"""
+		with self.lock_:
+			if apply is not None: apply()
+			self.sec_ = sec
+
 	def start(self) -> None:
 		"""
 			スケジューラを開始する。
@@ -57,10 +132,8 @@ class Scheduler:
 		self.timer_.daemon = True
 		self.timer_.start()
 
-		if isinstance(self.args_, tuple):
-			self.callback_(*self.args_)
-		else:
-			self.callback_()
+		with self.lock_:
+			self.call_()
 
 	def stop(self) -> None:
 		"""
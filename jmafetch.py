@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# 気象庁 XML の取得。タイムアウト、電文取得の投機的な再要求（ヘッジ）、サーキットブレーカを備える
+
+import time
+import threading
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import log
+
+class CircuitOpenError(requests.exceptions.RequestException):
+	""" サーキットブレーカが開いている（気象庁側の障害中とみなしている）ため、要求を送らなかった """
+	pass
+
+def IsOutage(e: requests.exceptions.RequestException) -> bool:
+	""" 相手側（気象庁）の障害とみなす失敗かどうか。接続の失敗、タイムアウト、5xx の応答 """
+	if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)): return True
+	response = getattr(e, "response", None)
+	return isinstance(e, requests.exceptions.HTTPError) and response is not None and response.status_code >= 500
+
+### class CircuitBreaker BEGIN ###
+
+class CircuitBreaker:
+	"""
+		取得の失敗が続いた場合に、一定時間要求を止めて相手側（気象庁）への負荷を減らす。
+		closed:    通常どおり要求する
+		open:      要求しない。止める時間は開くたびに倍に延ばす（base_sec, 2 * base_sec, ..., max_sec）
+		half_open: 止める時間が過ぎたら 1 件だけ試しに要求し、成功すれば直ちに closed に戻す
+	"""
+	def __init__(self, failures: int, base_sec: float, max_sec: float) -> None:
+		self.failures: int		= failures
+		self.base_sec: float	= base_sec
+		self.max_sec: float		= max_sec
+
+		self.state: str			= "closed"
+		self.fail_count: int	= 0		# 連続失敗回数
+		self.trips: int			= 0		# 連続して開いた回数
+		self.open_until: float	= 0.0	# time.monotonic
+		self.__trial: bool		= False	# half_open で試しの要求を送っている最中か
+		self.__lock = threading.Lock()
+
+	def Allow(self) -> bool:
+		""" 要求を送ってよいかどうか。half_open では最初の 1 件だけ許可する。 """
+		with self.__lock:
+			if self.state == "closed": return True
+
+			if self.state == "open":
+				if time.monotonic() < self.open_until: return False
+				self.state = "half_open"
+				self.__trial = False
+
+			if self.__trial: return False
+			self.__trial = True
+			return True
+
+	def Success(self) -> bool:
+		""" 要求の成功を記録する。ブレーカが閉じた（障害から復旧した）場合は True を返す。 """
+		with self.__lock:
+			recovered = self.state != "closed"
+			self.state = "closed"
+			self.fail_count = 0
+			self.trips = 0
+			self.__trial = False
+			return recovered
+
+	def Failure(self) -> float | None:
+		""" 要求の失敗を記録する。ブレーカが開いた場合は要求を止める秒数を返す。 """
+		with self.__lock:
+			self.fail_count += 1
+			if self.state == "closed" and self.fail_count < self.failures: return None
+
+			self.trips += 1
+			sec = min(self.base_sec * (2 ** (self.trips - 1)), self.max_sec)
+			self.state = "open"
+			self.open_until = time.monotonic() + sec
+			self.__trial = False
+			return sec
+
+### class CircuitBreaker END ###
+
+### class LatencyWindow BEGIN ###
+
+class LatencyWindow:
+	""" 直近の応答時間を保持し、その百分位数を求める。 """
+	def __init__(self, size: int) -> None:
+		self.__samples: deque[float] = deque(maxlen=size)
+		self.__lock = threading.Lock()
+
+	def __len__(self) -> int:
+		return len(self.__samples)
+
+	def Add(self, sec: float) -> None:
+		with self.__lock:
+			self.__samples.append(sec)
+
+	def Percentile(self, p: float) -> float:
+		""" p パーセンタイル（0 < p <= 100） """
+		with self.__lock:
+			ls = sorted(self.__samples)
+		return ls[min(len(ls) - 1, max(0, int(len(ls) * p / 100 + 0.5) - 1))]
+
+### class LatencyWindow END ###
+
+### class JMAFetcher BEGIN ###
+
+class JMAFetcher:
+	"""
+		気象庁 XML フィード・電文を取得する。接続（コネクションプール）は全フィード・電文で共有する。
+		すべての要求に接続・読み込みのタイムアウトを設定し、1 つの接続の停滞で取得処理全体が止まることを防ぐ。
+		電文の取得が直近の応答時間の hedge.percentile パーセンタイルを超えても終わらない場合は、同じ要求をもう 1 本送り、
+		先に返ってきた方を使う。
+		失敗が続いた場合はサーキットブレーカが開き、要求を止める（CircuitOpenError）。
+	"""
+	def __init__(self, config: dict) -> None:
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		self.session = requests.Session()
+		self.breaker = CircuitBreaker(0, 0, 0)
+		self.LoadConfig(config)
+
+		self.latency = LatencyWindow(self.hedgeinfo["window"])
+		self.__executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="JMAFetch")
+
+	def LoadConfig(self, config: dict) -> None:
+		reqinfo: dict = config["xmlfeed"]["request"]
+		self.timeout: tuple[float, float] = (reqinfo["connect_timeout_sec"], reqinfo["read_timeout_sec"])
+		self.hedgeinfo: dict = reqinfo["hedge"]
+
+		# ブレーカの状態（障害中かどうか）は設定を読み直しても引き継ぐ
+		brkinfo: dict = reqinfo["breaker"]
+		self.breaker.failures	= brkinfo["failures"]
+		self.breaker.base_sec	= brkinfo["base_sec"]
+		self.breaker.max_sec	= brkinfo["max_sec"]
+
+	def Get(self, url: str, headers: dict = None) -> requests.Response:
+		"""
+			タイムアウトとサーキットブレーカを適用して GET 要求を送る。HTTP のエラー（4xx, 5xx）も例外として送出する。
+			url:     取得先
+			headers: HTTP ヘッダ
+		"""
+		self.__Allow(url)
+		return self.__Record(lambda: self.__Send(url, headers))
+
+	def GetReport(self, url: str) -> requests.Response:
+		"""
+			電文を取得する。最初の要求が遅い場合はヘッジ要求を送り、先に成功した方の応答を返す。
+			ヘッジ要求を送っても、ブレーカには 1 回の取得として成功・失敗を記録する。
+			url: 電文の URL
+		"""
+		self.__Allow(url)
+		return self.__Record(lambda: self.__Hedged(url))
+
+	def __Hedged(self, url: str) -> requests.Response:
+		if not self.hedgeinfo["enabled"]: return self.__Timed(url)
+
+		first = self.__executor.submit(self.__Timed, url)
+		done, _ = wait([first], timeout=self.HedgeDelay())
+		if first in done: return first.result()
+
+		self.logger.info(f"電文の取得が遅いため、同じ要求をもう 1 本送ります（{url}）")
+		second = self.__executor.submit(self.__Timed, url)
+		pending = {first, second}
+		error = None
+		while len(pending) > 0:
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for fut in done:
+				if fut.exception() is None: return fut.result()
+				error = error or fut.exception()
+		raise error
+
+	def HedgeDelay(self) -> float:
+		""" ヘッジ要求を送るまでの待ち時間。応答時間の標本が少ないうちは既定値を使う。 """
+		if len(self.latency) < self.hedgeinfo["min_samples"]:
+			return self.hedgeinfo["default_delay_sec"]
+		return max(self.latency.Percentile(self.hedgeinfo["percentile"]), self.hedgeinfo["min_delay_sec"])
+
+	def Close(self) -> None:
+		self.__executor.shutdown(wait=False)
+		self.session.close()
+
+	def __Allow(self, url: str) -> None:
+		if not self.breaker.Allow():
+			raise CircuitOpenError(f"気象庁への要求を停止中です（{url}）")
+
+	def __Record(self, request) -> requests.Response:
+		"""
+			要求を実行し、その結果をブレーカに記録する。
+			失敗として数えるのは相手側の障害とみなせるもの（接続の失敗、タイムアウト、5xx）だけで、
+			4xx などは応答があったので成功として扱う（例外はそのまま送出する）。
+			request: 要求を送って応答を返す関数
+		"""
+		try:
+			response = request()
+		except requests.exceptions.RequestException as e:
+			if IsOutage(e):
+				sec = self.breaker.Failure()
+				if sec is not None:
+					self.logger.warning(f"気象庁 XML の取得に失敗し続けているため、{sec:.0f} 秒間要求を停止します")
+			elif self.breaker.Success():
+				self.logger.info("気象庁 XML の取得が復旧しました。通常の取得を再開します")
+			raise
+
+		if self.breaker.Success():
+			self.logger.info("気象庁 XML の取得が復旧しました。通常の取得を再開します")
+		return response
+
+	def __Send(self, url: str, headers: dict = None) -> requests.Response:
+		response = self.session.get(url, headers=headers, timeout=self.timeout)
+		response.raise_for_status()
+		return response
+
+	def __Timed(self, url: str) -> requests.Response:
+		start = time.perf_counter()
+		response = self.__Send(url)
+		self.latency.Add(time.perf_counter() - start)
+		return response
+
+### class JMAFetcher END ###
@@ -4,13 +4,25 @@
 
 import smtplib
 import os
+import sys
 import json
+import time
+import queue
+import threading
+import traceback
+
+from collections import deque
 
 from logging import getLogger, handlers, Formatter, Logger, ERROR
 from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
 from email.utils import formatdate
 
 
+_STOP = object()	# TLS_SMTPHandler の送信スレッドを止めるための番兵
+
+
 ### class MailHandler BEGIN ###
 
 class MailHandler:
@@ -19,11 +31,15 @@ class MailHandler:
 	def __init__(self, config_path: str, conf_enctype: str = "utf-8") -> None:
 		with open(config_path, "r", encoding=conf_enctype) as f:
 			conf = json.load(f)
-			self.server_addr: str	= conf["mailinfo"]["server"]["addr"]
-			self.server_port: str	= conf["mailinfo"]["server"]["port"]
-			self.addr_to: str	= conf["mailinfo"]["addr_to"]
-			self.addr_from: str	= conf["mailinfo"]["addr_from"]
-			self.password: str	= conf["mailinfo"]["password"]
+			self.LoadConfig(conf)
+		self.log_handler: TLS_SMTPHandler = None	# set_logger で設定される
+
+	def LoadConfig(self, conf: dict) -> None:
+		self.server_addr: str	= conf["mailinfo"]["server"]["addr"]
+		self.server_port: str	= conf["mailinfo"]["server"]["port"]
+		self.addr_to: str	= conf["mailinfo"]["addr_to"]
+		self.addr_from: str	= conf["mailinfo"]["addr_from"]
+		self.password: str	= conf["mailinfo"]["password"]
 
 	def send(self, body: str) -> None:
 		SendMail(
@@ -33,6 +49,11 @@ class MailHandler:
 			self.subject, body
 		)
 
+	def Flush(self) -> None:
+		""" メール ロギングハンドラに溜まっているログを直ちに送信する。 """
+		if self.log_handler is not None:
+			self.log_handler.Flush()
+
 ### class MailHandler END ###
 
 
@@ -43,15 +64,125 @@ class TLS_SMTPHandler(handlers.SMTPHandler):
 		デフォルトの logging.SMTPHandler は Gmail の SMTP に対応していない（TLS 認証がない）
 		なので、クラスを継承、ログ送出関数（emit）をオーバーライド
 		参考 : https://qiita.com/ryoheiszk/items/8b072adeb368cc35588d
+
+		emit はキューに積むだけで、実際の送信はバックグラウンドのスレッドが行う（ポーリングを止めない）。
+		batch_sec 秒以内に積まれたログは 1 通のまとめメールにし、1 時間あたりの送信数は max_per_hour 通までに抑える。
+		送信には認証済みの SMTPConnection を使い回す。
 	"""
+	max_buffer: int = 500	# まとめメール 1 通に載せるログの上限
+
+	def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None,
+			batch_sec: float = 10.0, max_per_hour: int = 20) -> None:
+		super().__init__(mailhost, fromaddr, toaddrs, subject, credentials)
+		self.batch_sec: float	= batch_sec
+		self.max_per_hour: int	= max(max_per_hour, 1)	# 0 以下ではいつまでも送信できなくなる
+
+		self.__conn = SMTPConnection(self.mailhost, self.mailport, self.username, self.password)
+		self.__conn_lock = threading.Lock()
+		self.__queue: queue.Queue	= queue.Queue()
+		self.__sent: deque[float]	= deque()	# 直近 1 時間の送信時刻
+		self.__dropped: int			= 0			# 上限を超えて捨てたログの数
+		self.__thread = threading.Thread(target=self.__Worker, name="TLS_SMTPHandler", daemon=True)
+		self.__thread.start()
+
 	def emit(self, record):
-		for toaddr in self.toaddrs:
-			SendMail(
-				self.mailhost, self.mailport,
-				self.fromaddr, toaddr,
-				self.username, self.password,
-				self.getSubject(record), self.format(record)
-			)
+		try:
+			self.__queue.put_nowait(self.format(record))
+		except Exception:
+			self.handleError(record)
+
+	def Flush(self, timeout: float = 30.0) -> None:
+		"""
+			キューに溜まっているログを（送信数の上限を無視して）直ちに送信する。送信が終わるまで待つ。
+			timeout: 送信完了を待つ最大秒数
+		"""
+		if not self.__thread.is_alive(): return
+
+		done = threading.Event()
+		self.__queue.put(done)
+		done.wait(timeout)
+
+	def Reconfigure(self, mhd: MailHandler, batch_sec: float, max_per_hour: int) -> None:
+		"""
+			送信先・SMTP サーバ・まとめメールの設定を変更する。溜まっているログは新しい設定で送信する。
+			mhd: 新しい送信先を設定した MailHandler
+			batch_sec / max_per_hour: まとめメールの集約時間と 1 時間あたりの送信数の上限
+		"""
+		self.batch_sec		= batch_sec
+		self.max_per_hour	= max(max_per_hour, 1)
+
+		with self.__conn_lock:
+			self.fromaddr	= mhd.addr_from
+			self.toaddrs	= [mhd.addr_to]
+			server = (mhd.server_addr, mhd.server_port, mhd.addr_from, mhd.password)
+			if server != (self.mailhost, self.mailport, self.username, self.password):
+				self.mailhost, self.mailport, self.username, self.password = server
+				self.__conn.Close()
+				self.__conn = SMTPConnection(*server)
+
+	def close(self):
+		if self.__thread.is_alive():
+			self.__queue.put(_STOP)
+			self.__thread.join(30.0)
+		with self.__conn_lock:
+			self.__conn.Close()
+		super().close()
+
+	def __Worker(self) -> None:
+		buffer: list[str]	= []
+		deadline: float		= None	# まとめメールを送る時刻
+
+		while True:
+			timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+			try:
+				item = self.__queue.get(timeout=timeout)
+			except queue.Empty:
+				# 集約時間が過ぎた。送信数の上限に達している場合は、送信可能になるまで溜め続ける
+				if self.__Allowed():
+					self.__SendDigest(buffer)
+					buffer, deadline = [], None
+				elif len(self.__sent) > 0:
+					deadline = self.__sent[0] + 3600
+				else:
+					deadline = time.monotonic() + self.batch_sec
+				continue
+
+			if item is _STOP:
+				self.__SendDigest(buffer)
+				return
+			elif isinstance(item, threading.Event):
+				self.__SendDigest(buffer)
+				buffer, deadline = [], None
+				item.set()
+				continue
+
+			if len(buffer) < self.max_buffer:	buffer.append(item)
+			else:								self.__dropped += 1
+			if deadline is None: deadline = time.monotonic() + self.batch_sec
+
+	def __Allowed(self) -> bool:
+		now = time.monotonic()
+		while len(self.__sent) > 0 and self.__sent[0] < now - 3600:
+			self.__sent.popleft()
+		return len(self.__sent) < self.max_per_hour
+
+	def __SendDigest(self, buffer: list[str]) -> None:
+		if len(buffer) == 0: return
+
+		subject = self.subject if len(buffer) == 1 else f"{self.subject}（{len(buffer)} 件）"
+		body = "\n\n----\n\n".join(buffer)
+		if self.__dropped > 0:
+			body += f"\n\n----\n\n送信数の上限により、ほかに {self.__dropped} 件のログを省略しました。"
+			self.__dropped = 0
+
+		try:
+			with self.__conn_lock:
+				for toaddr in self.toaddrs:
+					self.__conn.Send(self.fromaddr, toaddr, subject, body)
+			self.__sent.append(time.monotonic())
+		except Exception:
+			# ロガー経由で報告すると自分自身に戻ってくるので、標準エラー出力に出すだけにする
+			sys.stderr.write("--- Logging error ---\n" + traceback.format_exc())
 
 ### class TLS_SMTPHandler END ###
 
@@ -80,11 +211,72 @@ def SendMail(
 	smtpobj.send_message(message)
 	smtpobj.close()
 
+### class SMTPConnection BEGIN ###
+
+class SMTPConnection:
+	"""
+		認証済み（STARTTLS + ログイン）の SMTP 接続を保持し、使い回す。
+		サーバ側で切断されていた場合は一度だけ接続し直して送信する。
+	"""
+	def __init__(self, server_addr: str, server_port: int, cred_addr: str, password: str) -> None:
+		self.server_addr: str	= server_addr
+		self.server_port: int	= server_port
+		self.cred_addr: str		= cred_addr
+		self.password: str		= password
+		self.__smtp: smtplib.SMTP = None
+
+	def Send(self, addr_from: str, addr_to: str, subject: str, body: str, attachments: list[tuple[str, bytes]] = None) -> None:
+		"""
+			メールを送信する。
+			addr_from / addr_to:  メール送信元／先アドレス
+			subject: メールのタイトル
+			body:    本文
+			attachments: 添付ファイルの (ファイル名, 内容) のリスト
+		"""
+		if attachments:
+			message = MIMEMultipart()
+			message.attach(MIMEText(body))
+			for filename, data in attachments:
+				part = MIMEApplication(data, Name=filename)
+				part["Content-Disposition"] = f'attachment; filename="{filename}"'
+				message.attach(part)
+		else:
+			message = MIMEText(body)
+		message["Subject"] = subject
+		message["From"] = addr_from
+		message["To"] = addr_to
+		message["Date"] = formatdate()
+
+		for retry in (False, True):
+			try:
+				if self.__smtp is None: self.Open()
+				self.__smtp.send_message(message)
+				return
+			except (smtplib.SMTPException, OSError):
+				self.Close()
+				if retry: raise
+
+	def Open(self) -> None:
+		self.__smtp = smtplib.SMTP(self.server_addr, self.server_port)
+		self.__smtp.starttls()
+		self.__smtp.login(self.cred_addr, self.password)
+
+	def Close(self) -> None:
+		if self.__smtp is None: return
+
+		try:
+			self.__smtp.quit()
+		except (smtplib.SMTPException, OSError):
+			self.__smtp.close()
+		self.__smtp = None
+
+### class SMTPConnection END ###
+
 def set_logger(level: int, mhd: MailHandler, config: dict) -> None:
 	"""
 		全体（ルート）のログ設定。
 		ファイルに書き出す。ログが 100 KB 溜まったらバックアップにして新しいファイルを作る。
-		ERROR 以上のレベルはメールにて送信する。
+		ERROR 以上のレベルはメールにて送信する。送信はバックグラウンドで行い、短時間のログは 1 通にまとめる。
 		level: 出力レベル。DEBUG, INFO, WARNING, ERROR, CRITICAL のいずれか
 		mhd:   メール送信ハンドラ。事前に送信先を設定しておく必要あり。
 		config: config.json から得た設定情報
@@ -117,10 +309,24 @@ def set_logger(level: int, mhd: MailHandler, config: dict) -> None:
 		fromaddr=mhd.addr_from,
 		toaddrs=mhd.addr_to,
 		subject="I-Maplot ERROR log",
-		credentials=(mhd.addr_from, mhd.password)
+		credentials=(mhd.addr_from, mhd.password),
+		batch_sec=config["mailinfo"]["batch_sec"],
+		max_per_hour=config["mailinfo"]["max_per_hour"]
 	)
 	format = Formatter("%(asctime)s : [%(levelname)s]\nFrom %(filename)s -\n%(message)s")
 	smtp_handler.setLevel(ERROR)
 	smtp_handler.setFormatter(format)
 	logger_approot.addHandler(smtp_handler)
+	mhd.log_handler = smtp_handler
 	return
+
+def ReloadLogger(mhd: MailHandler, config: dict) -> None:
+	"""
+		設定の再読み込み時に、メール ロギングハンドラの送信先・SMTP サーバ・まとめメールの設定を反映する。
+		ログファイルの保存先の変更は、再起動するまで反映されない。
+		mhd:    メール送信ハンドラ（set_logger に渡したもの）
+		config: config.json から得た新しい設定情報
+	"""
+	mhd.LoadConfig(config)
+	if mhd.log_handler is not None:
+		mhd.log_handler.Reconfigure(mhd, config["mailinfo"]["batch_sec"], config["mailinfo"]["max_per_hour"])
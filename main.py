@@ -1,12 +1,16 @@
 # coding: utf-8
+import time
+T_LAUNCH = time.perf_counter()	# 起動時間計測の基準（main.py の読み込み開始時刻）
+
 import datetime
 import requests
 import struct
 import json
 import post
 import pickle
-import time
 import os
+import signal
+import threading
 import traceback
 import dataclasses
 
@@ -17,14 +21,29 @@ from xml.etree.ElementTree import Element
 from finalizer import Finalizer
 from socket import socket, setdefaulttimeout, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
 from collections.abc import Iterator
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Tuple, TYPE_CHECKING
 
 from interval import Scheduler
-from feedctl import FeedControl
-from report import EQPlotter_VXSE51, EQPlotter_VXSE53
+from feedctl import FeedControl, FeedState, ContentHash
+from memprof import RenderMeter
+from jmafetch import JMAFetcher, CircuitOpenError
+from reportqueue import ReportQueue, PendingReport
+from websub import PushSubscriber
+from fanout import FanoutPublisher
+from standby import LeaderLease
+from confreload import ConfigReloader
+import entryhandler
 import log
 import debugdef
 
+# report（cv2, matplotlib, numpy）は読み込みが重いので、初回の描画時か WarmUp で読み込む
+if TYPE_CHECKING:
+	from report import EQPlotter_VXSE51, EQPlotter_VXSE53
+
+# 複数の XML フィードを並行して取得するためのスレッドプール
+_fetcher = ThreadPoolExecutor(thread_name_prefix="FeedFetch")
+
 
 ### class EntryData BEGIN ###
 
@@ -65,137 +84,410 @@ def GetEntryList(root: Element, ns: dict) -> list[EntryData]:
 
 	return lsentry
 
-def CheckId(root: Element, feedctl: FeedControl, ns: dict) -> bool:
+def CheckId(root: Element, state: FeedState, ns: dict) -> bool:
 	"""
-		FeedControl に記録された XML の ID と 取得した XML フィードの ID を比較する。
-		渡された XML の ID の方が新しければ FeedControl を更新して True を返す。
-		root:    XML 全体を示すオブジェクト
-		feedctl: FeedControl クラス。 XML の ID 比較用
-		ns:      XML 名前空間。config.json により規定される
+		FeedState に記録された XML の ID と 取得した XML フィードの ID を比較する。
+		ID が記録と同じ（フィードに変更がない）場合は True を返す。記録は取得した ID に更新する。
+		root:  XML 全体を示すオブジェクト
+		state: フィードの取得状況。 XML の ID 比較用
+		ns:    XML 名前空間。config.json により規定される
 	"""
 	current = root.find("atom:id", ns).text
-	ret = True if current == feedctl.xmlid else False
+	ret = True if current == state.xmlid else False
 
-	feedctl.xmlid = current
+	state.xmlid = current
 	return ret
 
-def OnRequestException(feedctl: FeedControl, config: dict, e: Exception) -> None:
+def OnRequestException(state: FeedState, feed: dict, config: dict, e: Exception) -> None:
 	"""
-		気象庁 XML の取得に何らかの理由により失敗した場合に呼び出される。
-		feedctl: FeedControl クラス。連続エラー回数を記録するために使用
-		config:  config.json からの設定情報
-		e:       発生した例外に関する情報
+		気象庁 XML フィードの取得に何らかの理由により失敗した場合に呼び出される。
+		state:  フィードの取得状況。連続エラー回数を記録するために使用
+		feed:   取得に失敗したフィードの設定（config.json の xmlfeed.feeds の要素）
+		config: config.json からの設定情報
+		e:      発生した例外に関する情報
 	"""
 	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
-	logger.warning("地震情報の取得に失敗しました")
+	logger.warning(f"地震情報（{feed['name']}）の取得に失敗しました")
 	logger.warning(e)
-	feedctl.reqerr_count += 1
+	state.reqerr_count += 1
 
-	if feedctl.reqerr_count % config["xmlfeed"]["request"]["error_count"] == 0:
-		logger.error(f"地震情報の取得に{feedctl.reqerr_count}回連続で失敗しました。ログを確認してください。")
+	if state.reqerr_count % config["xmlfeed"]["request"]["error_count"] == 0:
+		logger.error(f"地震情報（{feed['name']}）の取得に{state.reqerr_count}回連続で失敗しました。ログを確認してください。")
+
+def SaveErrorXML(response: requests.Response, config: dict) -> None:
+	"""
+		解析に失敗した XML をログの出力先に保存し、エラーログに記録する。
+		response: 解析に失敗した XML を受け取った応答
+		config:   config.json からの設定情報
+	"""
+	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+	tmstr = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+	fname = config["paths"]["log"]["dir"] + "/" + tmstr + "_err.txt"
+	logger.error(traceback.format_exc() + "\n\nXML saved as : " + fname)
+
+	with open(fname, "w", encoding=response.encoding) as f:
+		f.write(response.text)
 
 type EQPlotterSeries = EQPlotter_VXSE51 | EQPlotter_VXSE53
-type ValidEntry = Tuple[str, EntryData, EQPlotterSeries]
+type ValidEntry = Tuple[entryhandler.EntryHandler, EntryData, EQPlotterSeries]
 
-def ValidEntryGenerator(feedctl: FeedControl, entry_list: list[EntryData], config: dict) -> Iterator[ValidEntry]:
+def ValidEntryGenerator(feedctl: FeedControl, entry_list: list[EntryData], config: dict, queue: ReportQueue) -> Iterator[ValidEntry]:
+	"""
+		処理済み索引（FeedControl.seen）になく、待ち行列にも入っていないエントリのうち、
+		処理が登録されている（entryhandler）ものを古い順に返す。
+		待ち行列がいっぱい（max_pending 件）になったら、残りのエントリは解析せずに後回しにして（ReportQueue.Defer）終わる。
+		処理済みとしての記録は、投稿が済んだ時点で MarkDone により行う。
+		feedctl:    FeedControl クラス。処理済み索引を保持する
+		entry_list: XML フィードの各項目情報
+		config:     config.json からの設定情報
+		queue:      描画・投稿を待っている電文の待ち行列
+	"""
 	lsentry = sorted(entry_list, key=lambda x: x.updated_time)
-	last_time: datetime.datetime = None
 
-	for l in lsentry:
-		if l.updated_time <= feedctl.last_eq: continue
+	# 索引導入前の FeedControl から引き継いだ場合は、前回の最終地震時刻までを処理済みとみなす
+	feedctl.seen.Seed(lsentry, feedctl.last_eq)
+
+	for i, l in enumerate(lsentry):
+		if feedctl.seen.Contains(l) or queue.Contains(l.id): continue
+
+		handler = entryhandler.Find(l.id)
+		if handler is None: continue
+
+		if queue.IsFull():
+			queue.Defer(lsentry[i:])
+			return
+
+		yield (handler, l, handler.factory(config))
+
+def MarkDone(feedctl: FeedControl, entry: EntryData, content_hash: str = None) -> None:
+	"""
+		エントリを処理済みとして記録する。
+		feedctl: FeedControl クラス。処理済み索引を保持する
+		entry:   処理が済んだエントリ
+		content_hash: 電文の内容ハッシュ（解析済みの場合）。同じ電文が別の ID で再送されても処理済みと判別できる
+	"""
+	feedctl.seen.Add(entry, content_hash)
+	feedctl.last_eq = max(feedctl.last_eq, entry.updated_time)
+
+def FetchFeed(fetcher: JMAFetcher, feed: dict, state: FeedState, ns: dict, config: dict) -> list[EntryData]:
+	"""
+		XML フィードを 1 本取得し、更新があればその各項目情報を返す。更新がない、または取得に失敗した場合は空のリストを返す。
+		複数のフィードを並行して取得するため、スレッドプールから呼び出される。
+		fetcher: 気象庁 XML の取得を担当する JMAFetcher クラス
+		feed:   取得するフィードの設定（config.json の xmlfeed.feeds の要素）
+		state:  フィードの取得状況。取得により適宜更新されていく
+		ns:     XML 名前空間。XML からの情報取得に使用
+		config: config.json からの設定情報
+	"""
+	response = None
+	try:
+		# 最終更新時刻以降の情報を（あれば）返すよう HTTP ヘッダに記載する。
+		# 更新がない場合、HTTP 304 と共に長さ 0 のデータが返るので無駄なダウンロードを節約することができる。
+		header = { "If-Modified-Since": state.last_update.strftime("%a, %d %b %Y %H:%M:%S GMT") }
+		response = fetcher.Get(feed["address"], headers=header)
+
+		# 更新がない場合（HTTP 304）は読み飛ばす
+		if response.status_code != 200: return []
+
+		state.reqerr_count = 0
+		response.encoding = response.apparent_encoding
+		xml = ET.fromstring(response.text)
+
+		# XML フィードの最終更新時刻を更新する
+		# 時刻情報は JST で記載されているので UTC（GMT）に変換する。
+		updated = xml.find("atom:updated", ns)
+		dt = datetime.datetime.fromisoformat(updated.text)
+		state.last_update = dt.astimezone(datetime.timezone.utc)
+
+		if CheckId(xml, state, ns): return []
+		return GetEntryList(xml, ns)
+
+	except CircuitOpenError:
+		# 気象庁側の障害中とみなして要求を止めている間は、失敗として数えない
+		pass
+	except requests.exceptions.RequestException as e:
+		OnRequestException(state, feed, config, e)
+	except ET.ParseError:
+		SaveErrorXML(response, config)
+	return []
 
-		if   "VXSE51" in l.id:	# 震度速報
-			last_time = l.updated_time
-			yield ("震度速報", l, EQPlotter_VXSE51(config))
-		elif "VXSE53" in l.id:	# 震源・震度に関する情報
-			last_time = l.updated_time
-			yield ("地震情報", l, EQPlotter_VXSE53(config))
+def EnqueueNewReports(feedctl: FeedControl, ns: dict, config: dict, fetcher: JMAFetcher, queue: ReportQueue) -> int:
+	"""
+		設定された気象庁 XML フィード（xmlfeed.feeds）を並行して取得し、処理が登録されている電文を取得・解析して待ち行列に入れる。
+		前回までに待ち行列がいっぱいで後回しにしたエントリも、フィードの更新の有無にかかわらず改めて取り込む。
+		待ち行列に入れた電文の数を返す。
+		feedctl: FeedControl クラス。フィードの取得により適宜更新されていく
+		ns:      XML 名前空間。XML からの情報取得に使用
+		config:  config.json からの設定情報
+		fetcher: 気象庁 XML の取得を担当する JMAFetcher クラス
+		queue:   描画・投稿を待っている電文の待ち行列
+	"""
+	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
 
-	if last_time is not None: feedctl.last_eq = last_time
+	# 各フィードは同じ接続プールを使って並行して取得する
+	feeds = [f for f in config["xmlfeed"]["feeds"] if f.get("enabled", True)]
+	futures = [_fetcher.submit(FetchFeed, fetcher, f, feedctl.Feed(f["name"]), ns, config) for f in feeds]
+	lsentry = [e for fut in futures for e in fut.result()]
 
-def GetJMAXMLFeed_Eqvol(feedctl: FeedControl, ns: dict, config: dict) -> None:
+	feedctl.last_access = datetime.datetime.now(tz=datetime.timezone.utc)
+	feedctl.last_update = max([feedctl.Feed(f["name"]).last_update for f in feeds], default=feedctl.last_update)
+
+	# 高頻度フィードと長期フィードの両方に載っているエントリは 1 つにまとめる
+	lsentry = list({e.id: e for e in queue.TakeDeferred() + lsentry}.values())
+
+	count = 0
+	for handler, entry, plotter in ValidEntryGenerator(feedctl, lsentry, config, queue):
+		response = None
+		try:
+			response = fetcher.GetReport(entry.link)
+			response.encoding = response.apparent_encoding
+
+			plotter.ParseXML(response.text)
+
+			# 処理済みの電文が別の ID で再送された場合は、この ID も処理済みとして省く
+			content_hash = ContentHash(entry, plotter.report_key) if plotter.report_key else None
+			if content_hash is not None and feedctl.seen.Contains(entry, content_hash):
+				logger.info(f"処理済みの電文と同じ内容のため、省略しました：{handler.name}（{entry.id}）")
+				MarkDone(feedctl, entry)
+				continue
+
+			queue.Push(handler.name, entry, plotter, handler.code, content_hash)
+			count += 1
+
+		# 取得・解析に失敗した電文は処理済みにしないので、フィードが次に更新されたときに再び取得する
+		# 要求を止めている間は、まだ取得していない電文を後回しにして次のポーリングで取り込む
+		except CircuitOpenError:
+			queue.Defer([e for e in lsentry if not feedctl.seen.Contains(e) and not queue.Contains(e.id)])
+			break
+		except requests.exceptions.RequestException as e:
+			logger.warning("地震情報（電文）の取得に失敗しました")
+			logger.warning(e)
+		except ET.ParseError:
+			SaveErrorXML(response, config)
+
+	return count
+
+def RenderReport(feedctl: FeedControl, config: dict, meter: RenderMeter, item: PendingReport, output_dir: str | None = None) -> None:
 	"""
-		気象庁 XML フィードから地震火山情報を取得し、地震に関する情報を抜き出す。
-		抜き出したエントリは EQPlotter クラスに渡され震度地図を描画、返された地図をポストする。
+		解析済みの電文から震度地図を描画し、画像（item.image）と情報文（item.message）を用意する。
+		待機系（standby）では投稿せずに描画だけを済ませておき、主系に昇格したときにすぐ投稿できるようにする。
+		feedctl: FeedControl クラス。描画のメモリ使用量の要約を記録する
+		config:  config.json からの設定情報
+		meter:   描画ごとのメモリ使用量を計測する RenderMeter クラス
+		item:    描画する電文
+		output_dir: 画像の出力先のフォルダ。None の場合は paths.output（待機系は系ごとのフォルダに出力する）
+	"""
+	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+	plotter = item.plotter
+	item.plotter = None
+	plotter.output_dir = output_dir
+
+	# メモリ予算を超えそうな場合は出力画像を縮小する
+	plotter.out_size = meter.Plan(plotter.out_size)
+	meter.Start()
+
+	# 画像のエンコードは情報文の作成と並行して進める
+	item.image = plotter.DrawMap("3" if config["eqlevel"][plotter.max_int] >= 3 else "1")
+	if plotter.suppressed_stamps > 0:
+		logger.info(f"震度画像の重なりを整理し、{plotter.suppressed_stamps} 個の描画を省きました")
+	item.message = plotter.GetMessage()
+
+	# 描画のメモリ使用量は画像のエンコードが終わるまでを計測する
+	wait([item.image])
+	feedctl.last_render = meter.Stop(plotter, plotter.out_size).Summary()
+
+	# del しておくとメモリの消費を防げる（1 回の描画に 100 MB 近く使っちゃうので……）
+	# ガベージコレクションを強制実行することでさらにメモリ消費を抑える作戦
+	del plotter
+	collect()
+
+def PostReport(feedctl: FeedControl, config: dict, publisher: FanoutPublisher, meter: RenderMeter, lease: LeaderLease, item: PendingReport) -> bool:
+	"""
+		解析済みの電文から震度地図を描画し（待機系のうちに描画済みならそれを使い）、地図と情報文をポストする。
+		配信に回した場合は True を、主系でなくなったため取りやめた場合は False を返す。
+		feedctl: FeedControl クラス。処理済み索引を保持する
+		config:  config.json からの設定情報
+		publisher: X などの配信先への配信を担当する FanoutPublisher クラス
+		meter:   描画ごとのメモリ使用量を計測する RenderMeter クラス
+		lease:   主系の権利（リース）を管理する LeaderLease クラス
+		item:    待ち行列から取り出した電文
+	"""
+	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+	name, entry = item.name, item.entry
+
+	if item.image is None:
+		RenderReport(feedctl, config, meter, item)
+	
+	# 更新（発表）時刻は UTC なので JST(+9h) に直す
+	updated_tmz = entry.updated_time.astimezone(datetime.timezone(datetime.timedelta(hours=9)))
+	post_fmt = "【" + name + updated_tmz.strftime(" %Y-%m-%d %H:%M ") + "気象庁発表】{}"
+
+	# 配信より先に処理済みとして共有の FeedControl に保存する。ここで主系でなくなっていれば配信しない
+	# （保存後・配信前に停止した場合はその電文を投稿しそびれるが、複数の系から二重に投稿することはない）
+	MarkDone(feedctl, entry, item.content_hash)
+	feedctl.last_msg = post_fmt.format(item.message)
+	if not lease.Save(feedctl):
+		logger.warning(f"主系ではなくなったため、投稿を取りやめました：{name}（{entry.id}）")
+		return False
+
+	# ログに地震情報を記録、同時に各配信先へ配信（配信は配信先ごとのスレッドで進む）
+	logger.info("地震情報：\n" + post_fmt.format(item.message))
+	pub = publisher.Begin(item.image, entry.id, item.code)
+	publisher.Publish(pub, post_fmt.format(item.message), post.Adjust_PostLen(post_fmt, item.message, config["post"]["cut_at_line"]))
+	return True
+
+def GetJMAXMLFeeds(feedctl: FeedControl, ns: dict, config: dict, fetcher: JMAFetcher, publisher: FanoutPublisher, meter: RenderMeter, queue: ReportQueue, lease: LeaderLease) -> None:
+	"""
+		気象庁 XML フィードから地震に関する電文を取得して待ち行列に入れ、優先度の高いものから震度地図を描画・ポストする。
+		待ち行列が空になるまでの間も recheck_sec 秒おきにフィードを確認し、後から発表された強い揺れの情報を先に処理する。
+		待機系（主系の権利を持たない場合）は取得・描画までを行い、投稿しない。
 		I-Maplot の中枢を担う部分。
 		feedctl: FeedControl クラス。フィードの取得により適宜更新されていく
 		ns:      XML 名前空間。XML からの情報取得に使用
 		config:  config.json からの設定情報
+		fetcher: 気象庁 XML の取得を担当する JMAFetcher クラス
+		publisher: X などの配信先への配信を担当する FanoutPublisher クラス
+		meter:   描画ごとのメモリ使用量を計測する RenderMeter クラス
+		queue:   描画・投稿を待っている電文の待ち行列
+		lease:   主系の権利（リース）を管理する LeaderLease クラス
 	"""
 	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
 	try:
-		# 最終更新時刻以降の情報を（あれば）返すよう HTTP ヘッダに記載する。
-		# 更新がない場合、HTTP 304 と共に長さ 0 のデータが返るので無駄なダウンロードを節約することができる。
-		header = { "If-Modified-Since": feedctl.last_update.strftime("%a, %d %b %Y %H:%M:%S GMT") }
-		response = requests.get(config["xmlfeed"]["request"]["address"], headers=header)
-		response.raise_for_status()
-		feedctl.last_access = datetime.datetime.now(tz=datetime.timezone.utc)
+		# 他の系（主系）が処理済みとした電文を取り込む
+		lease.Load(feedctl)
 
-		# 更新がない場合（HTTP 304）は読み飛ばす
-		if response.status_code == 200:
-			feedctl.reqerr_count = 0
-			response.encoding = response.apparent_encoding
-			xml = ET.fromstring(response.text)
-
-			# XML フィードの最終更新時刻を更新する
-			# 時刻情報は JST で記載されているので UTC（GMT）に変換する。
-			updated = xml.find("atom:updated", ns)
-			dt = datetime.datetime.fromisoformat(updated.text)
-			feedctl.last_update = dt.astimezone(datetime.timezone.utc)
-			
-			if CheckId(xml, feedctl, ns) is not True:
-				# 「震度に関する情報」と「震源・震度に関する情報」を抜き出す
-				# 「震源に関する情報」は、直後に震度と一緒に情報が再送されるため無視する
-				for name, entry, plotter in ValidEntryGenerator(feedctl, GetEntryList(xml, ns), config):
-					response = requests.get(entry.link)
-					response.encoding = response.apparent_encoding
-					response.raise_for_status()
-
-					plotter.ParseXML(response.text)
-
-					imgpath = plotter.DrawMap("3" if config["eqlevel"][plotter.max_int] >= 3 else "1")
-					message = plotter.GetMessage()
-					
-					# 更新（発表）時刻は UTC なので JST(+9h) に直す
-					updated_tmz = entry.updated_time.astimezone(datetime.timezone(datetime.timedelta(hours=9)))
-					post_fmt = "【" + name + updated_tmz.strftime(" %Y-%m-%d %H:%M ") + "気象庁発表】{}"
-					
-					# ログに地震情報を記録、同時に X へポスト
-					feedctl.last_msg = post_fmt.format(message)
-					logger.info("地震情報：\n" + post_fmt.format(message))
-					message = post.Adjust_PostLen(post_fmt, message)
-					post.Post(config["postauth"], message, imgpath)
-					# del しておくとメモリの消費を防げる（1 回の描画に 100 MB 近く使っちゃうので……）
-					# ガベージコレクションを強制実行することでさらにメモリ消費を抑える作戦
-					del plotter
-					collect()
-				
-				return
-		# 更新情報なし / XML ID に変更なし / 地震情報エントリに更新なし の場合はここにくる
-		logger.debug("地震情報：新しい地震の情報はありません")
-
-	except (requests.exceptions.ConnectionError, requests.exceptions.RequestException) as e:
-		OnRequestException(feedctl, config, e)
+		if not lease.IsLeader():
+			# 待機系：取得と描画だけを済ませておく。主系が処理済みとした電文は待ち行列から除く
+			EnqueueNewReports(feedctl, ns, config, fetcher, queue)
+			queue.Discard(lambda r: feedctl.seen.Contains(r.entry, r.content_hash))
+			for item in queue.Unrendered():
+				RenderReport(feedctl, config, meter, item, lease.StandbyOutput(config["paths"]["output"]))
+			return
 
-	except ET.ParseError:
-		tmstr = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-		fname = config["paths"]["log"]["dir"] + "/" + tmstr + "_err.txt"
-		logger.error(traceback.format_exc() + "\n\nXML saved as : " + fname)
+		# 前回までに X への投稿に失敗したものがあれば再試行する
+		publisher.RetryPending()
+
+		EnqueueNewReports(feedctl, ns, config, fetcher, queue)
+		queue.Discard(lambda r: feedctl.seen.Contains(r.entry, r.content_hash))
+		last_check = time.monotonic()
+
+		count = 0
+		while True:
+			item = queue.Pop()
+			if item is None:
+				# 待ち行列がいっぱいで後回しにしたエントリがあれば取り込んで続ける（取り込めなければ次のポーリングに回す）
+				if not queue.HasDeferred() or EnqueueNewReports(feedctl, ns, config, fetcher, queue) == 0: break
+				last_check = time.monotonic()
+				continue
+
+			# 1 件の描画・投稿に失敗しても、残りの電文の処理は続ける
+			# 失敗した電文は取り出した時点で解析結果を手放しているので、何度も失敗し続けないよう処理済みとする
+			try:
+				published = PostReport(feedctl, config, publisher, meter, lease, item)
+			except Exception:
+				logger.error(f"描画・投稿に失敗したため、処理済みとしました：{item.name}（{item.entry.id}）\n" + traceback.format_exc())
+				MarkDone(feedctl, item.entry, item.content_hash)
+				published = False
+			count += 1
+
+			# 同じ地震の新しい報に置き換えられた電文は、新しい報を配信に回してから処理済みとする
+			# 新しい報を配信できなかった場合は待ち行列に戻し、代わりに投稿する
+			if published:
+				for r in item.superseded:
+					logger.info(f"同じ地震の新しい電文があるため、描画・投稿を省略しました：{r.name}（{r.entry.updated_time.isoformat()}, {r.entry.id}）")
+					MarkDone(feedctl, r.entry, r.content_hash)
+			elif lease.IsLeader():
+				queue.Restore(item.superseded)
+
+			if len(queue) > 0 and time.monotonic() - last_check >= queue.recheck_sec:
+				EnqueueNewReports(feedctl, ns, config, fetcher, queue)
+				last_check = time.monotonic()
+
+		# 更新情報なし / XML ID に変更なし / 地震情報エントリに更新なし の場合
+		if count == 0:
+			logger.debug("地震情報：新しい地震の情報はありません")
 
-		with open(fname, "w", encoding=response.encoding) as f:
-			f.write(response.text)
-		
 	except Exception:
 		# これの呼び出し元（Scheduler.caller_）でも例外は補足しているのでなくても良い
 		logger.error(traceback.format_exc())
 	finally:
-		feedctl.PickleMyself()
+		lease.Save(feedctl)
+
+def WarmUp(config: dict) -> None:
+	"""
+		描画・投稿に使う重いモジュールと地図データを先に読み込んでおく。
+		起動を遅らせないよう、初回ポーリングの後に別スレッドで呼び出す。
+		config: config.json からの設定情報
+	"""
+	logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+	try:
+		start = time.perf_counter()
+
+		import report
+		import mapdata
+		import raster
+		post.WarmUp()
+		mapdata.LoadAssistant(config["paths"]["assistant_npz"])
+		if config["render"]["engine"] != "matplotlib":
+			raster.LoadRenderer(config)
+
+		logger.info(f"描画・投稿モジュールの事前読み込み完了（{(time.perf_counter() - start) * 1000:.0f} ms）")
+	except Exception:
+		logger.error(traceback.format_exc())
+
+def ReloadConfig(reloader: ConfigReloader, config: dict) -> str:
+	"""
+		config.json を読み直して反映し、結果の説明を返す。reload コマンド、SIGHUP から呼び出す。
+		反映できた場合は、新しい設定で使う地図データを裏で読み込んでおく（読み込み済みのものはそのまま使う）。
+		reloader: ConfigReloader クラス
+		config:   稼働中の設定情報
+	"""
+	ok, msg = reloader.Reload()
+	if ok:
+		threading.Thread(target=WarmUp, args=(config,), name="WarmUp", daemon=True).start()
+	return msg
+
+def AnswerReload(conn: socket, code: int, reloader: ConfigReloader, config: dict, sockinfo: dict) -> None:
+	"""
+		reload コマンドを受けて設定を読み直し、結果を送り返す。
+		反映は実行中のポーリングの完了を待つので、受け付けのループ（alive, exit）を止めないよう別スレッドで呼び出す。
+		conn:     reload.py との接続
+		code:     メッセージ種別
+		reloader: ConfigReloader クラス
+		config:   稼働中の設定情報
+		sockinfo: 起動時の sockinfo（再起動するまで変わらない）
+	"""
+	try:
+		msg = ReloadConfig(reloader, config)
+		bmsg = msg.encode(sockinfo["charset"])
+		conn.send(struct.pack("b" + str(len(bmsg)) + "s", code, bmsg))
+	except OSError:
+		# reload.py が応答を待たずに終了していても、反映の結果はログに残っている
+		pass
+	finally:
+		conn.close()
+
+def LogStartupReport(logger: log.Logger, marks: list[tuple[str, float]]) -> None:
+	"""
+		起動から初回ポーリング完了までの各段階の所要時間をログに記録する。
+		logger: ロガー
+		marks:  (段階名, その段階が終わった時刻（time.perf_counter）) のリスト
+	"""
+	lines = []
+	prev = T_LAUNCH
+	for name, t in marks:
+		lines.append(f"  {name}: {(t - prev) * 1000:.0f} ms")
+		prev = t
+
+	logger.info(f"起動時間：初回ポーリング完了まで {(prev - T_LAUNCH) * 1000:.0f} ms\n" + "\n".join(lines))
 
 def SendMail_SystemStop(mhd: log.MailHandler) -> None:
 	"""
 		システム終了時にメールを送信する。
 		mhd: メールによるロギング ハンドラー
 	"""
+	# 送信待ちのエラーログを先に送り切っておく
+	mhd.Flush()
 
 	mhd.send(
 		f"{datetime.datetime.now()}\n" +\
@@ -211,6 +503,7 @@ def main(mhd: log.MailHandler, config_path: str, conf_enctype: str = "utf-8"):
 		log.set_logger(INFO, mhd, conf)
 		logger = log.getLogger("{}.{}".format(conf["app_name"], __name__))
 		logger.info("JMAEQ I-Maplot システム開始")
+		marks = [("モジュール読み込み・設定", time.perf_counter())]
 
 		interval_sec: int = conf["interval_sec"]
 		feedctl_path: str = conf["paths"]["feedctl"]
@@ -222,17 +515,33 @@ def main(mhd: log.MailHandler, config_path: str, conf_enctype: str = "utf-8"):
 		codeinfo: dict = sockinfo["code"]
 		addrinfo: dict = sockinfo["address"]["accept"]
 
+		# 主系の権利（リース）の管理。複数の系を動かす場合は FeedControl を系の間で共有する
+		lease = LeaderLease(conf)
+
 		# FeedControl の読み込み
 		try:
-			with open(feedctl_path, "rb") as f:
+			with lease.Locked(), open(feedctl_path, "rb") as f:
 				feedctl = pickle.load(f)
 				feedctl.pkl_path = feedctl_path
 		except FileNotFoundError:
 			logger.warning("FeedControl が見つかりませんでした。作成します。")
 			feedctl = FeedControl(feedctl_path)
+
+		# 処理済み索引の保持件数・保持期間を設定に合わせる
+		seeninfo: dict = conf["xmlfeed"]["seen_index"]
+		feedctl.seen.max_entries = seeninfo["max_entries"]
+		feedctl.seen.max_age_sec = seeninfo["max_age_sec"]
+		feedctl.seen.Evict()
+
+		# 待ち行列は保存しないので、前回処理しきれなかった電文を拾えるよう起動時はフィードを取り直す
+		# 処理済みのエントリは処理済み索引により除かれる
+		for state in feedctl.feeds.values():
+			state.xmlid = ""
+			state.last_update = FeedState.last_update
 		
 		# システム開始時刻を記録
 		feedctl.system_start = datetime.datetime.now(tz=datetime.timezone.utc)
+		marks.append(("FeedControl 読み込み", time.perf_counter()))
 
 		# 画像出力先の存在確認（存在しない場合は作成）
 		if not os.path.isdir(output_path):
@@ -248,15 +557,53 @@ def main(mhd: log.MailHandler, config_path: str, conf_enctype: str = "utf-8"):
 		sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
 		sock.bind((addrinfo["host"], addrinfo["port"]))
 		sock.listen()
-
-		# interval_sec 秒おきに GetJMAXMLFeed_Eqvol 関数を実行
+		marks.append(("ソケット準備", time.perf_counter()))
+
+		# 気象庁 XML の取得担当。接続を使い回し、タイムアウト・サーキットブレーカを適用する
+		fetcher = JMAFetcher(conf)
+		# X・Webhook・共有ディレクトリ・まとめメールへの配信担当。配信先ごとのスレッドで並行して配信する
+		publisher = FanoutPublisher(conf)
+		# 描画ごとのメモリ使用量の計測・メモリ予算の管理
+		meter = RenderMeter(conf)
+		# 描画・投稿を待っている電文の待ち行列
+		queue = ReportQueue(conf)
+
+		# 初回ポーリングの前に、主系になれるかを確かめておく
+		if not lease.Renew():
+			logger.info(f"待機系として起動します（{lease.instance}）")
+
+		# interval_sec 秒おきに GetJMAXMLFeeds 関数を実行
 		sched = Scheduler(
 			interval_sec,
-			GetJMAXMLFeed_Eqvol,
+			GetJMAXMLFeeds,
 			conf,
-			(feedctl, ns, conf)	# 実行する関数に渡す引数のリスト
+			(feedctl, ns, conf, fetcher, publisher, meter, queue, lease)	# 実行する関数に渡す引数のリスト
 		)
 		sched.start()
+		marks.append(("初回ポーリング", time.perf_counter()))
+
+		# WebSub の更新通知を受けたら、次の定期取得を待たずに直ちに取得する
+		subscriber = None
+		if conf["websub"]["enabled"]:
+			subscriber = PushSubscriber(conf, sched.trigger)
+			subscriber.Start()
+
+		# リースを定期的に延長する。待機系から主系になったら、次の定期実行を待たずに取得・投稿する
+		lease.Start(sched.trigger)
+
+		# reload コマンド・SIGHUP で、再起動せずに config.json を読み直す
+		reloader = ConfigReloader(config_path, conf_enctype, conf, ns, mhd, sched, {
+			"feedctl": feedctl, "fetcher": fetcher, "publisher": publisher, "meter": meter,
+			"queue": queue, "lease": lease, "subscriber": subscriber
+		})
+		if hasattr(signal, "SIGHUP"):
+			signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+				target=ReloadConfig, args=(reloader, conf), name="ConfigReload", daemon=True
+			).start())
+		LogStartupReport(logger, marks)
+
+		# 初回ポーリングが終わってから、描画・投稿に必要なものを裏で読み込んでおく
+		threading.Thread(target=WarmUp, args=(conf,), name="WarmUp", daemon=True).start()
 
 		while True:
 			try:
@@ -277,6 +624,9 @@ def main(mhd: log.MailHandler, config_path: str, conf_enctype: str = "utf-8"):
 							"Last access: " + feedctl.last_access.isoformat() + "\n" +\
 							"Last update: " + feedctl.last_update.isoformat() + "\n" +\
 							"Last Earthquake: " + feedctl.last_eq.isoformat() + "\n" +\
+							"Last render: " + (feedctl.last_render or "-") + "\n" +\
+							"Delivery: " + publisher.LatencySummary() + "\n" +\
+							"Role: " + lease.Role() + "\n" +\
 							feedctl.last_msg
 					bmsg = msg.encode(sockinfo["charset"])
 					data = struct.pack("b" + str(len(bmsg)) + "s", code, bmsg)
@@ -284,6 +634,12 @@ def main(mhd: log.MailHandler, config_path: str, conf_enctype: str = "utf-8"):
 					conn.send(data)
 					conn.close()
 
+				# reload -> 設定を読み直し、結果を送り返す（別スレッドで行い、その間も alive, exit を受け付ける）
+				elif code == codeinfo["reload"]:
+					threading.Thread(
+						target=AnswerReload, args=(conn, code, reloader, conf, sockinfo), name="ConfigReload", daemon=True
+					).start()
+
 				# exit -> プログラム終了
 				elif code == codeinfo["exit"]:
 					if len(msg) > 0:
@@ -303,8 +659,13 @@ def main(mhd: log.MailHandler, config_path: str, conf_enctype: str = "utf-8"):
 			except Exception:
 				logger.error(traceback.format_exc())
 
+		if subscriber is not None: subscriber.Stop()
 		sched.stop()
-		feedctl.PickleMyself()
+		publisher.Close()
+		meter.Close()
+		fetcher.Close()
+		lease.Save(feedctl)
+		lease.Stop()
 	except Exception:
 		logger.error(traceback.format_exc())
 	else:
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# makemap.py が作成した地図データの読み込み
+# 実行時に pandas / geopandas / shapely を読み込まずに済むよう、numpy の配列だけで扱う
+
+import os
+import cv2
+import threading
+import numpy as np
+
+### class AssistantData BEGIN ###
+
+class AssistantData:
+	"""
+		地図描画補助情報（細分区域ごとの名前、地方名、重心、範囲）。
+		makemap.py が書き出す列指向の .npz ファイルから読み込む。
+	"""
+	def __init__(self, path: str) -> None:
+		with np.load(path, allow_pickle=False) as npz:
+			self.name: np.ndarray		= npz["name"]		# (N,)   区域名
+			self.region: np.ndarray		= npz["region"]		# (N,)   地方名
+			self.centroid: np.ndarray	= npz["centroid"]	# (N, 2) 重心の経度・緯度
+			self.bounds: np.ndarray		= npz["bounds"]		# (N, 4) min_x, min_y, max_x, max_y
+
+	def Select(self, names: list[str]) -> np.ndarray:
+		"""
+			names に含まれる区域の番号を、ファイル内の並び順で返す。
+			names: 区域名のリスト
+		"""
+		return np.flatnonzero(np.isin(self.name, names))
+
+### class AssistantData END ###
+
+
+### class CityIndex BEGIN ###
+
+class CityIndex:
+	"""
+		市町村役場の位置の索引（行政区域コード -> 経度・緯度）。
+		国土数値情報（市町村役場等及び公的集会施設データ, P34）から makemap.py が作成する。
+	"""
+	code_len: int = 5	# 行政区域コードの桁数。気象庁の市町村等コード（7 桁）の上 5 桁がこれにあたる
+
+	def __init__(self, path: str) -> None:
+		with np.load(path, allow_pickle=False) as npz:
+			self.code: np.ndarray	= npz["code"]	# (N,)   行政区域コード（昇順）
+			self.lonlat: np.ndarray	= npz["lonlat"]	# (N, 2) 役場の経度・緯度
+
+	def Lookup(self, codes: list[str]) -> tuple[np.ndarray, np.ndarray]:
+		"""
+			市町村等コードのリストに対応する経度・緯度を一括で求める。
+			((N, 2) の経度・緯度, 索引に見つかったかどうかの (N,) の真偽値) のタプルを返す。
+			codes: 気象庁の市町村等コードのリスト
+		"""
+		keys = np.array([c[:self.code_len] for c in codes], dtype=self.code.dtype)
+		if len(keys) == 0 or len(self.code) == 0:
+			return (np.empty((0, 2)), np.zeros(len(keys), dtype=bool))
+
+		pos = np.minimum(np.searchsorted(self.code, keys), len(self.code) - 1)
+		found = self.code[pos] == keys
+		return (self.lonlat[pos], found)
+
+### class CityIndex END ###
+
+
+### class LabelRaster BEGIN ###
+
+class LabelRaster:
+	"""
+		細分区域の番号を画素値に持つラスタ（0 は海などの区域外、i + 1 は AssistantData の i 番目の区域）。
+		経度・緯度の等間隔格子で、makemap.py が作成する。
+		区域のポリゴン（area_*）も含まれている場合は、格子を使わずに出力画像の範囲・大きさで直接ラスタ化する。
+	"""
+	shift_bits: int = 4	# cv2.fillPoly の固定小数点の桁数
+
+	def __init__(self, path: str) -> None:
+		with np.load(path, allow_pickle=False) as npz:
+			self.labels: np.ndarray	= npz["labels"]			# (H, W) uint16。先頭行が北端
+			self.bounds: np.ndarray	= npz["bounds"]			# 格子全体の min_x, min_y, max_x, max_y
+			self.deg_per_px: float	= float(npz["deg_per_px"])	# 1 画素あたりの度数
+
+			# 区域のポリゴン（raster.PolygonLayer と同じ形式。owner はポリゴン -> 区域の番号）。古いファイルにはない
+			self.polygons: dict[str, np.ndarray] | None = None
+			if "area_coords" in npz.files:
+				self.polygons = { k: npz[f"area_{k}"] for k in ("coords", "rings", "polys", "bbox", "owner") }
+
+	def Sample(self, bound: list, width: int, height: int) -> np.ndarray:
+		"""
+			描画範囲に合わせて区域番号を取り出す。(height, width) の配列を返す。
+			ポリゴンがあれば出力画像の大きさでラスタ化し、なければ格子から最近傍で取り出す。
+			bound: 描画範囲 [min_x, min_y, max_x, max_y]（経度・緯度）
+			width / height: 出力画像の大きさ [px]
+		"""
+		if self.polygons is not None: return self.__Rasterize(bound, width, height)
+
+		# 出力画素の中心の経度・緯度 -> 格子の行・列
+		lon = bound[0] + (np.arange(width) + 0.5) * (bound[2] - bound[0]) / width
+		lat = bound[3] - (np.arange(height) + 0.5) * (bound[3] - bound[1]) / height
+		cols = np.floor((lon - self.bounds[0]) / self.deg_per_px).astype(np.intp)
+		rows = np.floor((self.bounds[3] - lat) / self.deg_per_px).astype(np.intp)
+
+		h, w = self.labels.shape
+		vcols = (cols >= 0) & (cols < w)
+		vrows = (rows >= 0) & (rows < h)
+
+		out = np.zeros((height, width), dtype=self.labels.dtype)
+		out[np.ix_(vrows, vcols)] = self.labels[np.ix_(rows[vrows], cols[vcols])]
+		return out
+
+	def __Rasterize(self, bound: list, width: int, height: int) -> np.ndarray:
+		""" 描画範囲にかかる区域のポリゴンを、出力画像の画素格子にそのまま塗る。 """
+		out = np.zeros((height, width), dtype=np.uint16)
+		p = self.polygons
+		bbox = p["bbox"]
+		visible = np.flatnonzero(
+			(bbox[:, 0] <= bound[2]) & (bbox[:, 2] >= bound[0]) &
+			(bbox[:, 1] <= bound[3]) & (bbox[:, 3] >= bound[1])
+		)
+		if len(visible) == 0: return out
+
+		# 経度・緯度 -> 固定小数点のピクセル座標（ベース地図の描画と同じ変換）
+		scale = 1 << self.shift_bits
+		px_per_deg = (width / (bound[2] - bound[0]), height / (bound[3] - bound[1]))
+		pts = np.empty(p["coords"].shape, dtype=np.int32)
+		pts[:, 0] = np.rint((p["coords"][:, 0] - bound[0]) * px_per_deg[0] * scale)
+		pts[:, 1] = np.rint((bound[3] - p["coords"][:, 1]) * px_per_deg[1] * scale)
+
+		rings, polys = p["rings"], p["polys"]
+		for j in visible:
+			poly = [pts[rings[r]:rings[r + 1]] for r in range(polys[j], polys[j + 1])]
+			cv2.fillPoly(out, poly, int(p["owner"][j]) + 1, lineType=cv2.LINE_8, shift=self.shift_bits)
+		return out
+
+### class LabelRaster END ###
+
+
+_cache: dict = {}
+_cache_lock = threading.Lock()
+
+def LoadCached(cls: type, path: str):
+	"""
+		地図データを読み込む。一度読み込んだものはファイルが更新されるまで使い回す。
+		cls:  読み込みに使うクラス（コンストラクタにパスを受け取る）
+		path: ファイルパス
+	"""
+	mtime = os.path.getmtime(path)
+
+	with _cache_lock:
+		key = (cls.__name__, os.path.abspath(path))
+		cached = _cache.get(key)
+
+		if cached is None or cached[0] != mtime:
+			cached = (mtime, cls(path))
+			_cache[key] = cached
+		return cached[1]
+
+def RetainCached(paths: list[str]) -> int:
+	"""
+		読み込み済みの地図データのうち、paths に含まれないファイルのものを破棄する。破棄した数を返す。
+		設定の再読み込みで使わなくなった地図データを解放するのに使う（使い続けるものはそのまま残す）。
+		paths: 使い続けるファイルパス
+	"""
+	keep = { os.path.abspath(p) for p in paths }
+	with _cache_lock:
+		drop = [k for k in _cache if k[1] not in keep]
+		for k in drop:
+			del _cache[k]
+	return len(drop)
+
+def LoadAssistant(path: str) -> AssistantData:
+	""" 地図描画補助情報を読み込む。 """
+	return LoadCached(AssistantData, path)
+
+def LoadCityIndex(path: str) -> CityIndex:
+	""" 市町村役場の位置の索引を読み込む。 """
+	return LoadCached(CityIndex, path)
+
+def LoadLabelRaster(path: str) -> LabelRaster:
+	""" 細分区域の番号のラスタを読み込む。 """
+	return LoadCached(LabelRaster, path)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# 描画 1 回ごとのメモリ使用量の計測と、メモリ予算に応じた出力の大きさの調整
+
+import os
+import threading
+import tracemalloc
+import dataclasses
+
+import log
+
+### class RenderMemoryStat BEGIN ###
+
+@dataclasses.dataclass
+class RenderMemoryStat:
+	""" 描画 1 回分のメモリの計測結果。計測できなかった値は None """
+	out_size: tuple[int, int]		# 実際に描画した出力画像の大きさ (幅, 高さ)
+	rss_before: int | None			# 描画前の RSS [byte]
+	rss_after: int | None			# 描画後の RSS [byte]
+	peak_growth: int | None			# 描画中に増えたメモリの最大値の推定 [byte]
+	largest_array: int				# EQPlotter が保持していた最大の NumPy 配列 [byte]
+	traced_peak: int | None = None	# tracemalloc による確保量の最大値 [byte]
+	top: list[str] = dataclasses.field(default_factory=list)	# tracemalloc による確保量の多い箇所
+
+	def Summary(self) -> str:
+		""" ログ・状態表示用の 1 行の要約 """
+		mb = lambda b: "-" if b is None else f"{b / 2**20:.1f} MB"
+		s = f"{self.out_size[0]}x{self.out_size[1]}, RSS {mb(self.rss_before)} -> {mb(self.rss_after)}" +\
+			f", 増加（最大） {mb(self.peak_growth)}, 最大配列 {mb(self.largest_array)}"
+		if self.traced_peak is not None:
+			s += f", tracemalloc 最大 {mb(self.traced_peak)}"
+		return s
+
+### class RenderMemoryStat END ###
+
+### class RenderMeter BEGIN ###
+
+class RenderMeter:
+	"""
+		描画（DrawMap から投稿まで）1 回ごとのメモリ使用量を計測する。
+		RSS の増加量から出力画像 1 px あたりのメモリ量を学習しておき、
+		次の描画がメモリ予算（render.memory.budget_mb）を超えそうな場合は出力画像を縮小して描画させる。
+		描画中の RSS の最大値は、Linux では描画の直前に最大値（VmHWM）を初期化して描画後に読み取る。
+		初期化できない環境では、描画中に別スレッドで RSS を一定間隔で読み取ってその最大値を使う。
+		tracemalloc による詳細な計測（render.memory.instrument）は負荷がかかるので、必要な場合のみ有効にする。
+		設定の再読み込みで無効にした場合は、このクラスが開始した tracemalloc をその時点で止める。
+	"""
+	# 学習前に用いる 1 px あたりのメモリ量 [byte]（BGR のベース地図、重ね合わせ用の作業領域、エンコード結果の分）
+	default_bytes_per_px: float = 16.0
+
+	def __init__(self, config: dict) -> None:
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		self.__tracing: bool = False	# このクラスが tracemalloc を開始したか
+		self.LoadConfig(config)
+
+		self.bytes_per_px: float = self.default_bytes_per_px
+		self.last: RenderMemoryStat | None = None
+		self.__before: int | None = None
+		self.__hwm: bool = False					# 描画中の最大値を VmHWM で求めるか
+		self.__sampler: RSSSampler | None = None	# VmHWM を使えない場合に RSS を読み取るスレッド
+
+	def LoadConfig(self, config: dict) -> None:
+		meminfo: dict = config["render"]["memory"]
+		self.instrument: bool	= meminfo["instrument"]
+		self.budget_mb: float	= meminfo["budget_mb"]
+		self.min_scale: float	= meminfo["min_scale"]
+		self.top_n: int			= meminfo["top"]
+
+		# 詳細な計測をやめた場合は、メモリ確保のたびにかかる負荷をなくすため tracemalloc を止める
+		if not self.instrument: self.__StopTracing()
+
+	def Plan(self, out_size: tuple[int, int]) -> tuple[int, int]:
+		"""
+			メモリ予算に収まる出力画像の大きさを返す。予算がない、または収まる場合は out_size をそのまま返す。
+			out_size: 設定上の出力画像の大きさ (幅, 高さ)
+		"""
+		rss = CurrentRSS()
+		if self.budget_mb <= 0 or rss is None: return out_size
+
+		w, h = out_size
+		need = self.bytes_per_px * w * h
+		available = self.budget_mb * 2**20 - rss
+		if need <= available: return out_size
+
+		# 面積がメモリ量に比例するとして縮小率を決める
+		scale = max(self.min_scale, (max(available, 0) / need) ** 0.5)
+		size = (max(1, round(w * scale)), max(1, round(h * scale)))
+		self.logger.warning(
+			f"描画のメモリ使用量が予算（{self.budget_mb} MB）を超える見込みのため、出力画像を {size[0]}x{size[1]} に縮小します" +\
+			f"（RSS {rss / 2**20:.1f} MB, 見込み {need / 2**20:.1f} MB）"
+		)
+		return size
+
+	def Start(self) -> None:
+		""" 計測を開始する。描画の直前に呼び出す。 """
+		self.__before = CurrentRSS()
+		self.__hwm = ResetPeakRSS()
+		if not self.__hwm and self.__before is not None:
+			self.__sampler = RSSSampler()
+			self.__sampler.start()
+
+		if self.instrument:
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+				self.__tracing = True
+			tracemalloc.reset_peak()
+
+	def Stop(self, plotter, out_size: tuple[int, int]) -> RenderMemoryStat:
+		"""
+			計測を終了して結果を記録する。投稿（画像のエンコード・アップロード）が済んだ後、EQPlotter を破棄する前に呼び出す。
+			plotter:  描画に使った EQPlotter
+			out_size: 描画した出力画像の大きさ
+		"""
+		after = CurrentRSS()
+
+		# 描画中の RSS の最大値
+		peak = after
+		if self.__hwm:
+			peak = PeakRSS() or after
+		elif self.__sampler is not None:
+			self.__sampler.Stop()
+			peak = max(self.__sampler.peak, after or 0)
+			self.__sampler = None
+		growth = None if peak is None or self.__before is None else max(peak - self.__before, 0)
+
+		stat = RenderMemoryStat(out_size, self.__before, after, growth, LargestArray(plotter))
+
+		if self.instrument and tracemalloc.is_tracing():
+			stat.traced_peak = tracemalloc.get_traced_memory()[1]
+			snapshot = tracemalloc.take_snapshot()
+			stat.top = [str(s) for s in snapshot.statistics("lineno")[:self.top_n]]
+			if growth is None: growth = stat.traced_peak
+
+		# 1 px あたりのメモリ量を学習する。見積もりが小さすぎると予算を超えるので、大きい方を保つ
+		if growth is not None and growth > 0:
+			observed = growth / (out_size[0] * out_size[1])
+			self.bytes_per_px = max(observed, 0.8 * self.bytes_per_px + 0.2 * observed)
+
+		self.last = stat
+		self.logger.info("描画メモリ：" + stat.Summary() + "".join("\n  " + t for t in stat.top))
+		return stat
+
+	def Close(self) -> None:
+		self.__StopTracing()
+
+	def __StopTracing(self) -> None:
+		if self.__tracing and tracemalloc.is_tracing(): tracemalloc.stop()
+		self.__tracing = False
+
+### class RenderMeter END ###
+
+
+def CurrentRSS() -> int | None:
+	""" 現在の RSS [byte]。取得できない環境では None """
+	try:
+		with open("/proc/self/statm", "r") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError, AttributeError):
+		return None
+
+def ResetPeakRSS() -> bool:
+	"""
+		RSS の最大値（/proc/self/status の VmHWM）を現在の RSS に戻す（Linux 4.0 以降）。戻せた場合は True を返す。
+	"""
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+		return PeakRSS() is not None
+	except OSError:
+		return False
+
+def PeakRSS() -> int | None:
+	""" RSS の最大値（VmHWM）[byte]。取得できない環境では None """
+	try:
+		with open("/proc/self/status", "r") as f:
+			for line in f:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError):
+		pass
+	return None
+
+### class RSSSampler BEGIN ###
+
+class RSSSampler(threading.Thread):
+	""" 停止するまで interval_sec 秒おきに RSS を読み取り、その最大値（peak）を保持する。 """
+	def __init__(self, interval_sec: float = 0.01) -> None:
+		super().__init__(name="RSSSampler", daemon=True)
+		self.interval_sec: float = interval_sec
+		self.peak: int = CurrentRSS() or 0
+		self.__stop = threading.Event()
+
+	def run(self) -> None:
+		while not self.__stop.wait(self.interval_sec):
+			self.peak = max(self.peak, CurrentRSS() or 0)
+
+	def Stop(self) -> None:
+		self.__stop.set()
+		self.join()
+
+### class RSSSampler END ###
+
+def LargestArray(obj) -> int:
+	"""
+		オブジェクトのメンバ（リスト・辞書の要素を含む）が保持している NumPy 配列のうち、最大のものの大きさ [byte] を返す。
+		obj: 調べるオブジェクト（EQPlotter）
+	"""
+	largest = 0
+	stack = list(vars(obj).values())
+	while len(stack) > 0:
+		v = stack.pop()
+		if hasattr(v, "nbytes") and hasattr(v, "dtype"):
+			largest = max(largest, int(v.nbytes))
+		elif isinstance(v, (list, tuple)):
+			stack.extend(v)
+		elif isinstance(v, dict):
+			stack.extend(v.values())
+	return largest
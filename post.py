@@ -1,48 +1,319 @@
-import tweepy
-from twitter_text import parse_tweet
+import io
+import re
+import time
+import pickle
+import threading
+import traceback
+import dataclasses
+from concurrent.futures import Future, ThreadPoolExecutor
 
+import log
 import debugdef
 
-def Adjust_PostLen(post_fmt: str, target: str) -> str:
+# tweepy / twitter_text は読み込みが重いので、使う直前に読み込む（WarmUp で先に読み込んでおくこともできる）
+
+def WarmUp() -> None:
+	""" 投稿に使う重いモジュールを読み込んでおく。 """
+	import tweepy
+	import twitter_text
+
+def Adjust_PostLen(post_fmt: str, target: str, cut_at_line: bool = False) -> str:
 	"""
 		投稿時の文字列長を、X 側が受け入れ可能な長さまで切り詰めて調節する。
-		post_fmt: 投稿フォーマット。ここに target を差し込んだ文を計算に用いる。
-		target:   フォーマットに差し込む（可変）文
+		切り詰め量に対して投稿可否は単調なので、二分探索により O(log n) 回の判定で済ませる。
+		post_fmt:    投稿フォーマット。ここに target を差し込んだ文を計算に用いる。
+		target:      フォーマットに差し込む（可変）文
+		cut_at_line: True のとき、震度ごとの行（[震度X]）単位で切り詰める。行単位で収まらない場合は文字単位にフォールバックする
 	"""
+	from twitter_text import parse_tweet
+
 	# 半角 280 字以上は受け付けられないので処理軽減のために先に切っておく
 	target = target[:280]
-	text = ""
+	if len(target) == 0: return ""
+
+	# 切り詰めなしで収まるならそのまま
+	text = post_fmt.format(target)
+	if parse_tweet(text).valid:
+		return text
 
-	for i in range(len(target)):
-		text = post_fmt.format(target if i == 0 else (target[:-i] + "…"))
-		if parse_tweet(text).valid:
-			return text
+	if cut_at_line:
+		# 震度行の先頭位置（= 切り詰め位置）の候補。後ろの行から順に落としていく
+		# 最大震度の行まで落としてしまうと意味がないので、先頭の震度行は必ず残す
+		cuts = [m.start() for m in re.finditer(r"\n\[震度", target)][1:][::-1]
+		i = BisectValid(len(cuts), lambda i: post_fmt.format(target[:cuts[i]] + "\n…"))
+		if i is not None:
+			return post_fmt.format(target[:cuts[i]] + "\n…")
+
+	# 末尾から i 文字を削って「…」を付ける（i = 1, 2, ..., len(target) - 1）
+	i = BisectValid(len(target) - 1, lambda i: post_fmt.format(target[:-(i + 1)] + "…"))
+	if i is not None:
+		return post_fmt.format(target[:-(i + 1)] + "…")
 
 	return ""
 
-def Post(authdict: dict, text: str, img_path: str) -> None:
-	"""
-		文章と画像を X に投稿する。
-		authdict: X API 認証用の鍵の詰め合わせ
-		text:     投稿する文章
-		img_path: 投稿する画像へのファイルパス
-	"""
-	auth = tweepy.OAuthHandler(
-		consumer_key=authdict["api_key"],
-		consumer_secret=authdict["api_secret"],
-		access_token=authdict["access_token"],
-		access_token_secret=authdict["access_secret"]
-	)
-	client = tweepy.Client(
-		bearer_token=authdict["bearer_token"],
-		consumer_key=authdict["api_key"],
-		consumer_secret=authdict["api_secret"],
-		access_token=authdict["access_token"],
-		access_token_secret=authdict["access_secret"]
-	)
-	api = tweepy.API(auth)
-
-	# デバッグ時、投稿は封じられる
-	if debugdef.fDebug != True:
+def BisectValid(n: int, candidate) -> int | None:
+	"""
+		候補 candidate(0), ..., candidate(n - 1) のうち、X に投稿可能な最初のものの番号を二分探索で求める。
+		番号が大きいほど短い文になっていること（投稿可否が単調であること）を前提とする。
+		n:         候補の数
+		candidate: 番号を受け取り、候補となる投稿文を返す関数
+	"""
+	from twitter_text import parse_tweet
+
+	lo, hi = 0, n
+	while lo < hi:
+		mid = (lo + hi) // 2
+		if parse_tweet(candidate(mid)).valid:	hi = mid
+		else:									lo = mid + 1
+
+	return lo if lo < n else None
+
+### class PostJob BEGIN ###
+
+@dataclasses.dataclass
+class PostJob:
+	"""
+		投稿に失敗し、再試行を待っている投稿。
+		アップロード済みのメディアがあれば media_id を保持し、再試行時のアップロードを省略する。
+	"""
+	text: str
+	img_path: str
+	attempts: int		= 0
+	next_time: float	= 0.0
+	media_id: int		= None
+
+### class PostJob END ###
+
+### class RetryQueue BEGIN ###
+
+class RetryQueue:
+	"""
+		投稿に失敗した PostJob を保持する再試行キュー。
+		変更の都度 pickle 化して保存するので、システムを再起動しても未投稿分を引き継ぐことができる。
+	"""
+	def __init__(self, pkl_path: str, base_sec: float, max_sec: float, max_attempts: int) -> None:
+		self.pkl_path: str		= pkl_path
+		self.base_sec: float	= base_sec
+		self.max_sec: float		= max_sec
+		self.max_attempts: int	= max_attempts
+		self.jobs: list[PostJob] = []
+		self.__lock = threading.Lock()
+
+		try:
+			with open(self.pkl_path, "rb") as f:
+				self.jobs = pickle.load(f)
+		except FileNotFoundError:
+			pass
+
+	def __len__(self) -> int:
+		return len(self.jobs)
+
+	def Push(self, job: PostJob) -> bool:
+		"""
+			再試行回数に応じた待ち時間（指数バックオフ）を設定してキューに積む。
+			再試行回数が上限に達している場合は積まずに False を返す。
+			job: 再試行する投稿
+		"""
+		if job.attempts >= self.max_attempts: return False
+
+		self.__Backoff(job)
+		with self.__lock:
+			self.jobs.append(job)
+			self.Save()
+		return True
+
+	def Due(self) -> list[PostJob]:
+		"""
+			再試行の時刻を迎えた PostJob を返す。投稿順を保つため、キューに積んだ順に返す。
+			再試行中に停止しても失わないよう、キューからは除かない。結果に応じて Remove か Reschedule を呼び出すこと。
+		"""
+		now = time.time()
+		with self.__lock:
+			return [j for j in self.jobs if j.next_time <= now]
+
+	def Remove(self, job: PostJob) -> None:
+		"""
+			再試行に成功した PostJob をキューから除く。
+			job: Due で返した PostJob
+		"""
+		with self.__lock:
+			self.jobs = [j for j in self.jobs if j is not job]
+			self.Save()
+
+	def Reschedule(self, job: PostJob) -> bool:
+		"""
+			再試行に失敗した PostJob の次の再試行時刻を設定する。
+			再試行回数が上限に達している場合はキューから除いて False を返す。
+			job: Due で返した PostJob
+		"""
+		if job.attempts >= self.max_attempts:
+			self.Remove(job)
+			return False
+
+		self.__Backoff(job)
+		with self.__lock:
+			self.Save()
+		return True
+
+	def __Backoff(self, job: PostJob) -> None:
+		job.next_time = time.time() + min(self.base_sec * (2 ** job.attempts), self.max_sec)
+		job.attempts += 1
+
+	def Save(self) -> None:
+		with open(self.pkl_path, "wb") as f:
+			pickle.dump(self.jobs, f)
+
+### class RetryQueue END ###
+
+### class XPublisher BEGIN ###
+
+class XPublisher:
+	"""
+		X への投稿を担当する。
+		認証済みの tweepy.Client / tweepy.API は一度だけ作成して使い回す。
+		画像のアップロードは別スレッドで行うので、投稿文の作成と並行して進めることができる。
+		投稿に失敗した場合は例外を送出せず、RetryQueue に積んで後から再試行する。
+	"""
+	def __init__(self, config: dict) -> None:
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+
+		retryinfo: dict = config["post"]["retry"]
+		self.queue = RetryQueue(
+			config["paths"]["postqueue"],
+			retryinfo["base_sec"],
+			retryinfo["max_sec"],
+			retryinfo["max_attempts"]
+		)
+
+		self.__client = None	# tweepy.Client
+		self.__api    = None	# tweepy.API
+		self.__lock = threading.Lock()
+		self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="XPublisher")
+		# 再試行は新しい電文のアップロードを待たせないよう、別のスレッドで行う
+		self.__retry_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="XPublisherRetry")
+		self.LoadConfig(config)
+
+	def LoadConfig(self, config: dict) -> None:
+		""" 認証情報が変わった場合は、次の投稿時にクライアントを作り直す。再試行キューはそのまま引き継ぐ。 """
+		retryinfo: dict = config["post"]["retry"]
+		self.queue.base_sec		= retryinfo["base_sec"]
+		self.queue.max_sec		= retryinfo["max_sec"]
+		self.queue.max_attempts	= retryinfo["max_attempts"]
+
+		with self.__lock:
+			if config["postauth"] != getattr(self, "authdict", None):
+				self.__client = None
+				self.__api    = None
+			self.authdict: dict = config["postauth"]
+
+	def Connect(self) -> tuple:
+		""" X API のクライアントを（まだなければ）作成し、(tweepy.Client, tweepy.API) を返す。 """
+		with self.__lock:
+			if self.__client is not None: return (self.__client, self.__api)
+
+			import tweepy
+			authdict = self.authdict
+			auth = tweepy.OAuthHandler(
+				consumer_key=authdict["api_key"],
+				consumer_secret=authdict["api_secret"],
+				access_token=authdict["access_token"],
+				access_token_secret=authdict["access_secret"]
+			)
+			self.__client = tweepy.Client(
+				bearer_token=authdict["bearer_token"],
+				consumer_key=authdict["api_key"],
+				consumer_secret=authdict["api_secret"],
+				access_token=authdict["access_token"],
+				access_token_secret=authdict["access_secret"]
+			)
+			self.__api = tweepy.API(auth)
+			return (self.__client, self.__api)
+
+	def UploadMedia(self, image: Future) -> Future:
+		"""
+			画像のエンコード完了を待ってアップロードする処理を、別スレッドで開始する。結果（media_id）は Post に渡して受け取る。
+			image: EQPlotter の DrawMap（OutputImage）の戻り値。report.EncodedImage を返す Future
+		"""
+		return self.__executor.submit(self.__UploadEncoded, image)
+
+	def Post(self, text: str, media: Future, image: Future) -> bool:
+		"""
+			アップロードの完了を待ち、文章と画像を X に投稿する。
+			失敗した場合は再試行キューに積み、False を返す。
+			text:  投稿する文章
+			media: UploadMedia の戻り値
+			image: UploadMedia に渡したものと同じ Future（再試行用に画像の保存先を得る）
+		"""
+		# 画像がなければ再試行しても投稿できないので、再試行キューには積まない
+		try:
+			job = PostJob(text, image.result().path)
+		except Exception:
+			self.logger.error("画像を用意できなかったため、X への投稿を破棄します。\n" + traceback.format_exc())
+			return False
+
+		try:
+			job.media_id = media.result()
+			self.__CreatePost(job.text, job.media_id)
+			return True
+		except Exception:
+			self.logger.warning("X への投稿に失敗しました。再試行キューに登録します。\n" + traceback.format_exc())
+			self.__Requeue(job)
+			return False
+
+	def RetryPending(self) -> None:
+		""" 再試行の時刻を迎えた投稿を、再試行用のスレッドで再度投稿する（ポーリングや新しい電文の投稿を待たせない）。 """
+		if len(self.queue.Due()) == 0: return
+		self.__retry_executor.submit(self.__RetryDue)
+
+	def Close(self) -> None:
+		""" アップロード用・再試行用のスレッドを停止する。 """
+		self.__executor.shutdown(wait=True)
+		self.__retry_executor.shutdown(wait=True)
+
+	def __Requeue(self, job: PostJob) -> None:
+		if not self.queue.Push(job):
+			self.logger.error(f"X への投稿を {job.attempts} 回試みましたが失敗しました。投稿を破棄します。\n{job.text}")
+
+	def __RetryDue(self) -> None:
+		for job in self.queue.Due():
+			try:
+				if job.media_id is None:
+					job.media_id = self.__Upload(job.img_path)
+				self.__CreatePost(job.text, job.media_id)
+				self.queue.Remove(job)
+				self.logger.info(f"X への投稿を再試行し、成功しました（{job.attempts} 回目）")
+			except Exception:
+				# アップロード済みのメディアが失効している可能性があるので、次回はアップロードからやり直す
+				job.media_id = None
+				self.logger.warning(f"X への投稿の再試行に失敗しました（{job.attempts} 回目）\n" + traceback.format_exc())
+				if not self.queue.Reschedule(job):
+					self.logger.error(f"X への投稿を {job.attempts} 回試みましたが失敗しました。投稿を破棄します。\n{job.text}")
+
+	def __UploadEncoded(self, image: Future) -> int | None:
+		encoded = image.result()
+		self.logger.info(f"画像：{encoded.path}（{encoded.size / 1024:.1f} KB, エンコード {encoded.encode_sec * 1000:.0f} ms）")
+
+		# デバッグ時、投稿は封じられる
+		if debugdef.fDebug: return None
+
+		# エンコード済みのバイト列をそのまま渡し、ファイルを読み直さない
+		_, api = self.Connect()
+		media = api.media_upload(filename=encoded.path, file=io.BytesIO(encoded.data))
+		return media.media_id
+
+	def __Upload(self, img_path: str) -> int | None:
+		# デバッグ時、投稿は封じられる
+		if debugdef.fDebug: return None
+
+		_, api = self.Connect()
 		media = api.media_upload(filename=img_path)
-		client.create_tweet(text=text, media_ids=[media.media_id])
+		return media.media_id
+
+	def __CreatePost(self, text: str, media_id: int | None) -> None:
+		# デバッグ時、投稿は封じられる
+		if debugdef.fDebug: return
+
+		client, _ = self.Connect()
+		client.create_tweet(text=text, media_ids=[media_id])
+
+### class XPublisher END ###
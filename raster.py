@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# 軽量地図描画エンジン
+# makemap.py が書き出したポリゴンの座標配列を、matplotlib を使わずに cv2 で直接ラスタ化する
+
+import os
+import cv2
+import numpy as np
+
+from mapdata import LoadCached
+
+# 座標の小数部のビット数（cv2.fillPoly / polylines の shift）。サブピクセル精度で描画する
+SHIFT_BITS: int = 4
+
+### class PolygonLayer BEGIN ###
+
+class PolygonLayer:
+	"""
+		1 つの図層（細分区域、湖沼、県境など）のポリゴン群。
+		座標はすべてのリングを連結した 1 本の配列で持ち、オフセットで区切る。
+	"""
+	def __init__(self, npz, name: str) -> None:
+		self.name: str = name
+		self.coords: np.ndarray	= npz[f"{name}_coords"]	# (M, 2)   経度・緯度
+		self.rings: np.ndarray	= npz[f"{name}_rings"]	# (R + 1,) リング i の座標は coords[rings[i]:rings[i + 1]]
+		self.polys: np.ndarray	= npz[f"{name}_polys"]	# (P + 1,) ポリゴン j のリングは polys[j]:polys[j + 1] 番目（先頭が外周）
+		self.bbox: np.ndarray	= npz[f"{name}_bbox"]	# (P, 4)   ポリゴンごとの min_x, min_y, max_x, max_y
+		self.face: np.ndarray	= npz[f"{name}_face"]	# 塗りつぶし色（BGR）。塗らない場合は空
+		self.edge: np.ndarray	= npz[f"{name}_edge"]	# 線の色（BGR）。描かない場合は空
+		self.linewidth: float	= float(npz[f"{name}_linewidth"])	# 線の太さ [pt]
+
+	def Draw(self, img: np.ndarray, bound: list, px_per_deg: tuple[float, float], px_per_pt: float) -> None:
+		"""
+			図層を画像に描画する。
+			img: 描画先（BGR）
+			bound: 画像の範囲 [min_x, min_y, max_x, max_y]（経度・緯度）
+			px_per_deg: 1 度あたりのピクセル数 (x, y)
+			px_per_pt: 1 ポイントあたりのピクセル数（線の太さの換算用）
+		"""
+		# 画像の範囲にかかるポリゴンだけを描く
+		visible = np.flatnonzero(
+			(self.bbox[:, 0] <= bound[2]) & (self.bbox[:, 2] >= bound[0]) &
+			(self.bbox[:, 1] <= bound[3]) & (self.bbox[:, 3] >= bound[1])
+		)
+		if len(visible) == 0: return
+
+		# 経度・緯度 -> 固定小数点のピクセル座標
+		scale = (1 << SHIFT_BITS)
+		pts = np.empty(self.coords.shape, dtype=np.int32)
+		pts[:, 0] = np.rint((self.coords[:, 0] - bound[0]) * px_per_deg[0] * scale)
+		pts[:, 1] = np.rint((bound[3] - self.coords[:, 1]) * px_per_deg[1] * scale)
+
+		polygons = [
+			[pts[self.rings[r]:self.rings[r + 1]] for r in range(self.polys[j], self.polys[j + 1])]
+			for j in visible
+		]
+
+		if len(self.face) > 0:
+			color = self.face.tolist()
+			# 飛び地が穴の中にある場合に偶奇判定で抜けないよう、ポリゴン（外周 + 穴）ごとに塗る
+			for rings in polygons:
+				cv2.fillPoly(img, rings, color, lineType=cv2.LINE_AA, shift=SHIFT_BITS)
+
+		if len(self.edge) > 0:
+			thickness = max(1, round(self.linewidth * px_per_pt))
+			rings = [r for rings in polygons for r in rings]
+			cv2.polylines(img, rings, True, self.edge.tolist(), thickness=thickness, lineType=cv2.LINE_AA, shift=SHIFT_BITS)
+
+### class PolygonLayer END ###
+
+### class BaseMapRenderer BEGIN ###
+
+class BaseMapRenderer:
+	"""
+		ベース地図を描画する。細分区域 -> 湖沼 -> 県境 の順に重ねる。
+		線の太さは、幅 16 インチのキャンバスを出力画像の幅にラスタ化した場合（matplotlib 版と同じ）に合わせて換算する。
+	"""
+	layer_names: tuple = ("area", "lake", "pref")
+
+	def __init__(self, path: str) -> None:
+		with np.load(path, allow_pickle=False) as npz:
+			self.back: list = npz["back"].tolist()	# 背景（海）の色（BGR）
+			self.layers: list[PolygonLayer] = [PolygonLayer(npz, name) for name in self.layer_names]
+
+	def Render(self, bound: list, width: int, height: int, px_per_pt: float = None) -> np.ndarray:
+		"""
+			指定した範囲のベース地図を描画する。(height, width, 3) の BGR 画像を返す。
+			bound: 描画範囲 [min_x, min_y, max_x, max_y]（経度・緯度）
+			width / height: 出力画像の大きさ [px]
+			px_per_pt: 1 ポイントあたりのピクセル数。省略時は幅 16 インチのキャンバスとして換算する
+		"""
+		img = np.empty((height, width, 3), dtype=np.uint8)
+		img[:] = self.back
+
+		px_per_deg = (width / (bound[2] - bound[0]), height / (bound[3] - bound[1]))
+		px_per_pt  = px_per_pt or (width / 16) / 72
+
+		for layer in self.layers:
+			layer.Draw(img, bound, px_per_deg, px_per_pt)
+		return img
+
+### class BaseMapRenderer END ###
+
+### class BaseRaster BEGIN ###
+
+class BaseRaster:
+	"""
+		makemap.py があらかじめ日本全域を描画しておいたベース地図（.npy）を、メモリマップで読み込んで使う。
+		ファイルは読み取り専用で共有されるので、複数の描画プロセスが同時に使っても実メモリは 1 つ分で済む。
+		描画範囲の切り出しはコピーを伴わないビューで行い、出力画像の大きさに縮尺を合わせる時点で初めて複製する。
+		拡大・縮小して使うため、線の太さは出力画像の大きさによらず格子に対して一定になる。
+	"""
+	def __init__(self, path: str) -> None:
+		self.img: np.ndarray = np.load(path, mmap_mode="r")	# (H, W, 3) BGR。先頭行が北端
+		with np.load(BaseRasterMetaPath(path), allow_pickle=False) as meta:
+			self.bounds: np.ndarray	= meta["bounds"]				# 格子全体の min_x, min_y, max_x, max_y
+			self.deg_per_px: float	= float(meta["deg_per_px"])	# 1 画素あたりの度数
+			self.back: list			= meta["back"].tolist()		# 格子の外（海）の色（BGR）
+
+	def Render(self, bound: list, width: int, height: int) -> np.ndarray:
+		"""
+			指定した範囲のベース地図を切り出す。(height, width, 3) の BGR 画像（書き込み可能な複製）を返す。
+			bound: 描画範囲 [min_x, min_y, max_x, max_y]（経度・緯度）
+			width / height: 出力画像の大きさ [px]
+		"""
+		img = np.empty((height, width, 3), dtype=np.uint8)
+		img[:] = self.back
+
+		g, res = self.bounds, self.deg_per_px
+		h, w = self.img.shape[:2]
+
+		# 描画範囲と重なる格子の行・列
+		c0 = max(int(np.floor((bound[0] - g[0]) / res)), 0)
+		c1 = min(int(np.ceil((bound[2] - g[0]) / res)), w)
+		r0 = max(int(np.floor((g[3] - bound[3]) / res)), 0)
+		r1 = min(int(np.ceil((g[3] - bound[1]) / res)), h)
+		if c0 >= c1 or r0 >= r1: return img
+
+		# 格子の切り出し範囲が出力画像のどこに当たるか
+		px_per_deg = (width / (bound[2] - bound[0]), height / (bound[3] - bound[1]))
+		x0 = round((g[0] + c0 * res - bound[0]) * px_per_deg[0])
+		x1 = round((g[0] + c1 * res - bound[0]) * px_per_deg[0])
+		y0 = round((bound[3] - (g[3] - r0 * res)) * px_per_deg[1])
+		y1 = round((bound[3] - (g[3] - r1 * res)) * px_per_deg[1])
+		if x0 >= x1 or y0 >= y1: return img
+
+		view = self.img[r0:r1, c0:c1]	# メモリマップ上のビュー（コピーなし）
+		interpolation = cv2.INTER_AREA if (x1 - x0) < view.shape[1] else cv2.INTER_LINEAR
+		tile = cv2.resize(view, (x1 - x0, y1 - y0), interpolation=interpolation)
+
+		# 出力画像からはみ出す部分を除いて貼り付ける
+		ox0, oy0 = max(x0, 0), max(y0, 0)
+		ox1, oy1 = min(x1, width), min(y1, height)
+		if ox0 < ox1 and oy0 < oy1:
+			img[oy0:oy1, ox0:ox1] = tile[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0]
+		return img
+
+### class BaseRaster END ###
+
+
+# render.engine -> (ベース地図の描画クラス, そのデータの paths のキー)
+ENGINES: dict[str, tuple[type, str]] = {
+	"cv2":    (BaseMapRenderer, "polygons"),
+	"raster": (BaseRaster, "baseraster"),
+}
+
+def BaseRasterMetaPath(path: str) -> str:
+	""" ベース地図のラスタ（.npy）に対応する、範囲などの情報を保存したファイルのパス """
+	return os.path.splitext(path)[0] + "_meta.npz"
+
+def LoadRenderer(config: dict) -> BaseMapRenderer | BaseRaster:
+	"""
+		render.engine に応じたベース地図の描画クラスを読み込む。一度読み込んだものは使い回す。
+		config: config.json からの設定情報
+	"""
+	cls, key = ENGINES[config["render"]["engine"]]
+	return LoadCached(cls, config["paths"][key])
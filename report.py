@@ -1,22 +1,43 @@
 # coding: utf-8
 import os
+import io
+import re
+import glob
+import time
+import argparse
 import datetime
 import pickle
+import dataclasses
 import cv2
 import numpy as np
 import json
 
-from matplotlib.figure import Figure
-from matplotlib.axes import Axes
-import matplotlib.pyplot as plt
-plt.switch_backend("Agg")
-
-from xml.etree import ElementTree as ET
 from decimal import Decimal
 from collections import Counter
-from pandas import read_pickle, DataFrame
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 from eqinfo import IntensityHolder, HypocenterHolder
+from mapdata import AssistantData, LabelRaster, LoadAssistant, LoadCityIndex, LoadLabelRaster
+from raster import BaseMapRenderer, BaseRaster, LoadRenderer
+from xmlextract import Extractor
+
+# 画像のエンコードを受け持つワーカ。描画（投稿）処理の流れを止めないように別スレッドで行う
+_encoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ImageEncoder")
+
+### class EncodedImage BEGIN ###
+
+@dataclasses.dataclass
+class EncodedImage:
+	"""
+		エンコード済みの出力画像。
+		投稿側はファイルを読み直さず、data をそのまま使う。
+	"""
+	path: str			# 画像の保存先
+	data: bytes			# エンコード済みのバイト列
+	encode_sec: float	# エンコード（と保存）にかかった時間
+	size: int			# data のバイト数
+
+### class EncodedImage END ###
 
 ### class EQPlotter BEGIN ###
 
@@ -26,6 +47,9 @@ class EQPlotterBase:
 		XMLの解析等はサブクラスにて担当し、このクラスではすでに整理された情報のみを受け取る。
 		I-Maplot の根幹を担う部分
 	"""
+	# アイコンの倍率（zoom）の基準となる出力画像の幅 (px)。dpi=300 固定で描画していた頃の出力幅に相当する
+	icon_base_width: int = 3700
+
 	def __init__(self, config: dict) -> None:
 		"""
 			コンストラクタ
@@ -35,21 +59,32 @@ class EQPlotterBase:
 		self.LoadConfig(config)
 
 		self.__img_base: cv2.typing.MatLike  = None
-		self.__raster_img_path: str = ""
 		self.__bound: list = [0xffff, 0xffff, -0xffff, -0xffff]
+		# 出力ファイル名（拡張子なし）。None の場合は地震発生時刻から決める
+		self.output_name: str | None = None
+		# 出力先のフォルダ。None の場合は paths.output
+		self.output_dir: str | None = None
 
 		# 地図データ（Created by makemap.py）の読み込み
-		with open(config["paths"]["areamap"], "rb") as f:
-			self.__fig: Figure = pickle.load(f)
-		
-		self.__ax: Axes = self.__fig.gca()
-		self.__ax.axis("tight")				# よくわからん
-		self.__ax.axis("off")				# 軸の表示を行わない
-		self.__ax.set_aspect("equal")		# 縦横軸の比率が等しくなるように
-		self.__fig.set_size_inches(16, 9)	# キャンバス比率を 16:9 に
+		if self.engine == "matplotlib":
+			# matplotlib は読み込みが重いので、このエンジンを使う場合のみ読み込む
+			import matplotlib.pyplot as plt
+			plt.switch_backend("Agg")
+
+			with open(config["paths"]["areamap"], "rb") as f:
+				self.__fig = pickle.load(f)		# matplotlib.figure.Figure
+
+			self.__ax = self.__fig.gca()		# matplotlib.axes.Axes
+			self.__ax.axis("tight")				# よくわからん
+			self.__ax.axis("off")				# 軸の表示を行わない
+			self.__ax.set_aspect("equal")		# 縦横軸の比率が等しくなるように
+			self.__ax.set_position([0, 0, 1, 1])	# 余白なしでキャンバス全体に描画する
+		else:
+			# 座標配列から cv2 で直接描画する（"cv2"）か、描画済みのラスタから切り出す（"raster"）。一度読み込んだものは使い回す
+			self.__renderer: BaseMapRenderer | BaseRaster = LoadRenderer(config)
 
 		# 地図描画補助情報の読み込み
-		self.assistant: DataFrame = read_pickle(config["paths"]["assistant"])
+		self.assistant: AssistantData = LoadAssistant(config["paths"]["assistant_npz"])
 
 	def LoadConfig(self, config: dict) -> None:
 		"""
@@ -58,20 +93,27 @@ class EQPlotterBase:
 		"""
 		self.__output_path: str    = config["paths"]["output"]
 		self.images_path: str    = config["paths"]["images"]
+		self.encinfo: dict       = config["render"]["encode"]
+		self.citymap_path: str   = config["paths"]["citymap"]
+		self.intensity_mode: str = config["render"]["intensity_mode"]
+		self.city_zoom: float    = config["render"]["city_zoom"]
+		self.declutter: str      = config["render"]["declutter"]
+		self.declutter_overlap: float = config["render"]["declutter_overlap"]
+		self.engine: str         = config["render"]["engine"]
+		self.labelmap_path: str  = config["paths"]["labelmap"]
+		self.fillinfo: dict      = config["render"]["fill"]
 		self.backcolor: str = config["makemap"]["areamap"]["color"]["back"]
-		self.ns: dict      = config["xmlfeed"]["xml_ns"]["report"]
-
-	def XMLSplitRoot(self, xml: str) -> tuple[ET.Element | None, ET.Element | None, ET.Element | None]:
-		root = ET.fromstring(xml)
-		ctrl = root.find("atom:Control", self.ns["report"])
-		head = root.find("atom:Head", self.ns["head"])
-		body = root.find("atom:Body", self.ns["body"])
-		return (ctrl, head, body)
+		self.xml_backend: str = config["xmlfeed"]["xml_backend"]
+		# 出力画像の大きさ (幅, 高さ) [px]。ベース地図はこの大きさで直接ラスタ化する
+		self.out_size: tuple[int, int] = (config["render"]["width"], config["render"]["height"])
 
-	def Rasterize(self) -> str:
+	def Rasterize(self) -> None:
 		if self.__img_base is not None:	return
 
-		# 16 : 9 に合わせて領域の切り取りが必要
+		# 出力画像の縦横比（16 : 9 など）に合わせて領域の切り取りが必要
+		width, height = self.out_size
+		aspect = height / width
+
 		self.__bound[0] -= 0.5
 		self.__bound[1] -= 0.5
 		self.__bound[2] += 0.5
@@ -79,32 +121,37 @@ class EQPlotterBase:
 		xdiff = self.__bound[2] - self.__bound[0]
 		ydiff = self.__bound[3] - self.__bound[1]
 		
-		if ydiff > xdiff * 0.5625:
-			# Y の大きさが 16:9 より大きいので、Y を基準に X を 16 に合うように拡張
-			xdiff = ydiff * 1.7778 - xdiff
+		if ydiff > xdiff * aspect:
+			# Y の大きさが出力比率より大きいので、Y を基準に X を拡張
+			xdiff = ydiff / aspect - xdiff
 			self.__bound[0] -= xdiff / 2
 			self.__bound[2] += xdiff / 2
 		else:
-			# Y の大きさが 16:9 より小さいので、X を基準に Y を 9 に合うように拡張
-			ydiff = xdiff * 0.5625 - ydiff
+			# Y の大きさが出力比率より小さいので、X を基準に Y を拡張
+			ydiff = xdiff * aspect - ydiff
 			self.__bound[1] -= ydiff / 2
 			self.__bound[3] += ydiff / 2
 
+		if self.engine != "matplotlib":
+			self.__img_base = self.__renderer.Render(self.__bound, width, height)
+			return
+
+		import matplotlib.pyplot as plt
+		from matplotlib.backends.backend_agg import FigureCanvasAgg
 		self.__ax.set_xlim(self.__bound[0], self.__bound[2])
 		self.__ax.set_ylim(self.__bound[1], self.__bound[3])
 
-		self.__raster_img_path = "./temporary.png"
-		self.__fig.savefig(
-			self.__raster_img_path,
-			facecolor=self.backcolor,
-			bbox_inches="tight",
-			pad_inches=0,
-			dpi=300
-		)
-		self.__img_base = cv2.imread(self.__raster_img_path)
-		plt.close(self.__fig)
+		# 幅 16 インチのキャンバスを、出力画像の大きさちょうどになる dpi でラスタ化する
+		dpi = width / 16
+		self.__fig.set_size_inches(16, height / dpi)
 
-		return self.__raster_img_path
+		# ファイルを介さずにキャンバスのバッファから直接読み取る（一括描画の並列実行でも競合しない）
+		self.__fig.set_dpi(dpi)
+		self.__fig.set_facecolor(self.backcolor)
+		canvas = FigureCanvasAgg(self.__fig)
+		canvas.draw()
+		self.__img_base = cv2.cvtColor(np.asarray(canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+		plt.close(self.__fig)
 
 	# x, y は画像としての座標 (px)
 	def PlotImage(self, px: list, img_add: cv2.typing.MatLike) -> None:
@@ -113,23 +160,45 @@ class EQPlotterBase:
 			px: 座標 (x, y) のリスト。同じ画像をまとめて描画可能
 			img_add: 地図に重ねる画像 
 		"""
-		if (self.__img_base is None) or (img_add is None): return
+		if (self.__img_base is None) or (img_add is None) or len(px) == 0: return
 
 		bseh, bsew = self.__img_base.shape[:2]
 		addh, addw = img_add.shape[:2]
-		
-		px = [(x, y) for x, y in px \
-				if not(x + addw < 0 or y + addh < 0 or x > bsew or y > bseh)]
-		for x, y in px:
+
+		# 画像の外に出てしまうものはまとめて除外する
+		px = np.asarray(px).reshape(-1, 2)
+		px = px[~((px[:, 0] + addw < 0) | (px[:, 1] + addh < 0) | (px[:, 0] > bsew) | (px[:, 1] > bseh))]
+		for x, y in px.tolist():
 			alpha_blend(self.__img_base, img_add, x, y)
 	
-	def OutputImage(self, eq_time: datetime.datetime) -> str:
-		""" 画像をファイルに出力する """
-		outpath = os.path.join(self.__output_path, f"{eq_time.strftime("%Y%m%d_%H%M%S")}.png")
-		cv2.imwrite(outpath, self.__img_base)
-		os.remove(self.__raster_img_path)
-		return outpath
+	def OutputImage(self, eq_time: datetime.datetime) -> Future:
+		"""
+			画像をエンコードしてファイルに出力する。
+			エンコードはワーカで行い、結果（EncodedImage）を受け取るための Future を直ちに返す。
+		"""
+		ext = ENCODE_EXT[self.encinfo["format"]]
+		name = self.output_name or eq_time.strftime("%Y%m%d_%H%M%S")
+		outpath = os.path.join(self.output_dir or self.__output_path, f"{name}.{ext}")
+		return _encoder.submit(EncodeImage, self.__img_base, outpath, self.encinfo)
 	
+	def BlendLabelColors(self, labels: LabelRaster, lut: np.ndarray) -> None:
+		"""
+			区域番号のラスタをもとに、区域ごとの色をベース地図に一括で重ね合わせる。
+			labels: 区域番号のラスタ
+			lut: 区域番号 -> BGRA の (区域数 + 1, 4) の uint8 配列。アルファが 0 の区域は塗らない
+		"""
+		if self.__img_base is None: return
+
+		height, width = self.__img_base.shape[:2]
+		idx  = labels.Sample(self.__bound, width, height)
+		mask = lut[idx, 3] > 0
+		if not mask.any(): return
+
+		color = lut[idx[mask]].astype(np.float32)
+		alpha = color[:, 3:] / 255
+		base  = self.__img_base[mask]
+		self.__img_base[mask] = (base * (1 - alpha) + color[:, :3] * alpha).astype(np.uint8)
+
 	# max_bound: [min_x, min_y, max_x, max_y]
 	def ExpandMapBound(self, min_x: float, min_y: float, max_x: float, max_y: float) -> list:
 		"""
@@ -145,6 +214,27 @@ class EQPlotterBase:
 		self.__bound[3] = max(max_y, self.__bound[3])	# max_y
 		return self.__bound
 
+	def IconZoom(self, zoom: float) -> float:
+		"""
+			アイコンの倍率を出力画像の大きさに合わせて換算する。
+			zoom: 幅 icon_base_width の画像に重ねる場合の倍率
+		"""
+		return zoom * self.out_size[0] / self.icon_base_width
+
+	def GeoCoords2Pixels(self, coords) -> np.ndarray:
+		"""
+			緯度経度をまとめてピクセル座標に変換する（GeoCoord2Pixel のベクトル版）。(N, 2) の整数配列を返す。
+			丸めは GeoCoord2Pixel と同じく偶数丸め。
+			coords: 経度・緯度の (N, 2) の配列（またはタプルのリスト）
+		"""
+		coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+		if self.__img_base is None: return np.zeros(coords.shape, dtype=int)
+
+		lpx, lpy = GetLatLonperPixel(self.__bound, self.__img_base)
+		x = np.rint((coords[:, 0] - self.__bound[0]) / lpx)
+		y = np.rint((self.__bound[3] - coords[:, 1]) / lpy)
+		return np.stack([x, y], axis=1).astype(int)
+
 	def GeoCoord2Pixel(self, lon: float, lat: float) -> tuple:
 		"""
 			地図データ上の緯度経度をラスタ画像上のピクセル座標に変換する。lon, lat を x, y のタプルにして返す。
@@ -187,7 +277,7 @@ class Hypocenter_Plotter(EQPlotterBase):
 		self.Rasterize()
 		
 		img_add = cv2.imread(os.path.join(self.images_path, "hypocenter.png"), cv2.IMREAD_UNCHANGED)
-		img_add = cv2.resize(img_add, dsize=None, fx=zoom, fy=zoom, interpolation=cv2.INTER_LINEAR)
+		img_add = ResizeIcon(img_add, self.IconZoom(zoom))
 		longitude = self.hypocenter.longitude
 		latitude  = self.hypocenter.latitude
 		
@@ -207,6 +297,7 @@ class Intensity_Plotter(EQPlotterBase):
 	def __init__(self, config: dict) -> None:
 		super().__init__(config)
 		self.intensity = IntensityHolder(config)
+		self.suppressed_stamps: int = 0	# 重なりの整理で描画を省いた震度画像の数
 
 	def SetMapBounds(self, plot_level: str):
 		""" 地図の描画範囲を決定する。 """
@@ -214,13 +305,11 @@ class Intensity_Plotter(EQPlotterBase):
 		for k, v in self.intensity.intensity.items():
 			if len(v) == 0: continue
 
-			m = self.assistant[self.assistant["name"].isin(v)]
+			m = self.assistant.Select(v)
 
-			# m["bounds"] 各行は csv 形式のテキスト
-			# csv2tuple で tuple に変換して list にして格納
-			# tuple -> (min_x, min_y, max_x, max_y)
-			if fbound:
-				bounds = np.array(list(map(lambda b: csv2tuple(b), m["bounds"]))).T
+			# bounds 各行 -> (min_x, min_y, max_x, max_y)
+			if fbound and len(m) > 0:
+				bounds = self.assistant.bounds[m].T
 				self.bound = self.ExpandMapBound(bounds[0].min(), bounds[1].min(), bounds[2].max(), bounds[3].max())
 			
 			if k == plot_level: fbound = False
@@ -229,39 +318,123 @@ class Intensity_Plotter(EQPlotterBase):
 		""" IntensityHolder から震度情報を取り出して描画する。 """
 		self.Rasterize()
 
+		groups = []
 		for k, v in self.intensity.intensity.items():
 			if len(v) == 0: continue
 
-			m = self.assistant[self.assistant["name"].isin(v)]
-			coords = list(map(lambda g: (g.x, g.y), m["centroid"]))
-			self.PlotIntensity2(coords, k, 0.25)
+			m = self.assistant.Select(v)
+			groups.append((k, self.assistant.centroid[m]))
+		self.PlotIntensityGroups(groups, 0.25)
+
+	def PlotIntensityGroups(self, groups: list[tuple[str, np.ndarray]], zoom: float=1.0) -> None:
+		"""
+			震度ごとの座標群を、重なりを整理した上で描画する。
+			配置は空間ハッシュ（震度画像の大きさの格子）で整理し、大きく重なる場合は大きい震度だけを残す（self.declutter による）。
+			大きい震度が上に来るよう、小さい震度から順に描画する。
+			groups: (震度, 緯度経度の (N, 2) 配列) のリスト。震度の大きい順に並んでいること
+			zoom: 画像を重ね合わせる際の倍率
+		"""
+		if len(groups) == 0: return
+
+		icons = { k: self.LoadIntensityIcon(k, zoom) for k, _ in groups }
+		cell  = max(max(icon.shape[:2]) for icon in icons.values())
+
+		pxgroups = [(k, self.GeoCoords2Pixels(coords)) for k, coords in groups]
+		placed, self.suppressed_stamps = DeclutterStamps(pxgroups, cell, self.declutter, self.declutter_overlap)
+
+		for k, px in reversed(placed):
+			cx, cy = GetCenterPixel(icons[k])
+			self.PlotImage(px - (cx, cy), icons[k])
+
+	def PlotIntensityFill(self) -> None:
+		"""
+			細分区域を震度ごとの色で塗りつぶす。
+			IntensityHolder から区域番号 -> 色 の対応表を作り、区域番号のラスタ全体に 1 回で適用する。
+		"""
+		self.Rasterize()
+
+		colors: dict = self.fillinfo["colors"]
+		alpha = round(self.fillinfo["alpha"] * 255)
+		lut = np.zeros((len(self.assistant.name) + 1, 4), dtype=np.uint8)
+
+		# 震度の小さい順に設定し、同じ区域に複数の震度があれば大きい方を残す
+		for k, v in reversed(self.intensity.intensity.items()):
+			if len(v) == 0 or k not in colors: continue
+			lut[self.assistant.Select(v) + 1] = (*HexToBGR(colors[k]), alpha)
+
+		self.BlendLabelColors(LoadLabelRaster(self.labelmap_path), lut)
+
+	def LoadIntensityIcon(self, intensity: str, zoom: float=1.0) -> cv2.typing.MatLike:
+		"""
+			震度画像を読み込み、出力画像の大きさに合わせて拡大縮小する。
+			intensity: 震度
+			zoom: 画像を重ね合わせる際の倍率
+		"""
+		img_add = cv2.imread(os.path.join(self.images_path, intensity+".png"), cv2.IMREAD_UNCHANGED)
+		return ResizeIcon(img_add, self.IconZoom(zoom))
 		
 	# x, y は地図としての座標 (lon, lat)
 	def PlotIntensity2(self, coords: list[tuple[float, float]], intensity: str, zoom: float=1.0) -> None:
 		"""
 			ベース地図に指定した震度の震度画像を描画する。
-			coords: 緯度経度のリスト
+			coords: 緯度経度のリスト（(N, 2) の配列でもよい）
 			intensity: 描画する震度
 			zoom: 画像を重ね合わせる際の倍率
 		"""
-		img_add = cv2.imread(os.path.join(self.images_path, intensity+".png"), cv2.IMREAD_UNCHANGED)
-		img_add = cv2.resize(img_add, dsize=None, fx=zoom, fy=zoom, interpolation=cv2.INTER_LINEAR)
+		img_add = self.LoadIntensityIcon(intensity, zoom)
 
 		# 緯度経度のリストをピクセル座標のリストに変換する
-		px = [self.GeoCoord2Pixel(lon, lat) for lon, lat in coords]
+		px = self.GeoCoords2Pixels(coords)
 		cx, cy = GetCenterPixel(img_add)
-		self.PlotImage([(x - cx, y - cy) for x, y in px], img_add)
+		self.PlotImage(px - (cx, cy), img_add)
 		return
 
+	def PlotIntensityCity(self, holder: IntensityHolder, zoom: float=1.0) -> None:
+		"""
+			市町村ごとの震度を、役場の位置に描画する。
+			震度ごとに全市町村の位置を索引から一括で引き、まとめて描画する。
+			holder: 市町村等コード付きで震度情報を格納した IntensityHolder
+			zoom: 画像を重ね合わせる際の倍率
+		"""
+		self.Rasterize()
+		cities = LoadCityIndex(self.citymap_path)
+
+		groups = []
+		for k, v in holder.code.items():
+			if len(v) == 0: continue
+
+			lonlat, found = cities.Lookup(v)
+			groups.append((k, lonlat[found]))
+		self.PlotIntensityGroups(groups, zoom)
+
 ### class Intensity_Plotter END ###
 
 ### class EQPlotter_VXSE51 BEGIN ###
 
 class EQPlotter_VXSE51(Intensity_Plotter):
 	""" VXSE51（震度速報）用の電文解析・地図描画クラス """
+	# 電文から取り出す項目。経路は Report 要素からの要素名
+	EXTRACTOR = Extractor(
+		{
+			"control":     "Control",
+			"head":        "Head",
+			"body":        "Body",
+			"infokind":    "Head/InfoKind",
+			"event_id":    "Head/EventID",
+			"report_time": "Head/ReportDateTime",
+			"target_time": "Head/TargetDateTime",
+			"max_int":     "Body/Intensity/Observation/MaxInt",
+		},
+		{
+			"areas": ("Body/Intensity/Observation/Pref/Area", { "name": "Name", "max_int": "MaxInt" }),
+		}
+	)
+
 	def __init__(self, config) -> None:
 		super().__init__(config)
 		self.eq_time: datetime.datetime = None
+		self.event_id: str = None	# 地震の識別子（Head/EventID）
+		self.report_key: str = None	# 電文の識別情報（再送の判別用。InfoKind, EventID, ReportDateTime）
 		self.max_int: str = "-"
 		self.streqlv: str = config["level_str"]
 		self.eqlevel: dict = config["eqlevel"]
@@ -270,8 +443,8 @@ class EQPlotter_VXSE51(Intensity_Plotter):
 		""" 地震のあった地方名を出力する。 """
 		max_area: list = self.intensity.intensity[self.max_int]
 
-		df = self.assistant[self.assistant["name"].isin(max_area)]
-		c = Counter(df["region"].iloc)
+		m = self.assistant.Select(max_area)
+		c = Counter(self.assistant.region[m].tolist())
 		region = c.most_common()[0][0]
 
 		return region + ("で" if len(region) > 0 else "")
@@ -293,39 +466,34 @@ class EQPlotter_VXSE51(Intensity_Plotter):
 	
 	def ParseXML(self, xml: str) -> None:
 		""" XML (VXSE51) の解析を行う """
-		# xml_ の接頭辞がついている変数は XML の要素を扱うものであるとみなす
-		xml_ctrl, xml_head, xml_body = self.XMLSplitRoot(xml)
+		x = self.EXTRACTOR.Extract(xml, self.xml_backend)
 
 		# XMLが正常にパースできない場合は終了
-		if xml_ctrl is None or xml_head is None or xml_body is None:
+		if not (x.Has("control") and x.Has("head") and x.Has("body")):
 			return
 
 		# InfoKind が「震度速報」でない場合は終了
-		xml_infokind = xml_head.find(".//atom:InfoKind", self.ns["head"])
-		if xml_infokind.text != "震度速報": return
+		if x.First("infokind") != "震度速報": return
+		self.event_id = x.First("event_id")
+		self.report_key = "\n".join((x.First("infokind"), self.event_id or "", x.First("report_time") or ""))
 
 		# 地震発生時刻の取得
-		xml_target_time = xml_head.find(".//atom:TargetDateTime", self.ns["head"])
-		self.eq_time = datetime.datetime.fromisoformat(xml_target_time.text)
+		self.eq_time = datetime.datetime.fromisoformat(x.First("target_time"))
 
 		# 観測最大震度の取得
-		xml_observation = xml_body.find(".//atom:Intensity/atom:Observation", self.ns["body"])
-		xml_max_int = xml_observation.find("./atom:MaxInt", self.ns["body"])
-		self.max_int = xml_max_int.text
+		self.max_int = x.First("max_int")
 
 		# 震度情報（細分区域）の取得
-		xml_arealist = xml_observation.findall("./atom:Pref/atom:Area", self.ns["body"])
-		for xml_area in xml_arealist:
-			xml_areaname  = xml_area.find("./atom:Name",   self.ns["body"])
-			xml_intensity = xml_area.find("./atom:MaxInt", self.ns["body"])
-			self.intensity.AddIntensity(xml_intensity.text, xml_areaname.text)
+		for area in x.records["areas"]:
+			self.intensity.AddIntensity(area["max_int"], area["name"])
 
-	def DrawMap(self, plot_level: str="1") -> str:
+	def DrawMap(self, plot_level: str="1") -> Future:
 		""" 震度地図の描画 """
 		self.SetMapBounds(plot_level)
-		self.PlotIntensity()
-		outpath = self.OutputImage(self.eq_time)
-		return outpath
+
+		if self.intensity_mode == "fill":	self.PlotIntensityFill()
+		else:								self.PlotIntensity()
+		return self.OutputImage(self.eq_time)
 	
 ### class EQPlotter_VXSE51 END ###
 
@@ -333,9 +501,34 @@ class EQPlotter_VXSE51(Intensity_Plotter):
 
 class EQPlotter_VXSE53(Hypocenter_Plotter, Intensity_Plotter):
 	""" VXSE53（震源・震度に関する情報）用の電文解析・地図描画クラス """
+	# 電文から取り出す項目。経路は Report 要素からの要素名
+	EXTRACTOR = Extractor(
+		{
+			"control":      "Control",
+			"head":         "Head",
+			"body":         "Body",
+			"infokind":     "Head/InfoKind",
+			"event_id":     "Head/EventID",
+			"report_time":  "Head/ReportDateTime",
+			"origin_time":  "Body/Earthquake/OriginTime",
+			"hypo_name":    "Body/Earthquake/Hypocenter/Area/Name",
+			"coordinate":   "Body/Earthquake/Hypocenter/Area/Coordinate",
+			"magnitude":    "Body/Earthquake/Magnitude",
+			"observation":  "Body/Intensity/Observation",
+			"max_int":      "Body/Intensity/Observation/MaxInt",
+			"comment_code": "Body/Comments/ForecastComment[@codeType='固定付加文']/Code",
+		},
+		{
+			"areas":  ("Body/Intensity/Observation/Pref/Area", { "name": "Name", "max_int": "MaxInt" }),
+			"cities": ("Body/Intensity/Observation/Pref/Area/City", { "name": "Name", "max_int": "MaxInt", "code": "Code" }),
+		}
+	)
+
 	def __init__(self, config: dict) -> None:
 		super().__init__(config)
 		self.eq_time: datetime.datetime = None
+		self.event_id: str = None	# 地震の識別子（Head/EventID）
+		self.report_key: str = None	# 電文の識別情報（再送の判別用。InfoKind, EventID, ReportDateTime）
 		self.intensity_city = IntensityHolder(config)
 		self.codelist: list[str] = []
 		self.max_int: str = "-"
@@ -361,76 +554,64 @@ class EQPlotter_VXSE53(Hypocenter_Plotter, Intensity_Plotter):
 	
 	def ParseXML(self, xml: str) -> None:
 		""" XML (VXSE53) の解析を行う """
-		# xml_ の接頭辞がついている変数は XML の要素を扱うものであるとみなす
-		xml_ctrl, xml_head, xml_body = self.XMLSplitRoot(xml)
+		x = self.EXTRACTOR.Extract(xml, self.xml_backend)
 
 		# XMLが正常にパースできない場合は終了
-		if xml_ctrl is None or xml_head is None or xml_body is None:
+		if not (x.Has("control") and x.Has("head") and x.Has("body")):
 			return
 
 		# InfoKind が「地震情報」でない場合は終了
-		xml_infokind = xml_head.find(".//atom:InfoKind", self.ns["head"])
-		if xml_infokind.text != "地震情報": return
-
-		xml_earthquake = xml_body.find("./atom:Earthquake", self.ns["body"])
-		xml_intensity  = xml_body.find("./atom:Intensity",  self.ns["body"])
+		if x.First("infokind") != "地震情報": return
+		self.event_id = x.First("event_id")
+		self.report_key = "\n".join((x.First("infokind"), self.event_id or "", x.First("report_time") or ""))
 
 		# 地震発生時刻の取得
-		xml_origin_time = xml_body.find(".//atom:OriginTime", self.ns["body"])
-		self.eq_time = datetime.datetime.fromisoformat(xml_origin_time.text)
+		self.eq_time = datetime.datetime.fromisoformat(x.First("origin_time"))
 
 		# 震源情報の取得
 		# 震源域名
-		xml_hypocenter = xml_earthquake.find("./atom:Hypocenter/atom:Area", self.ns["body"])
-		self.hypocenter.name = xml_hypocenter.find("./atom:Name", self.ns["body"]).text
+		self.hypocenter.name = x.First("hypo_name")
 
 		# 震源位置（緯度・経度・深さ）
-		xml_coordinate = xml_hypocenter.find("./jmx_eb:Coordinate", self.ns["body"])
-		self.hypocenter.ParseHypocenter(xml_coordinate.text)
+		self.hypocenter.ParseHypocenter(x.First("coordinate"))
 
 		# マグニチュード
-		xml_magnitude = xml_earthquake.find("./jmx_eb:Magnitude", self.ns["body"])
-		self.hypocenter.magnitude = float(xml_magnitude.text)
+		self.hypocenter.magnitude = float(x.First("magnitude"))
 
 		# 観測最大震度の取得
 		# 2024-09-24 震度が観測されない場合がある
-		xml_observation = xml_body.find(".//atom:Intensity/atom:Observation", self.ns["body"])
-		
-		if xml_observation is None: 
+		if not x.Has("observation"):
 			self.max_int = "-"
 		else:
-			xml_maxint = xml_observation.find("./atom:MaxInt", self.ns["body"])
-			self.max_int = xml_maxint.text
+			self.max_int = x.First("max_int")
 
 			# 震度情報（細分区域）の取得
-			xml_arealist = xml_observation.findall("./atom:Pref/atom:Area", self.ns["body"])
-			for xml_area in xml_arealist:
-				xml_areaname = xml_area.find("./atom:Name",   self.ns["body"])
-				xml_maxint   = xml_area.find("./atom:MaxInt", self.ns["body"])
-				self.intensity.AddIntensity(xml_maxint.text, xml_areaname.text)	# in Intensity_Plotter
+			for area in x.records["areas"]:
+				self.intensity.AddIntensity(area["max_int"], area["name"])	# in Intensity_Plotter
 
 			# 震度情報（市町村等）の取得
-			xml_citylist = xml_observation.findall("./atom:Pref/atom:Area/atom:City", self.ns["body"])
-			for xml_city in xml_citylist:
-				xml_cityname = xml_city.find("./atom:Name",   self.ns["body"])
-				xml_maxint   = xml_city.find("./atom:MaxInt", self.ns["body"])
-				self.intensity_city.AddIntensity(xml_maxint.text, xml_cityname.text)
+			for city in x.records["cities"]:
+				self.intensity_city.AddIntensity(city["max_int"], city["name"], city["code"])
 
 		# 固定付加文の取得。文はパターン化されておりコードで識別することができる
-		xml_forecast_comment = xml_body.findall(".//atom:ForecastComment[@codeType='固定付加文']", self.ns["body"])
-		for c in xml_forecast_comment:
-			xml_code = c.find(".//atom:Code", self.ns["body"])
-			if xml_code is not None:
-				self.codelist = xml_code.text.split()
+		code = x.Last("comment_code")
+		if code is not None:
+			self.codelist = code.split()
 		
-	def DrawMap(self, plot_level: str="1") -> str:
+	def DrawMap(self, plot_level: str="1") -> Future:
 		""" 震源・震度地図の描画 """
 		Hypocenter_Plotter.SetMapBounds(self)
 		Intensity_Plotter.SetMapBounds(self, plot_level)
-		self.PlotHypocenter(0.4)
-		self.PlotIntensity()
-		outpath = self.OutputImage(self.eq_time)
-		return outpath
+		# 塗りつぶしの場合は震源が隠れないよう、先に塗っておく
+		if self.intensity_mode == "fill":
+			self.PlotIntensityFill()
+			self.PlotHypocenter(0.4)
+		else:
+			self.PlotHypocenter(0.4)
+
+			if self.intensity_mode == "city":	self.PlotIntensityCity(self.intensity_city, self.city_zoom)
+			else:								self.PlotIntensity()
+		return self.OutputImage(self.eq_time)
 
 ### funcdef BEGIN ###
 
@@ -447,6 +628,14 @@ def GetLatLonperPixel(bound: tuple, img: cv2.typing.MatLike) -> tuple:
 
 	return (wln / wpx, hlt / hpx)
 
+def HexToBGR(color: str) -> tuple[int, int, int]:
+	"""
+		"#RRGGBB" 形式の色を cv2 用の (B, G, R) に変換する。
+		color: 色
+	"""
+	c = color.lstrip("#")
+	return (int(c[4:6], 16), int(c[2:4], 16), int(c[0:2], 16))
+
 def GetCenterPixel(img: cv2.typing.MatLike) -> tuple:
 	"""
 		画像の中央座標を取得する
@@ -458,6 +647,81 @@ def GetCenterPixel(img: cv2.typing.MatLike) -> tuple:
 	cy = int(Decimal(str(img.shape[0] / 2)).quantize(Decimal("0")))
 	return (cx, cy)
 
+# 升目が埋まっていた場合にずらす先（mode = "nudge"）。近い順
+NUDGE_OFFSETS: tuple = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1))
+
+def DeclutterStamps(groups: list[tuple[str, np.ndarray]], cell: int, mode: str, overlap: float = 0.5) -> tuple[list, int]:
+	"""
+		重ねる画像の配置を、一辺 cell ピクセルの格子による空間ハッシュで整理する。
+		(整理後の groups, 描画を省いた数) のタプルを返す。
+		groups: (キー, ピクセル座標の (N, 2) 配列) のリスト。優先度の高い順に並んでいること
+		cell: 格子の大きさ。重ねる画像の大きさにするとよい
+		mode: "cell"  -> 周囲 3×3 の升目に置いた画像と overlap 以上重なるものは省く（優先度の高いものを残す）
+		      "nudge" -> 升目が埋まっていれば隣の空いた升目へずらし、空きがなければ省く
+		      "off"   -> 整理しない（完全に同じ位置に重なって隠れるものだけを省く）
+		overlap: "cell" で省く重なりの割合（一辺 cell の正方形どうしの重なる面積 / 正方形の面積）
+	"""
+	occupied: set = set()
+	grid: dict[tuple[int, int], list[tuple[int, int]]] = {}	# 升目 -> 置いた画像の中心（"cell"）
+	placed: list  = []
+	suppressed: int = 0
+
+	for key, px in groups:
+		keep = []
+		for x, y in px.tolist():
+			if mode == "cell":
+				# 重なりうるのは周囲 3×3 の升目に置いたものだけ
+				c = (x // cell, y // cell)
+				near = (q for dx in (-1, 0, 1) for dy in (-1, 0, 1) for q in grid.get((c[0] + dx, c[1] + dy), ()))
+				if any(OverlapRatio((x, y), q, cell) >= overlap for q in near):
+					suppressed += 1
+				else:
+					grid.setdefault(c, []).append((x, y))
+					keep.append((x, y))
+				continue
+
+			c = (x, y) if mode == "off" else (x // cell, y // cell)
+
+			if c not in occupied:
+				occupied.add(c)
+				keep.append((x, y))
+				continue
+
+			if mode == "nudge":
+				for dx, dy in NUDGE_OFFSETS:
+					n = (c[0] + dx, c[1] + dy)
+					if n not in occupied:
+						occupied.add(n)
+						keep.append((x + dx * cell, y + dy * cell))
+						break
+				else:
+					suppressed += 1
+			else:
+				suppressed += 1
+
+		placed.append((key, np.array(keep, dtype=int).reshape(-1, 2)))
+
+	return placed, suppressed
+
+def OverlapRatio(p: tuple[int, int], q: tuple[int, int], size: int) -> float:
+	"""
+		中心が p, q にある一辺 size の正方形どうしが重なる面積の割合（0 〜 1）。
+		p, q: 中心のピクセル座標
+		size: 正方形の一辺
+	"""
+	w = max(size - abs(p[0] - q[0]), 0)
+	h = max(size - abs(p[1] - q[1]), 0)
+	return (w * h) / (size * size)
+
+def ResizeIcon(img: cv2.typing.MatLike, zoom: float) -> cv2.typing.MatLike:
+	"""
+		アイコン画像を拡大縮小する。縮小時は INTER_AREA を使いエイリアシングを抑える。
+		img: アイコン画像
+		zoom: 倍率
+	"""
+	interpolation = cv2.INTER_AREA if zoom < 1.0 else cv2.INTER_LINEAR
+	return cv2.resize(img, dsize=None, fx=zoom, fy=zoom, interpolation=interpolation)
+
 def alpha_blend(img_base: cv2.typing.MatLike, img_add: cv2.typing.MatLike, x: int, y: int) -> None:
 	"""
 		参考 : https://qiita.com/smatsumt/items/923aefb052f217f2f3c5
@@ -476,32 +740,191 @@ def alpha_blend(img_base: cv2.typing.MatLike, img_add: cv2.typing.MatLike, x: in
 		img_base[y0:y1, x0:x1] * (1 - img_add[ay0:ay1, ax0:ax1, 3:] / 255) + \
 		img_add[ay0:ay1, ax0:ax1, :3] * (img_add[ay0:ay1, ax0:ax1, 3:] / 255)
 
-def csv2tuple(csv: str) -> tuple:
-	return tuple(map(float, csv.split(",")))
+# 出力形式 -> 拡張子
+ENCODE_EXT: dict = { "png": "png", "jpeg": "jpg", "webp": "webp" }
+
+# PNG 圧縮の方針（zlib strategy）
+PNG_STRATEGY: dict = {
+	"default":  cv2.IMWRITE_PNG_STRATEGY_DEFAULT,
+	"filtered": cv2.IMWRITE_PNG_STRATEGY_FILTERED,
+	"huffman":  cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY,
+	"rle":      cv2.IMWRITE_PNG_STRATEGY_RLE,
+	"fixed":    cv2.IMWRITE_PNG_STRATEGY_FIXED,
+}
+
+def EncodeImage(img: cv2.typing.MatLike, outpath: str, encinfo: dict) -> EncodedImage:
+	"""
+		画像をエンコードし、ファイルに保存する。
+		img: 画像（BGR）
+		outpath: 保存先
+		encinfo: エンコード設定（config.json の render.encode）
+	"""
+	start = time.perf_counter()
+
+	match encinfo["format"]:
+		case "png" if encinfo["palette"] > 0:
+			# 地図は少数の平坦な色で構成されるので、パレット化すると大きく縮む
+			from PIL import Image
+			pimg = Image.fromarray(img[:, :, ::-1]).quantize(colors=encinfo["palette"], method=Image.Quantize.FASTOCTREE)
+			buf = io.BytesIO()
+			pimg.save(buf, "PNG", compress_level=encinfo["png_compression"])
+			data = buf.getvalue()
+		case "png":
+			params = [
+				cv2.IMWRITE_PNG_COMPRESSION, encinfo["png_compression"],
+				cv2.IMWRITE_PNG_STRATEGY, PNG_STRATEGY[encinfo["png_strategy"]]
+			]
+			data = cv2.imencode(".png", img, params)[1].tobytes()
+		case "jpeg":
+			data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, encinfo["quality"]])[1].tobytes()
+		case "webp":
+			data = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, encinfo["quality"]])[1].tobytes()
+		case _:
+			raise ValueError(f"Unknown image format: {encinfo["format"]}")
+
+	with open(outpath, "wb") as f:
+		f.write(data)
+
+	return EncodedImage(outpath, data, time.perf_counter() - start, len(data))
 
 ### funcdef END ###
 
-from sys import argv 
+### batch BEGIN ###
 
-if __name__ == "__main__":
-	if len(argv) >= 2:
-		path = argv[1]
+# 電文の InfoKind -> 描画クラス（一括描画で電文の種別を判定するのに使う）
+BATCH_PLOTTERS: dict[str, type] = {
+	"震度速報": EQPlotter_VXSE51,
+	"地震情報": EQPlotter_VXSE53,
+}
+_INFOKIND_PATTERN = re.compile(r"<InfoKind>\s*(.*?)\s*</InfoKind>")
+
+# ワーカプロセスごとの設定情報（BatchInit で設定する）
+_batch_conf: dict = None
+
+def ExpandInputs(patterns: list[str]) -> list[str]:
+	"""
+		ディレクトリ（配下の *.xml を再帰的に探す）、glob パターン、ファイル名を展開し、重複を除いて並べ替えたリストを返す。
+		patterns: コマンドラインで指定された入力
+	"""
+	paths = set()
+	for p in patterns:
+		if os.path.isdir(p):
+			paths.update(glob.glob(os.path.join(p, "**", "*.xml"), recursive=True))
+		elif glob.has_magic(p):
+			paths.update(glob.glob(p, recursive=True))
+		else:
+			paths.add(p)
+
+	return sorted(os.path.abspath(p) for p in paths if os.path.isfile(p))
+
+def BatchInit(conf: dict) -> None:
+	"""
+		ワーカプロセスの初期化。地図データを読み込んでおき、以降の描画ではキャッシュ（LoadCached）を使い回す。
+		conf: config.json からの設定情報
+	"""
+	global _batch_conf
+	_batch_conf = conf
+
+	LoadAssistant(conf["paths"]["assistant_npz"])
+	if conf["render"]["engine"] != "matplotlib":
+		LoadRenderer(conf)
+	if conf["render"]["intensity_mode"] == "fill":
+		LoadLabelRaster(conf["paths"]["labelmap"])
+	elif conf["render"]["intensity_mode"] == "city":
+		LoadCityIndex(conf["paths"]["citymap"])
+
+def BatchRender(path: str) -> tuple[str, str, str]:
+	"""
+		電文 1 件の種別を判定して描画し、(入力, 結果, 詳細) を返す。結果は "ok" / "skip" / "error" のいずれか。
+		出力ファイル名は入力ファイル名の拡張子を除いたものとする。
+		path: 電文（XML）のパス
+	"""
+	conf = _batch_conf
+	try:
+		name = os.path.splitext(os.path.basename(path))[0]
+		ext  = ENCODE_EXT[conf["render"]["encode"]["format"]]
+		outpath = os.path.join(conf["paths"]["output"], f"{name}.{ext}")
+		if os.path.isfile(outpath): return (path, "skip", outpath)
 
-		with open("./config.json", "r", encoding="utf-8") as f:
-			conf = json.load(f)
-		
 		with open(path, "r", encoding="utf-8") as f:
 			xml = f.read()
-		
-		output_path = conf["paths"]["output"]
 
-		if not os.path.isdir(output_path):
-			print(f"{output_path} is not found. Now Making...")
-			os.mkdir(output_path)
-		
-		eqp = EQPlotter_VXSE53(conf)
+		m = _INFOKIND_PATTERN.search(xml)
+		cls = BATCH_PLOTTERS.get(m.group(1)) if m else None
+		if cls is None: return (path, "skip", "対象外の電文")
+
+		eqp = cls(conf)
 		eqp.ParseXML(xml)
-		print(eqp.GetMessage())
-		eqp.DrawMap("3" if conf["eqlevel"][eqp.max_int] >= 3 else 1)
-	else:
-		print("USAGE>python report.py [path_to_xml]")
+		if eqp.eq_time is None: return (path, "skip", "電文を解析できませんでした")
+
+		eqp.output_name = name
+		image = eqp.DrawMap("3" if conf["eqlevel"][eqp.max_int] >= 3 else "1").result()
+		return (path, "ok", image.path)
+	except Exception as e:
+		return (path, "error", f"{type(e).__name__}: {e}")
+
+def BatchMain(args: argparse.Namespace) -> None:
+	"""
+		電文を一括で描画する。描画はプロセスプールに分散し、完了した入力は進捗ファイルに記録する。
+		同じ進捗ファイルを指定して再実行すると、完了済みの入力を読み飛ばして続きから描画する。
+		args: コマンドライン引数
+	"""
+	with open(args.config, "r", encoding="utf-8") as f:
+		conf = json.load(f)
+
+	if args.output is not None:
+		conf["paths"]["output"] = args.output
+	output_path = conf["paths"]["output"]
+
+	if not os.path.isdir(output_path):
+		print(f"{output_path} is not found. Now Making...")
+		os.makedirs(output_path)
+
+	progress_path = args.progress or os.path.join(output_path, "batch_progress.txt")
+	done = set()
+	if os.path.isfile(progress_path) and not args.force:
+		with open(progress_path, "r", encoding="utf-8") as f:
+			done = set(l.rstrip("\n") for l in f)
+
+	paths = [p for p in ExpandInputs(args.inputs) if p not in done]
+	if args.force:
+		# 出力済みの画像も描き直す
+		ext = ENCODE_EXT[conf["render"]["encode"]["format"]]
+		for p in paths:
+			outpath = os.path.join(output_path, f"{os.path.splitext(os.path.basename(p))[0]}.{ext}")
+			if os.path.isfile(outpath): os.remove(outpath)
+
+	print(f"{len(paths)} files ({len(done)} already done)")
+	count = Counter()
+	start = time.perf_counter()
+
+	with ProcessPoolExecutor(max_workers=args.jobs or None, initializer=BatchInit, initargs=(conf,)) as pool,\
+		 open(progress_path, "a", encoding="utf-8") as progress:
+		futures = [pool.submit(BatchRender, p) for p in paths]
+		for i, fut in enumerate(as_completed(futures), 1):
+			path, result, detail = fut.result()
+			count[result] += 1
+			print(f"[{i}/{len(paths)}] {result}: {path} -> {detail}")
+
+			# 失敗したものは再実行時にもう一度描画する
+			if result != "error":
+				progress.write(path + "\n")
+				progress.flush()
+
+	elapsed = time.perf_counter() - start
+	print(
+		f"rendered {count['ok']}, skipped {count['skip']}, failed {count['error']} in {elapsed:.1f} s" +\
+		f" ({count['ok'] / elapsed if elapsed > 0 else 0:.2f} maps/s)"
+	)
+
+### batch END ###
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="JMAEQ I-Maplot 震度地図の描画（一括描画）")
+	parser.add_argument("inputs", nargs="+", help="電文（XML）のファイル、ディレクトリ、または glob パターン")
+	parser.add_argument("-o", "--output", help="画像の出力先（既定は config.json の paths.output）")
+	parser.add_argument("-j", "--jobs", type=int, default=0, help="描画に使うプロセス数（既定は CPU 数）")
+	parser.add_argument("-c", "--config", default="./config.json", help="設定ファイルのパス")
+	parser.add_argument("--progress", help="進捗ファイルのパス（既定は出力先の batch_progress.txt）")
+	parser.add_argument("--force", action="store_true", help="進捗と出力済みの画像を無視してすべて描き直す")
+	BatchMain(parser.parse_args())
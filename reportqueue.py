@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# 解析済みで描画・投稿を待っている電文の待ち行列
+
+import time
+import threading
+import dataclasses
+from collections import OrderedDict
+
+import log
+
+### class PendingReport BEGIN ###
+
+@dataclasses.dataclass
+class PendingReport:
+	""" 解析済みで、描画・投稿を待っている電文 """
+	name: str			# 投稿文に使う情報の名称
+	entry: object		# main.EntryData
+	plotter: object		# 解析済みの EQPlotter
+	code: str			# 電文コード（VXSE51 など）
+	max_int: str		# 最大震度（描画後は plotter を解放するので、入れた時点で控えておく）
+	event_id: str		# 地震の識別子（EventID）。同じ地震の電文は発表順に処理する
+	priority: float		# 基本の優先度（震度の階級 + 電文の種別による加点）
+	enqueued: float		# 待ち行列に入れた時刻（time.monotonic）
+	superseded: list = dataclasses.field(default_factory=list)	# 取り出し時に、この電文により不要になった（省略する）電文
+	image: object = None		# 描画済みの画像（report.EncodedImage を返す Future）。未描画なら None
+	message: str = None			# 描画時に作成した情報文
+	content_hash: str = None	# 電文の内容ハッシュ（feedctl.ContentHash）。処理済みとして記録するときに使う
+
+### class PendingReport END ###
+
+### class ReportQueue BEGIN ###
+
+class ReportQueue:
+	"""
+		描画・投稿を待っている電文の待ち行列。優先度の高い地震の電文から取り出す。
+		優先度は 震度の階級（eqlevel[max_int]）+ 電文の種別による加点 + 待ち時間による加点 とし、
+		待ち時間による加点で、小さい地震の電文がいつまでも後回しにされることを防ぐ。
+		同じ地震（EventID）の電文は、その中で最も優先度の高いものに合わせて、発表順に取り出す。
+		同じ地震・同じ種別の電文が複数待っている場合は、方針（xmlfeed.coalesce）に従って古い報を省略する。
+			"latest":     最新の報だけを投稿する
+			"first_last": 最初の報と最新の報だけを投稿する（最初の報を投稿済みなら最新の報だけ）
+			"none":       省略しない
+		解析済みの電文は max_pending 件までとし、それを超える電文は取得・解析せずにエントリのまま後回しにする（Defer）。
+		待ち行列は数件程度にしかならないので、取り出しのたびに全件から選ぶ。
+	"""
+	# 投稿済みの (地震の識別子, 電文コード) を覚えておく数
+	posted_max: int = 256
+
+	def __init__(self, config: dict) -> None:
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		self.LoadConfig(config)
+
+		self.__items: list[PendingReport] = []
+		self.__deferred: OrderedDict[str, object] = OrderedDict()	# エントリ ID -> main.EntryData
+		self.__posted: OrderedDict[tuple[str, str], None] = OrderedDict()
+		self.__lock = threading.Lock()
+
+	def LoadConfig(self, config: dict) -> None:
+		prioinfo: dict = config["xmlfeed"]["priority"]
+		self.eqlevel: dict			= config["eqlevel"]
+		self.report_weight: dict	= prioinfo["report"]
+		self.aging_sec: float		= prioinfo["aging_sec"]
+		self.recheck_sec: float		= prioinfo["recheck_sec"]
+		self.max_pending: int		= prioinfo["max_pending"]
+		self.coalesce: str			= config["xmlfeed"]["coalesce"]
+
+	def __len__(self) -> int:
+		return len(self.__items)
+
+	def Contains(self, entry_id: str) -> bool:
+		""" エントリが待ち行列に入っているかどうか """
+		with self.__lock:
+			return any(r.entry.id == entry_id for r in self.__items)
+
+	def IsFull(self) -> bool:
+		""" 解析済みの電文が max_pending 件に達しているかどうか """
+		return len(self.__items) >= self.max_pending
+
+	def Defer(self, entries: list) -> None:
+		"""
+			待ち行列がいっぱいのため取得・解析しなかったエントリを、後で取り込むために覚えておく。
+			entries: main.EntryData のリスト
+		"""
+		with self.__lock:
+			for e in entries:
+				self.__deferred[e.id] = e
+
+	def HasDeferred(self) -> bool:
+		""" 後回しにしたエントリがあるかどうか """
+		return len(self.__deferred) > 0
+
+	def TakeDeferred(self) -> list:
+		""" 後回しにしたエントリをすべて取り出す。 """
+		with self.__lock:
+			entries = list(self.__deferred.values())
+			self.__deferred.clear()
+		return entries
+
+	def Discard(self, predicate) -> list[PendingReport]:
+		"""
+			条件に合う電文を待ち行列から除き、除いた電文を返す。
+			predicate: PendingReport を受け取り、除く場合に True を返す関数
+		"""
+		kept, removed = [], []
+		with self.__lock:
+			for r in self.__items:
+				(removed if predicate(r) else kept).append(r)
+			self.__items = kept
+		return removed
+
+	def Unrendered(self) -> list[PendingReport]:
+		""" まだ描画していない電文（優先度の高い順） """
+		now = time.monotonic()
+		with self.__lock:
+			return sorted((r for r in self.__items if r.image is None), key=lambda r: -self.Effective(r, now))
+
+	def Push(self, name: str, entry, plotter, code: str, content_hash: str = None) -> PendingReport:
+		"""
+			解析済みの電文を待ち行列に入れる。
+			name:    投稿文に使う情報の名称
+			entry:   main.EntryData
+			plotter: 解析済みの EQPlotter
+			code:    電文コード（VXSE51 など）
+			content_hash: 電文の内容ハッシュ（feedctl.ContentHash）
+		"""
+		priority = self.eqlevel.get(plotter.max_int, -1) + self.report_weight.get(code, 0)
+		item = PendingReport(
+			name, entry, plotter, code, plotter.max_int,
+			getattr(plotter, "event_id", None) or entry.id,
+			priority, time.monotonic(), content_hash=content_hash
+		)
+
+		with self.__lock:
+			self.__items.append(item)
+		return item
+
+	def Restore(self, items: list[PendingReport]) -> None:
+		"""
+			取り出したときに省略した電文を待ち行列に戻す（それを省略させた電文を投稿できなかった場合）。
+			items: 戻す電文
+		"""
+		with self.__lock:
+			self.__items += items
+
+	def Pop(self) -> PendingReport | None:
+		"""
+			次に描画・投稿する電文を取り出す。待ち行列が空なら None を返す。
+			省略した電文は待ち行列から除き、取り出した電文の superseded に入れて返す。
+		"""
+		now = time.monotonic()
+		with self.__lock:
+			if len(self.__items) == 0: return None
+
+			# 最も優先度の高い電文（同じ優先度なら発表の早いもの）を含む地震を選び、その地震の最も古い電文を取り出す
+			best = max(self.__items, key=lambda r: (self.Effective(r, now), -r.entry.updated_time.timestamp()))
+			item = min((r for r in self.__items if r.event_id == best.event_id), key=lambda r: r.entry.updated_time)
+
+			# 同じ地震・同じ種別の電文のうち、新しい報により不要になったものを省く
+			group = sorted(
+				(r for r in self.__items if r.event_id == item.event_id and r.code == item.code),
+				key=lambda r: r.entry.updated_time
+			)
+			item, superseded = self.__Coalesce(group)
+
+			# 失敗しうる処理は待ち行列から除く前に済ませる
+			taken = { id(r) for r in [item] + superseded }
+			rest = [r for r in self.__items if id(r) not in taken]
+			oldest = min(rest, key=lambda r: r.entry.updated_time, default=None)
+			jumped = oldest is not None and oldest.entry.updated_time < item.entry.updated_time
+
+			item.superseded = superseded
+			self.__items = rest
+
+			key = (item.event_id, item.code)
+			self.__posted[key] = None
+			self.__posted.move_to_end(key)
+			while len(self.__posted) > self.posted_max:
+				self.__posted.popitem(last=False)
+
+		if jumped:
+			self.logger.info(f"優先度の高い電文を先に処理します：{item.name}（最大震度 {item.max_int}）。待ち {len(rest)} 件")
+		return item
+
+	def __Coalesce(self, group: list[PendingReport]) -> tuple[PendingReport, list[PendingReport]]:
+		"""
+			同じ地震・同じ種別の電文（発表順）から、今回投稿するものと省略するものを選ぶ。
+			group: 同じ地震・同じ種別の電文。1 件以上あり、発表順に並んでいること
+		"""
+		if self.coalesce == "none" or len(group) == 1:
+			return (group[0], [])
+
+		# 最初の報が未投稿なら最初の報を投稿し、途中の報を省く（最新の報は待ち行列に残す）
+		posted = (group[0].event_id, group[0].code) in self.__posted
+		if self.coalesce == "first_last" and not posted:
+			return (group[0], group[1:-1])
+
+		return (group[-1], group[:-1])
+
+	def Effective(self, item: PendingReport, now: float) -> float:
+		""" 待ち時間による加点を含めた優先度 """
+		return item.priority + (now - item.enqueued) / self.aging_sec
+
+### class ReportQueue END ###
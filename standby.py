@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# 複数の I-Maplot を同時に動かす場合（ホットスタンバイ）の主系の選出と、FeedControl の共有
+
+import os
+import json
+import time
+import pickle
+import socket
+import secrets
+import threading
+import contextlib
+import traceback
+
+import log
+
+# fcntl は Unix 系にしかない。Windows では msvcrt でロックする
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+	import msvcrt
+
+@contextlib.contextmanager
+def FileLock(path: str):
+	"""
+		ファイルによる排他ロック。同じファイルをロックするプロセス（同じホスト、または共有ファイルシステム上）の間で排他する。
+		path: ロックに使うファイル（なければ作成する）
+	"""
+	with open(path, "a+b") as f:
+		if fcntl is not None:
+			fcntl.flock(f, fcntl.LOCK_EX)
+		else:
+			f.seek(0)
+			msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(f, fcntl.LOCK_UN)
+			else:
+				f.seek(0)
+				msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+### class LeaderLease BEGIN ###
+
+class LeaderLease:
+	"""
+		主系の権利（リース）を管理する。リースを持つ系（主系）だけが投稿し、他の系（待機系）は取得・描画までを行って待機する。
+		リースはファイル（paths.lease）に持ち主と期限を書いて表し、主系は lease_sec / 3 秒おきに期限を延ばす。
+		主系が停止して期限が切れると、待機系のいずれかがリースを取得して主系になり、直ちにフィードを取得・投稿する。
+		FeedControl（処理済み索引など）は同じロックの下で共有のファイル（paths.feedctl）に保存し、主系だけが書き込む。
+		保存時にリースを持っているかを確認するので、リースを失った系が投稿することはない。
+		standby.enabled が false の場合は常に主系として動き、FeedControl をそのまま保存する。
+	"""
+	def __init__(self, config: dict) -> None:
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		sbinfo: dict = config["standby"]
+		self.enabled: bool		= sbinfo["enabled"]
+		self.path: str			= config["paths"]["lease"]
+		self.lock_path: str		= self.path + ".lock"
+		self.instance: str		= sbinfo["instance"] or f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+		self.leader: bool		= not self.enabled
+		self.expires: float		= float("inf") if not self.enabled else 0.0	# 自分のリースの期限（time.time）
+		self.__stop = threading.Event()
+		self.__thread: threading.Thread = None
+		self.LoadConfig(config)
+
+	def LoadConfig(self, config: dict) -> None:
+		""" リースの期間は次の延長から反映する。有効・無効、リースのファイル、系の名前の変更は再起動するまで反映されない。 """
+		self.lease_sec: float = config["standby"]["lease_sec"]
+
+	def IsLeader(self) -> bool:
+		""" 主系であり、リースの期限内であるかどうか """
+		return self.leader and time.time() < self.expires
+
+	def Role(self) -> str:
+		""" alive の応答用の表示 """
+		if not self.enabled: return "single"
+		return ("leader" if self.IsLeader() else "standby") + f" ({self.instance})"
+
+	def Renew(self) -> bool:
+		""" リースを延長する（持ち主がいないか期限が切れていれば取得する）。主系かどうかを返す。 """
+		if not self.enabled: return True
+
+		was_leader = self.leader
+		now = time.time()
+		with FileLock(self.lock_path):
+			record = self.__Read()
+			if record.get("holder") in (None, self.instance) or record.get("expires", 0) <= now:
+				self.expires = now + self.lease_sec
+				self.__Write({ "holder": self.instance, "expires": self.expires })
+				self.leader = True
+			else:
+				self.leader = False
+
+		if self.leader and not was_leader:
+			self.logger.warning(f"主系になりました（{self.instance}）")
+		elif was_leader and not self.leader:
+			self.logger.warning(f"主系の権利を失いました。待機系として動作します（主系：{record.get('holder')}）")
+		return self.leader
+
+	def Start(self, on_promoted) -> None:
+		"""
+			リースの延長（待機系なら取得の試行）を別スレッドで定期的に行う。
+			on_promoted: 待機系から主系になったときに呼び出す関数（Scheduler.trigger）
+		"""
+		if not self.enabled: return
+
+		def run() -> None:
+			while not self.__stop.wait(self.lease_sec / 3):
+				try:
+					was_leader = self.leader
+					if self.Renew() and not was_leader: on_promoted()
+				except Exception:
+					self.logger.error(traceback.format_exc())
+
+		self.__thread = threading.Thread(target=run, name="LeaderLease", daemon=True)
+		self.__thread.start()
+
+	def Stop(self) -> None:
+		""" リースの延長を止め、主系であればリースを手放す（待機系が直ちに主系になれるようにする）。 """
+		if not self.enabled: return
+
+		self.__stop.set()
+		if self.__thread is not None: self.__thread.join()
+
+		with FileLock(self.lock_path):
+			if self.__Read().get("holder") == self.instance:
+				self.__Write({ "holder": None, "expires": 0 })
+		self.leader = False
+
+	def Load(self, feedctl) -> None:
+		"""
+			共有の FeedControl から、主系が記録した処理済み索引・最新の地震情報を取り込む。
+			フィードごとの取得状況は系ごとに持つので取り込まない。
+			feedctl: 取り込み先の FeedControl
+		"""
+		if not self.enabled: return
+
+		try:
+			with FileLock(self.lock_path):
+				with open(feedctl.pkl_path, "rb") as f:
+					shared = pickle.load(f)
+		except FileNotFoundError:
+			return
+
+		feedctl.seen	= shared.seen
+		feedctl.last_eq	= shared.last_eq
+		feedctl.last_msg = shared.last_msg
+
+	def Save(self, feedctl) -> bool:
+		"""
+			主系であれば FeedControl を共有のファイルに保存する。保存した場合は True を返す。
+			feedctl: 保存する FeedControl
+		"""
+		if not self.enabled:
+			feedctl.PickleMyself()
+			return True
+
+		with FileLock(self.lock_path):
+			record = self.__Read()
+			if record.get("holder") != self.instance or record.get("expires", 0) <= time.time():
+				self.leader = False
+				return False
+
+			# 読み取り側が書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+			with open(feedctl.pkl_path + ".tmp", "wb") as f:
+				pickle.dump(feedctl, f)
+			os.replace(feedctl.pkl_path + ".tmp", feedctl.pkl_path)
+		return True
+
+	def StandbyOutput(self, output: str) -> str:
+		"""
+			待機系が描画した画像の出力先（系ごとのフォルダ）を返す。主系の出力（paths.output）や他の系の出力を上書きしないようにする。
+			output: 主系の出力先（paths.output）
+		"""
+		path = os.path.join(output, "standby", "".join(c if c.isalnum() or c in "-_." else "_" for c in self.instance))
+		os.makedirs(path, exist_ok=True)
+		return path
+
+	def Locked(self):
+		""" 共有の FeedControl を読み書きするときのロック """
+		return FileLock(self.lock_path) if self.enabled else contextlib.nullcontext()
+
+	def __Read(self) -> dict:
+		try:
+			with open(self.path, "r", encoding="utf-8") as f:
+				return json.load(f)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return {}
+
+	def __Write(self, record: dict) -> None:
+		with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+			json.dump(record, f)
+		os.replace(self.path + ".tmp", self.path)
+
+### class LeaderLease END ###
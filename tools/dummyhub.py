@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Location: /tools
+# WebSub のハブの代わり（動作確認用）。購読の申し込みを受け付けて購読確認を行い、フィードの更新通知を署名付きで送る。
+# config.json の websub.hub を http://127.0.0.1:<port>/ に、websub.callback_url を受信側の URL にして main.py を起動する。
+# 通知は Enter キーを押すたび、または --interval 秒おきに送る。
+
+import sys
+import hmac
+import time
+import hashlib
+import secrets
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import urlencode, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# callback -> (topic, secret)
+subscribers: dict[str, tuple[str, str]] = {}
+lock = threading.Lock()
+
+def VerifyIntent(callback: str, mode: str, topic: str, lease: str, verify_token: str) -> bool:
+	""" 購読者に購読確認を行い、hub.challenge がそのまま返ってくれば True """
+	challenge = secrets.token_hex(16)
+	query = { "hub.mode": mode, "hub.topic": topic, "hub.challenge": challenge, "hub.lease_seconds": lease }
+	if verify_token: query["hub.verify_token"] = verify_token
+
+	try:
+		with urllib.request.urlopen(callback + ("&" if "?" in callback else "?") + urlencode(query), timeout=10) as r:
+			return r.status == 200 and r.read().decode("utf-8") == challenge
+	except (urllib.error.URLError, OSError) as e:
+		print(f"verification failed: {callback} ({e})")
+		return False
+
+class HubHandler(BaseHTTPRequestHandler):
+	def do_POST(self) -> None:
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+		form = { k: v[0] for k, v in parse_qs(body).items() }
+		mode, callback, topic = form.get("hub.mode"), form.get("hub.callback"), form.get("hub.topic")
+		if mode not in ("subscribe", "unsubscribe") or not callback or not topic:
+			self.send_error(400)
+			return
+
+		self.send_response(202)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+		# 購読確認は申し込みへの応答の後に行う（非同期の確認）
+		def verify() -> None:
+			if not VerifyIntent(callback, mode, topic, form.get("hub.lease_seconds", ""), form.get("hub.verify_token", "")): return
+			with lock:
+				if mode == "subscribe":
+					subscribers[callback] = (topic, form.get("hub.secret", ""))
+				else:
+					subscribers.pop(callback, None)
+			print(f"{mode}d: {callback} ({topic})")
+		threading.Thread(target=verify, daemon=True).start()
+
+	def log_message(self, format: str, *args) -> None:
+		pass
+
+def Publish(feed: bytes, method: str) -> None:
+	""" 全購読者に更新通知を送る """
+	with lock:
+		targets = list(subscribers.items())
+	if len(targets) == 0:
+		print("no subscribers")
+		return
+
+	for callback, (topic, secret) in targets:
+		headers = { "Content-Type": "application/atom+xml", "Link": f'<{topic}>; rel="self"' }
+		if secret:
+			digest = hmac.new(secret.encode("utf-8"), feed, getattr(hashlib, method)).hexdigest()
+			headers["X-Hub-Signature"] = f"{method}={digest}"
+
+		start = time.perf_counter()
+		try:
+			with urllib.request.urlopen(urllib.request.Request(callback, data=feed, headers=headers), timeout=10) as r:
+				print(f"notified: {callback} -> {r.status} ({(time.perf_counter() - start) * 1000:.1f} ms)")
+		except (urllib.error.URLError, OSError) as e:
+			print(f"notify failed: {callback} ({e})")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="JMAEQ I-Maplot WebSub ハブの代わり（動作確認用）")
+	parser.add_argument("feed", help="通知の本文として送るフィード（Atom）のファイル")
+	parser.add_argument("-p", "--port", type=int, default=18767, help="購読の申し込みを受け付けるポート")
+	parser.add_argument("-i", "--interval", type=float, default=0, help="通知を送る間隔 [秒]。0 なら Enter キーを押すたびに送る")
+	parser.add_argument("--method", default="sha256", choices=["sha1", "sha256", "sha384", "sha512"], help="署名の方式")
+	parser.add_argument("--callback", help="購読の申し込みを待たずに通知先に加える購読者の URL")
+	parser.add_argument("--topic", default="", help="--callback の購読者のトピック")
+	parser.add_argument("--secret", default="", help="--callback の購読者の署名用の鍵")
+	args = parser.parse_args()
+
+	with open(args.feed, "rb") as f:
+		feed = f.read()
+	if args.callback:
+		subscribers[args.callback] = (args.topic, args.secret)
+
+	server = ThreadingHTTPServer(("127.0.0.1", args.port), HubHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	print(f"hub listening on http://127.0.0.1:{args.port}/")
+
+	try:
+		while True:
+			if args.interval > 0:
+				time.sleep(args.interval)
+			elif sys.stdin.readline() == "":
+				break
+			Publish(feed, args.method)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.shutdown()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Location: /tools
+# main.py の読み込みにかかる時間を python -X importtime で計測し、重いモジュールを一覧表示する。
+# デプロイ後にこれを実行し、起動から初回ポーリングまでの時間が延びていないか確認する。
+
+import re
+import sys
+import argparse
+import subprocess
+
+# 起動時に読み込まれていてはならない（初回描画時まで遅延させる）モジュール
+HEAVY_MODULES = ("cv2", "matplotlib", "numpy", "pandas", "geopandas", "shapely", "tweepy", "twitter_text")
+
+def MeasureImportTime(module: str) -> list[tuple[int, int, str]]:
+	"""
+		module を読み込む子プロセスを -X importtime 付きで起動し、(self [us], cumulative [us], モジュール名) のリストを返す。
+		module: 読み込むモジュール名
+	"""
+	proc = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", f"import {module}"],
+		capture_output=True, text=True
+	)
+	if proc.returncode != 0:
+		raise RuntimeError(proc.stderr)
+
+	ls = []
+	for line in proc.stderr.splitlines():
+		m = re.match(r"import time:\s*(\d+) \|\s*(\d+) \|(\s*)(\S+)", line)
+		if m is None: continue
+		ls.append((int(m.group(1)), int(m.group(2)), m.group(4)))
+	return ls
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="JMAEQ I-Maplot 起動時間計測用プログラム")
+	parser.add_argument("-m", "--module", default="main", help="計測するモジュール（既定: main）")
+	parser.add_argument("-n", "--top", type=int, default=15, help="表示する件数")
+	parser.add_argument("-b", "--budget-ms", type=float, default=0, help="読み込み時間の上限 [ms]。超えた場合は終了コード 1")
+	args = parser.parse_args()
+
+	try:
+		ls = MeasureImportTime(args.module)
+	except RuntimeError as e:
+		print(f"ERROR:{e}")
+		exit(1)
+
+	total = max((c for _, c, name in ls if name == args.module), default=0)
+	print(f"import {args.module}: {total / 1000:.1f} ms")
+	print(f"{"cumulative [ms]":>16} {"self [ms]":>10}  module")
+	for s, c, name in sorted(ls, key=lambda x: x[1], reverse=True)[:args.top]:
+		print(f"{c / 1000:16.1f} {s / 1000:10.1f}  {name}")
+
+	heavy = sorted({name.split(".")[0] for _, _, name in ls} & set(HEAVY_MODULES))
+	if len(heavy) > 0:
+		print(f"WARNING: 起動時に重いモジュールが読み込まれています: {", ".join(heavy)}")
+
+	if args.budget_ms > 0 and total / 1000 > args.budget_ms:
+		print(f"ERROR: 読み込み時間が上限 {args.budget_ms} ms を超えています")
+		exit(1)
@@ -1,12 +1,24 @@
 # coding: utf-8
-from shapely.geometry import Polygon, MultiPolygon, Point
+from shapely.geometry import Polygon, MultiPolygon
 from pandas import DataFrame
+from concurrent.futures import ProcessPoolExecutor
 
 from matplotlib.axes import Axes
+from matplotlib.colors import to_rgb
 import matplotlib.pyplot as plt
 import geopandas as gpd
+import numpy as np
+import cv2
+import shapely
+import hashlib
 import pickle
 import json
+import glob
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from raster import BaseMapRenderer, BaseRasterMetaPath
 
 def SelectLargestPolygon(geometry: Polygon | MultiPolygon):
 	polygon = list(geometry)[0]
@@ -22,29 +34,41 @@ def SelectLargestPolygon(geometry: Polygon | MultiPolygon):
 			target = Polygon()
 	return target
 
-def DrawPrefecture(df: gpd.GeoDataFrame, preflist: list, ax: Axes=None, edgecolor="None", facecolor="None", linewidth=0):
-	if ax is None: ax = plt.gca()
-
+def DissolvePrefecture(args: tuple) -> tuple:
+	"""
+		1 つの都道府県に属する細分区域を結合し、最大のポリゴンを県の枠線として返す。
+		ProcessPoolExecutor のワーカで実行される。
+		args: (都道府県情報, その都道府県に属する細分区域の GeoDataFrame)
+	"""
+	pl, m = args
+	bound = m.dissolve()
+	return pl, SelectLargestPolygon(bound["geometry"])
+
+def FramePrefectures(df: gpd.GeoDataFrame, preflist: list, workers: int) -> list:
+	"""
+		都道府県ごとの枠線を、プロセスプールで並列に計算する。(都道府県情報, ポリゴン) のリストを返す。
+		df: 細分区域の GeoDataFrame
+		preflist: config.json の pref
+		workers: ワーカ数
+	"""
+	jobs = []
 	for pl in preflist:
 		code = [str(n) for n in range(int(pl["codestart"]), int(pl["codeend"]) + 1)]
 		m = df[df["code"].isin(code)]
 
 		if len(m) > 0:
-			print(f"  Framing {pl["name"]}, {(m.iloc[0])["name"]} - {(m.iloc[-1])["name"]} ...", end="", flush=True)
+			print(f"  Framing {pl["name"]}, {(m.iloc[0])["name"]} - {(m.iloc[-1])["name"]} ...", flush=True)
+			jobs.append((pl, m))
 
-			bound = m.dissolve()
-			bound["geometry"] = SelectLargestPolygon(bound["geometry"])
-			bound.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, linewidth=linewidth)
-			print("done", flush=True)
-	return
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(DissolvePrefecture, jobs))
 
-def Centroid2Point(geometry: DataFrame) -> Point:
-	ctr = list(geometry.centroid.coords)[0]
-	return Point(ctr)
+def DrawPrefecture(outlines: list, ax: Axes=None, edgecolor="None", facecolor="None", linewidth=0):
+	if ax is None: ax = plt.gca()
 
-def Bound2String(geometry: DataFrame) -> str:
-	bounds = geometry.bounds
-	return "{},{},{},{}".format(bounds[0], bounds[1], bounds[2], bounds[3])
+	bound = gpd.GeoSeries([geom for _, geom in outlines])
+	bound.plot(ax=ax, edgecolor=edgecolor, facecolor=facecolor, linewidth=linewidth)
+	return
 
 def AreaCode2RegionName(code, region: list) -> str:
 	c = -1 if code is None else int(code)
@@ -53,9 +77,230 @@ def AreaCode2RegionName(code, region: list) -> str:
 			return r["name"]
 	return ""
 
-def MakeAssistantData(row, region):
-	return row["name"], AreaCode2RegionName(row["code"], region), \
-		Centroid2Point(row["geometry"]), Bound2String(row["geometry"])
+def MakeAssistantData(df: gpd.GeoDataFrame, region: list) -> DataFrame:
+	"""
+		地図描画補助情報（名前、地方名、重心、範囲）を作成する。
+		重心と範囲は shapely のベクトル演算で全区域まとめて計算する。
+		df: 細分区域の GeoDataFrame
+		region: config.json の region
+	"""
+	geoms  = df["geometry"].values
+	bounds = shapely.bounds(geoms)
+
+	assistant = DataFrame()
+	assistant["name"]     = df["name"].values
+	assistant["region"]   = [AreaCode2RegionName(c, region) for c in df["code"]]
+	assistant["centroid"] = shapely.centroid(geoms)
+	assistant["bounds"]   = ["{},{},{},{}".format(*b) for b in bounds]
+	return assistant
+
+def WriteAssistantArrays(path: str, assistant: DataFrame) -> None:
+	"""
+		地図描画補助情報を列指向の .npz 形式で書き出す。
+		実行時（report.py）は pandas / shapely なしで、これを読み込むだけで済む。
+		path: 書き出し先
+		assistant: MakeAssistantData の戻り値
+	"""
+	np.savez(
+		path,
+		name=np.array(assistant["name"], dtype=str),
+		region=np.array(assistant["region"], dtype=str),
+		centroid=shapely.get_coordinates(np.asarray(assistant["centroid"])),
+		bounds=np.array([[float(v) for v in b.split(",")] for b in assistant["bounds"]])
+	)
+
+def WriteCityIndex(path: str, gpd_city: gpd.GeoDataFrame) -> None:
+	"""
+		市町村役場の位置の索引（行政区域コード -> 経度・緯度）を .npz 形式で書き出す。
+		同じ行政区域コードに複数の施設がある場合は、本庁（施設分類 1）を優先する。
+		path: 書き出し先
+		gpd_city: 国土数値情報 P34（市町村役場等及び公的集会施設データ）の GeoDataFrame
+	"""
+	df = DataFrame({
+		"code":  gpd_city["P34_001"].astype(str).str.zfill(5),
+		"branch": gpd_city["P34_002"].astype(str) != "1",
+		"lon":   gpd_city["geometry"].x,
+		"lat":   gpd_city["geometry"].y,
+	})
+	df = df.sort_values(["code", "branch"], kind="stable").drop_duplicates("code")
+
+	np.savez(
+		path,
+		code=np.array(df["code"], dtype=str),
+		lonlat=df[["lon", "lat"]].to_numpy(dtype=float)
+	)
+
+def ColorBGR(color: str) -> np.ndarray:
+	"""
+		matplotlib の色指定を cv2 用の BGR（0 - 255）に変換する。"None" の場合は空の配列を返す。
+		color: 色名など
+	"""
+	if color is None or str(color).lower() == "none":
+		return np.empty(0, dtype=np.uint8)
+	return np.array([round(c * 255) for c in to_rgb(color)][::-1], dtype=np.uint8)
+
+def PolygonArrays(geoms, tolerance: float) -> dict:
+	"""
+		ジオメトリ群を簡略化し、リング単位に分解した座標配列にする（report.py の軽量描画エンジン用）。
+		geoms: ポリゴン／マルチポリゴンの配列
+		tolerance: 簡略化の許容誤差（度）
+	"""
+	geoms = shapely.simplify(np.asarray(geoms), tolerance, preserve_topology=True)
+	polys, owner = shapely.get_parts(geoms, return_index=True)
+	nonempty = ~shapely.is_empty(polys)
+	polys, owner = polys[nonempty], owner[nonempty]
+
+	# ポリゴン -> リング（外周が先頭） -> 座標
+	rings, ring_poly = shapely.get_rings(polys, return_index=True)
+	coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+	ring_offsets = np.concatenate([[0], np.cumsum(np.bincount(coord_ring, minlength=len(rings)))])
+	poly_offsets = np.concatenate([[0], np.cumsum(np.bincount(ring_poly, minlength=len(polys)))])
+
+	return {
+		"coords": coords,
+		"rings": ring_offsets,
+		"polys": poly_offsets,
+		"bbox": shapely.bounds(polys),
+		"owner": owner,	# ポリゴン -> 元のジオメトリの番号
+	}
+
+def WritePolygonArrays(path: str, layers: dict, back: str, tolerance: float) -> None:
+	"""
+		ベース地図の各図層を座標配列として .npz 形式で書き出す。
+		path: 書き出し先
+		layers: 図層名 -> (ジオメトリ群, 塗りつぶし色, 線の色, 線の太さ [pt])
+		back: 背景（海）の色
+		tolerance: 簡略化の許容誤差（度）
+	"""
+	arrays = { "back": ColorBGR(back) }
+	for name, (geoms, face, edge, linewidth) in layers.items():
+		for k, v in PolygonArrays(geoms, tolerance).items():
+			arrays[f"{name}_{k}"] = v
+		arrays[f"{name}_face"] = ColorBGR(face)
+		arrays[f"{name}_edge"] = ColorBGR(edge)
+		arrays[f"{name}_linewidth"] = np.array(linewidth, dtype=float)
+
+	np.savez(path, **arrays)
+
+def WriteLabelRaster(path: str, geoms, grid: dict, tolerance: float) -> None:
+	"""
+		細分区域の番号（geoms の i 番目 -> i + 1、区域外 -> 0）を画素値に持つラスタを .npz 形式で書き出す。
+		区域のポリゴン（area_*）も一緒に書き出し、実行時はそれを出力画像の大きさでラスタ化して、区域ごとの塗りつぶしを 1 回の表引きで行う。
+		path: 書き出し先
+		geoms: 細分区域のジオメトリ群（地図描画補助情報と同じ並び）
+		grid: 格子の設定（config.json の makemap.grid）
+		tolerance: 簡略化の許容誤差（度）
+	"""
+	bounds = np.array(grid["bounds"], dtype=float)
+	res = grid["deg_per_px"]
+	width  = int(np.ceil((bounds[2] - bounds[0]) / res))
+	height = int(np.ceil((bounds[3] - bounds[1]) / res))
+
+	arr = PolygonArrays(geoms, tolerance)
+	scale = 1 << 4	# cv2.fillPoly の shift
+	pts = np.empty(arr["coords"].shape, dtype=np.int32)
+	pts[:, 0] = np.rint((arr["coords"][:, 0] - bounds[0]) / res * scale)
+	pts[:, 1] = np.rint((bounds[3] - arr["coords"][:, 1]) / res * scale)
+
+	labels = np.zeros((height, width), dtype=np.uint16)
+	rings, polys = arr["rings"], arr["polys"]
+	for j in range(len(polys) - 1):
+		poly = [pts[rings[r]:rings[r + 1]] for r in range(polys[j], polys[j + 1])]
+		cv2.fillPoly(labels, poly, int(arr["owner"][j]) + 1, lineType=cv2.LINE_8, shift=4)
+
+	np.savez(
+		path, labels=labels, bounds=bounds, deg_per_px=np.array(res, dtype=float),
+		**{ f"area_{k}": arr[k] for k in ("coords", "rings", "polys", "bbox", "owner") }
+	)
+
+def WriteBaseRaster(path: str, polygons_path: str, grid: dict, baseraster: dict) -> None:
+	"""
+		座標配列（polygons_path）から日本全域のベース地図を描画し、メモリマップで読み込める .npy 形式で書き出す。
+		範囲などの情報は別ファイル（raster.BaseRasterMetaPath）に書き出す。
+		実行中の I-Maplot がメモリマップしているファイルを壊さないよう、一時ファイルに書いてから置き換える。
+		path: 書き出し先
+		polygons_path: 座標配列のパス
+		grid: 格子の範囲の設定（config.json の makemap.grid）。解像度は baseraster の deg_per_px を使う
+		baseraster: config.json の makemap.baseraster
+	"""
+	bounds = np.array(grid["bounds"], dtype=float)
+	res = baseraster["deg_per_px"]
+	width  = int(np.ceil((bounds[2] - bounds[0]) / res))
+	height = int(np.ceil((bounds[3] - bounds[1]) / res))
+	# 格子の大きさに合わせて右端・上端を広げ、1 画素 = res 度ちょうどにする
+	bounds[2] = bounds[0] + width * res
+	bounds[1] = bounds[3] - height * res
+
+	renderer = BaseMapRenderer(polygons_path)
+	img = renderer.Render(bounds.tolist(), width, height, baseraster["px_per_pt"])
+
+	meta_path = BaseRasterMetaPath(path)
+	with open(meta_path + ".tmp", "wb") as f:
+		np.savez(f, bounds=bounds, deg_per_px=np.array(res, dtype=float), back=np.array(renderer.back, dtype=np.uint8))
+	os.replace(meta_path + ".tmp", meta_path)
+
+	with open(path + ".tmp", "wb") as f:
+		np.save(f, np.ascontiguousarray(img))
+	os.replace(path + ".tmp", path)
+
+def SelectLakes(gpd_lake: gpd.GeoDataFrame, n: int = 30) -> gpd.GeoSeries:
+	"""
+		面積上位 n 番目までの湖沼を抜き出し、簡略化して返す。
+		gpd_lake: 湖沼の GeoDataFrame
+		n: 抜き出す数
+	"""
+	# 座標系 JGD2000 (EPSG:4612) -> 正積図法 (EPSG:3410)に変換
+	gpd_lake.crs = "epsg:4612"
+	eap_lake = gpd_lake.to_crs(epsg=3410)	# Equal Area map Projection
+
+	# ジオメトリから面積を抽出し、面積の大きい順にソートし上位 n 位までを取得
+	eap_lake["area"] = eap_lake["geometry"].area
+	df = eap_lake.sort_values("area", ascending=False).head(n)
+
+	# 正積図法で絞り込んだデータを元の座標系のデータにも適用し、さらに簡略化する
+	return gpd_lake[gpd_lake["W09_001"].isin(list(df["W09_001"]))].simplify(0.005)
+
+def HashInputs(shape_paths: list[str], params) -> str:
+	"""
+		ジオメトリ計算の入力（シェープファイル一式の内容と計算に関わる設定）のハッシュ値を計算する。
+		色など描画にしか関わらない設定は含めないので、それらを変えてもキャッシュは有効なまま。
+		shape_paths: シェープファイル（.shp）のパス。同名の .dbf, .shx 等もまとめてハッシュする
+		params: 計算に関わる設定（JSON 化できるもの）
+	"""
+	h = hashlib.sha256()
+	for path in shape_paths:
+		for f in sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + ".*")):
+			with open(f, "rb") as fp:
+				for chunk in iter(lambda: fp.read(1 << 20), b""):
+					h.update(chunk)
+	h.update(json.dumps(params, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+	return h.hexdigest()
+
+def BuildGeometry(areamap_shape_path: str, lake_shape_path: str, pref: list, region: list, workers: int) -> dict:
+	""" シェープファイルを読み込み、描画に必要なジオメトリ一式を計算する。 """
+	print("Reading Shapefiles...", end="", flush=True)
+	gpd_map  = gpd.read_file(areamap_shape_path, encoding="utf-8")
+	gpd_lake = gpd.read_file(lake_shape_path, encoding="utf-8")
+	print("done", flush=True)
+
+	# 湖沼（面積上位30番目まで）
+	print("Selecting lakes...", end="", flush=True)
+	lakes = SelectLakes(gpd_lake, 30)
+	print("done", flush=True)
+
+	# 県の枠線
+	print("Framing Prefectures...", flush=True)
+	outlines = FramePrefectures(gpd_map, pref, workers)
+	print("all done", flush=True)
+
+	print("Extracting assitant data...", end="", flush=True)
+	assistant = MakeAssistantData(gpd_map, region)
+	# EPSG6668 : JGD2011(世界測地系)緯度経度
+	# 気象庁のシェープファイルがおいてあるページに書いてあった。今後変わるかも分からん
+	print("done", flush=True)
+
+	return { "areas": gpd_map, "lakes": lakes, "outlines": outlines, "assistant": assistant }
 
 
 if __name__ == "__main__":
@@ -81,12 +326,24 @@ if __name__ == "__main__":
 		lake_color_face: str	= lake["color"]["face"]
 		lake_color_back: str	= lake["color"]["back"]
 
+		# city data
+		city_shape_path: str	= makemap["city"]["shapefile"]
+
 		# output paths
 		paths: dict			= conf["paths"]
 		areamap_path: str   = paths["areamap"]
 		assistant_path: str = paths["assistant"]
+		assistant_npz_path: str = paths["assistant_npz"]
+		citymap_path: str		= paths["citymap"]
+		polygons_path: str		= paths["polygons"]
+		labelmap_path: str		= paths["labelmap"]
+		grid: dict				= makemap["grid"]
+		baseraster_path: str	= paths["baseraster"]
+		baseraster: dict		= makemap["baseraster"]
 
 		simplify_tolerance: int = makemap["simplify_tolerance"]
+		workers: int			= makemap["workers"] or os.cpu_count()
+		cache_dir: str			= makemap["cache_dir"]
 
 		pref: dict   = conf["pref"]
 		region: dict = conf["region"]
@@ -96,11 +353,25 @@ if __name__ == "__main__":
 
 	print("done", flush=True)
 
-	print("Reading Shapefiles...", end="", flush=True)
-	gpd_map  = gpd.read_file(areamap_shape_path, encoding="utf-8")
-	gpd_lake = gpd.read_file(lake_shape_path, encoding="utf-8")
+	# ジオメトリの計算結果は入力のハッシュ値をキーにキャッシュする
+	print("Hashing inputs...", end="", flush=True)
+	key = HashInputs([areamap_shape_path, lake_shape_path], [pref, region, simplify_tolerance])
+	cache_path = os.path.join(cache_dir, f"geometry_{key[:16]}.pkl")
 	print("done", flush=True)
 
+	try:
+		with open(cache_path, "rb") as f:
+			geometry = pickle.load(f)
+		print(f"Geometry loaded from cache {cache_path}", flush=True)
+	except FileNotFoundError:
+		geometry = BuildGeometry(areamap_shape_path, lake_shape_path, pref, region, workers)
+
+		print(f"Writing geometry cache to {cache_path}...", end="", flush=True)
+		os.makedirs(cache_dir, exist_ok=True)
+		with open(cache_path, "wb") as f:
+			pickle.dump(geometry, f)
+		print("done", flush=True)
+
 	fig = plt.figure()
 	ax  = fig.add_subplot()
 	ax.set_facecolor(areamap_color_back)
@@ -108,38 +379,26 @@ if __name__ == "__main__":
 
 	# 細分区域の描画
 	print("Ploting each area...", end="", flush=True)
-	gpd_map.plot(ax=ax, edgecolor=areamap_color_edge, facecolor=areamap_color_face, linewidth=0.5)
+	geometry["areas"].plot(ax=ax, edgecolor=areamap_color_edge, facecolor=areamap_color_face, linewidth=0.5)
 	print("done", flush=True)
 
 
 	# 湖沼の描画（面積上位30番目まで）
-	# 座標系 JGD2000 (EPSG:4612) -> 正積図法 (EPSG:3410)に変換
 	print("Ploting lakes...", end="", flush=True)
-
-	gpd_lake.crs = "epsg:4612"
-	eap_lake = gpd_lake.to_crs(epsg=3410)	# Equal Area map Projection
-
-	# ジオメトリから面積を抽出し、面積の大きい順にソートし上位30位までを取得
-	eap_lake["area"] = eap_lake["geometry"].apply(lambda x: x.area)
-	df = eap_lake.sort_values("area", ascending=False).head(30)
-
-	# 正積図法で絞り込んだデータを元の座標系のデータにも適用し、さらに簡略化してプロット
-	gpd_lake = gpd_lake[gpd_lake["W09_001"].isin(list(df["W09_001"]))].simplify(0.005)
-	gpd_lake.plot(ax=ax, edgecolor=lake_color_edge, facecolor=lake_color_face, linewidth=0.1)
+	geometry["lakes"].plot(ax=ax, edgecolor=lake_color_edge, facecolor=lake_color_face, linewidth=0.1)
 	print("done", flush=True)
 
 
-	# 県の枠線描画 (データの簡略化はこの中で行う)
-	print("Framing Prefectures...", flush=True)
+	# 県の枠線描画
+	print("Framing Prefectures...", end="", flush=True)
 	DrawPrefecture(
-		gpd_map,
-		pref,
+		geometry["outlines"],
 		ax=ax,
 		edgecolor=areamap_color_edge,
 		facecolor="None",
 		linewidth=1.0,
 	)
-	print("all done", flush=True)
+	print("done", flush=True)
 
 	# pickle でデータを保存
 	print(f"Writing area map to {areamap_path}...", end="", flush=True)
@@ -147,16 +406,42 @@ if __name__ == "__main__":
 		pickle.dump(fig, f)
 	print("done", flush=True)
 
-	print("Extracting assitant data...", end="", flush=True)
-	assistant = DataFrame()
+	# 軽量描画エンジン用の座標配列（描画の順序・色・線の太さは上の matplotlib 版と同じ）
+	print(f"Writing polygon arrays to {polygons_path}...", end="", flush=True)
+	WritePolygonArrays(
+		polygons_path,
+		{
+			"area": (geometry["areas"]["geometry"].values, areamap_color_face, areamap_color_edge, 0.5),
+			"lake": (geometry["lakes"].values, lake_color_face, lake_color_edge, 0.1),
+			"pref": ([geom for _, geom in geometry["outlines"]], "None", areamap_color_edge, 1.0),
+		},
+		areamap_color_back,
+		simplify_tolerance
+	)
+	print("done", flush=True)
 
-	assistant[["name", "region", "centroid", "bounds"]] = \
-		gpd_map.apply(MakeAssistantData, region=region, result_type="expand", axis=1)
+	# 描画済みのベース地図（render.engine = "raster" 用）
+	print(f"Writing base raster to {baseraster_path}...", end="", flush=True)
+	WriteBaseRaster(baseraster_path, polygons_path, grid, baseraster)
+	print("done", flush=True)
 
-	# EPSG6668 : JGD2011(世界測地系)緯度経度
-	# 気象庁のシェープファイルがおいてあるページに書いてあった。今後変わるかも分からん
+	# 区域番号のラスタ（震度の塗りつぶし用）
+	print(f"Writing label raster to {labelmap_path}...", end="", flush=True)
+	WriteLabelRaster(labelmap_path, geometry["areas"]["geometry"].values, grid, simplify_tolerance)
 	print("done", flush=True)
 
 	print(f"Writing assistant data to {assistant_path}...", end="", flush=True)
-	assistant.to_pickle(assistant_path)
+	geometry["assistant"].to_pickle(assistant_path)
 	print("done", flush=True)
+
+	print(f"Writing assistant arrays to {assistant_npz_path}...", end="", flush=True)
+	WriteAssistantArrays(assistant_npz_path, geometry["assistant"])
+	print("done", flush=True)
+
+	# 市町村役場の位置の索引（シェープファイルがある場合のみ）
+	if os.path.isfile(city_shape_path):
+		print(f"Writing city index to {citymap_path}...", end="", flush=True)
+		WriteCityIndex(citymap_path, gpd.read_file(city_shape_path, encoding="utf-8"))
+		print("done", flush=True)
+	else:
+		print(f"City shapefile {city_shape_path} is not found. Skipping city index.", flush=True)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# Location: /tools
+# 電文解析（xmlextract による 1 回走査）が、従来の find / findall による解析と同じ結果を返すかを電文の保存先に対して確認する。
+# 解析の項目を変更した場合は、過去の電文に対してこれを実行してから反映する。
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from xml.etree import ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import xmlextract
+from report import EQPlotter_VXSE51, EQPlotter_VXSE53
+
+def LegacyParse(xml: str, ns: dict) -> dict | None:
+	"""
+		従来の ParseXML と同じ find / findall による解析を行い、結果を辞書で返す。対象外の電文は None を返す。
+		xml: 電文
+		ns:  XML 名前空間（config.json の xmlfeed.xml_ns.report）
+	"""
+	root = ET.fromstring(xml)
+	ctrl = root.find("atom:Control", ns["report"])
+	head = root.find("atom:Head", ns["head"])
+	body = root.find("atom:Body", ns["body"])
+	if ctrl is None or head is None or body is None: return None
+
+	kind = head.find(".//atom:InfoKind", ns["head"]).text
+	ret = { "kind": kind, "areas": [], "cities": [], "codes": [] }
+
+	if kind == "震度速報":
+		ret["time"] = head.find(".//atom:TargetDateTime", ns["head"]).text
+		observation = body.find(".//atom:Intensity/atom:Observation", ns["body"])
+		ret["max_int"] = observation.find("./atom:MaxInt", ns["body"]).text
+		for area in observation.findall("./atom:Pref/atom:Area", ns["body"]):
+			ret["areas"].append((area.find("./atom:Name", ns["body"]).text, area.find("./atom:MaxInt", ns["body"]).text))
+
+	elif kind == "地震情報":
+		earthquake = body.find("./atom:Earthquake", ns["body"])
+		ret["time"] = body.find(".//atom:OriginTime", ns["body"]).text
+		hypocenter = earthquake.find("./atom:Hypocenter/atom:Area", ns["body"])
+		ret["hypo_name"]  = hypocenter.find("./atom:Name", ns["body"]).text
+		ret["coordinate"] = hypocenter.find("./jmx_eb:Coordinate", ns["body"]).text
+		ret["magnitude"]  = earthquake.find("./jmx_eb:Magnitude", ns["body"]).text
+
+		observation = body.find(".//atom:Intensity/atom:Observation", ns["body"])
+		if observation is None:
+			ret["max_int"] = "-"
+		else:
+			ret["max_int"] = observation.find("./atom:MaxInt", ns["body"]).text
+			for area in observation.findall("./atom:Pref/atom:Area", ns["body"]):
+				ret["areas"].append((area.find("./atom:Name", ns["body"]).text, area.find("./atom:MaxInt", ns["body"]).text))
+			for city in observation.findall("./atom:Pref/atom:Area/atom:City", ns["body"]):
+				ret["cities"].append((
+					city.find("./atom:Name", ns["body"]).text,
+					city.find("./atom:MaxInt", ns["body"]).text,
+					city.find("./atom:Code", ns["body"]).text
+				))
+
+		for c in body.findall(".//atom:ForecastComment[@codeType='固定付加文']", ns["body"]):
+			code = c.find(".//atom:Code", ns["body"])
+			if code is not None: ret["codes"] = code.text.split()
+	else:
+		return None
+
+	return ret
+
+def ExtractParse(xml: str, backend: str) -> dict | None:
+	"""
+		EQPlotter の EXTRACTOR による解析結果を、LegacyParse と同じ形の辞書で返す。対象外の電文は None を返す。
+		xml:     電文
+		backend: xmlextract のバックエンド
+	"""
+	# InfoKind は両方の EXTRACTOR で同じ経路なので、まず VXSE51 側で判定する
+	x = EQPlotter_VXSE51.EXTRACTOR.Extract(xml, backend)
+	if not (x.Has("control") and x.Has("head") and x.Has("body")): return None
+
+	kind = x.First("infokind")
+	ret = { "kind": kind, "areas": [], "cities": [], "codes": [] }
+
+	if kind == "震度速報":
+		ret["time"] = x.First("target_time")
+		ret["max_int"] = x.First("max_int")
+		ret["areas"] = [(a["name"], a["max_int"]) for a in x.records["areas"]]
+
+	elif kind == "地震情報":
+		x = EQPlotter_VXSE53.EXTRACTOR.Extract(xml, backend)
+		ret["time"] = x.First("origin_time")
+		ret["hypo_name"]  = x.First("hypo_name")
+		ret["coordinate"] = x.First("coordinate")
+		ret["magnitude"]  = x.First("magnitude")
+
+		if not x.Has("observation"):
+			ret["max_int"] = "-"
+		else:
+			ret["max_int"] = x.First("max_int")
+			ret["areas"]  = [(a["name"], a["max_int"]) for a in x.records["areas"]]
+			ret["cities"] = [(c["name"], c["max_int"], c["code"]) for c in x.records["cities"]]
+
+		code = x.Last("comment_code")
+		if code is not None: ret["codes"] = code.split()
+	else:
+		return None
+
+	return ret
+
+if __name__ == "__main__":
+	CONFIG_PATH = "./config.json"
+	CONFIG_ENCTYPE = "utf-8"
+
+	parser = argparse.ArgumentParser(description="JMAEQ I-Maplot 電文解析の一致確認用プログラム")
+	parser.add_argument("inputs", nargs="+", help="電文（XML）のファイル、またはディレクトリ")
+	args = parser.parse_args()
+
+	with open(CONFIG_PATH, "r", encoding=CONFIG_ENCTYPE) as f:
+		conf = json.load(f)
+	ns = conf["xmlfeed"]["xml_ns"]["report"]
+
+	paths = []
+	for p in args.inputs:
+		paths += sorted(glob.glob(os.path.join(p, "**", "*.xml"), recursive=True)) if os.path.isdir(p) else [p]
+
+	backends = ["etree"] + (["lxml"] if xmlextract.LxmlAvailable() else [])
+	elapsed = { "legacy": 0.0, **{ b: 0.0 for b in backends } }
+	checked, mismatched = 0, 0
+
+	for path in paths:
+		with open(path, "r", encoding="utf-8") as f:
+			xml = f.read()
+
+		start = time.perf_counter()
+		expected = LegacyParse(xml, ns)
+		elapsed["legacy"] += time.perf_counter() - start
+		if expected is None: continue
+
+		checked += 1
+		for b in backends:
+			start = time.perf_counter()
+			actual = ExtractParse(xml, b)
+			elapsed[b] += time.perf_counter() - start
+
+			if actual != expected:
+				mismatched += 1
+				print(f"MISMATCH ({b}): {path}")
+				for k in expected.keys():
+					if expected.get(k) != (actual or {}).get(k):
+						print(f"  {k}: {expected.get(k)!r} != {(actual or {}).get(k)!r}")
+
+	print(f"{checked} reports checked, {mismatched} mismatches")
+	for k, v in elapsed.items():
+		print(f"  {k}: {v * 1000:.1f} ms")
+
+	sys.exit(1 if mismatched > 0 else 0)
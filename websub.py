@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# WebSub（PubSubHubbub）による XML フィード更新通知の受信
+# 通知を受けたら定期取得を待たずに直ちにフィードを取得する。定期取得は通知が届かない場合の予備として続ける
+
+import hmac
+import time
+import hashlib
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import log
+from jmafetch import LatencyWindow
+
+# X-Hub-Signature の方式 -> ハッシュ関数
+SIGNATURE_METHODS: dict = { "sha1": hashlib.sha1, "sha256": hashlib.sha256, "sha384": hashlib.sha384, "sha512": hashlib.sha512 }
+
+### class PushSubscriber BEGIN ###
+
+class PushSubscriber:
+	"""
+		WebSub の購読者（subscriber）。ハブからの購読確認（verification of intent）に応答し、更新通知を受け付ける。
+		通知は X-Hub-Signature の HMAC を検証してから受け付け、trigger（Scheduler.trigger）でフィードの取得を直ちに始める。
+		署名のない通知を受け付けると誰でもフィードの取得を起こせてしまうので、secret が空の場合は受け付けを開始しない。
+		通知の受信から取得完了までの時間を記録する。
+	"""
+	def __init__(self, config: dict, trigger) -> None:
+		"""
+			config:  config.json からの設定情報
+			trigger: 通知を受けたときに呼び出す関数。取得完了時に呼び出す関数を引数に取る（Scheduler.trigger）
+		"""
+		self.logger: log.Logger = log.getLogger("{}.{}".format(config["app_name"], __name__))
+		self.trigger = trigger
+		self.LoadConfig(config)
+
+		self.latency = LatencyWindow(100)
+		self.__server: ThreadingHTTPServer = None
+		self.__renew: threading.Timer = None
+
+	def LoadConfig(self, config: dict) -> None:
+		subinfo: dict = config["websub"]
+		self.address: tuple[str, int]	= (subinfo["host"], subinfo["port"])
+		self.path: str					= subinfo["path"]
+		self.hub: str					= subinfo["hub"]
+		self.callback_url: str			= subinfo["callback_url"]
+		self.secret: bytes				= subinfo["secret"].encode("utf-8")
+		self.verify_token: str			= subinfo["verify_token"]
+		self.lease_sec: int				= subinfo["lease_sec"]
+		self.max_body_bytes: int		= subinfo["max_body_bytes"]
+		self.topics: list[str]			= subinfo["topics"] or [f["address"] for f in config["xmlfeed"]["feeds"] if f.get("enabled", True)]
+
+	def Start(self) -> None:
+		""" 通知を受け付けるサーバを別スレッドで開始し、ハブに購読を申し込む。 """
+		if not self.secret:
+			self.logger.error("websub.secret が設定されていないため、WebSub の通知の受け付けを開始しません")
+			return
+
+		subscriber = self
+
+		class Handler(PushRequestHandler):
+			owner = subscriber
+
+		self.__server = ThreadingHTTPServer(self.address, Handler)
+		self.__server.daemon_threads = True
+		threading.Thread(target=self.__server.serve_forever, name="PushSubscriber", daemon=True).start()
+		self.logger.info(f"WebSub の通知の受け付けを開始しました（{self.address[0]}:{self.address[1]}{self.path}）")
+
+		if self.hub and self.callback_url:
+			self.Subscribe()
+
+	def Stop(self) -> None:
+		if self.__renew is not None: self.__renew.cancel()
+		if self.__server is not None:
+			self.__server.shutdown()
+			self.__server.server_close()
+
+	def Subscribe(self) -> None:
+		""" 各トピックの購読をハブに申し込む。購読期間が切れる前に申し込み直す。 """
+		import requests
+
+		for topic in self.topics:
+			try:
+				response = requests.post(self.hub, data={
+					"hub.mode": "subscribe",
+					"hub.callback": self.callback_url,
+					"hub.topic": topic,
+					"hub.lease_seconds": self.lease_sec,
+					"hub.secret": self.secret.decode("utf-8"),
+					"hub.verify": "async",
+					"hub.verify_token": self.verify_token,
+				}, timeout=10)
+				response.raise_for_status()
+				self.logger.info(f"WebSub の購読を申し込みました（{topic}）")
+			except Exception:
+				self.logger.warning(f"WebSub の購読の申し込みに失敗しました（{topic}）\n" + traceback.format_exc())
+
+		self.__renew = threading.Timer(self.lease_sec * 0.9, self.Subscribe)
+		self.__renew.daemon = True
+		self.__renew.start()
+
+	def Verify(self, query: dict) -> str | None:
+		"""
+			ハブからの購読確認に応答する。確認できた場合は返すべき hub.challenge を、できなかった場合は None を返す。
+			query: 購読確認の GET 要求のクエリ
+		"""
+		mode  = query.get("hub.mode")
+		topic = query.get("hub.topic")
+		if mode not in ("subscribe", "unsubscribe"): return None
+		if topic not in self.topics: return None
+		if self.verify_token and query.get("hub.verify_token") != self.verify_token: return None
+
+		self.logger.info(f"WebSub の購読を確認しました（{mode}: {topic}）")
+		return query.get("hub.challenge")
+
+	def CheckSignature(self, body: bytes, signature: str | None) -> bool:
+		"""
+			通知の本文の HMAC を検証する。secret を設定していない場合は常に False を返す。
+			body:      通知の本文
+			signature: X-Hub-Signature ヘッダ（"sha1=..." など）
+		"""
+		if not self.secret: return False
+		if signature is None or "=" not in signature: return False
+
+		method, digest = signature.split("=", 1)
+		if method not in SIGNATURE_METHODS: return False
+
+		expected = hmac.new(self.secret, body, SIGNATURE_METHODS[method]).hexdigest()
+		return hmac.compare_digest(expected, digest.strip().lower())
+
+	def Notify(self) -> None:
+		""" 更新通知を受け付けた。フィードの取得を直ちに始め、取得完了までの時間を記録する。 """
+		start = time.perf_counter()
+		self.trigger(lambda: self.__OnFetched(start))
+
+	def __OnFetched(self, start: float) -> None:
+		sec = time.perf_counter() - start
+		self.latency.Add(sec)
+		self.logger.info(
+			f"WebSub：通知から取得完了まで {sec * 1000:.0f} ms" +\
+			f"（直近 {len(self.latency)} 件の中央値 {self.latency.Percentile(50) * 1000:.0f} ms, 95% {self.latency.Percentile(95) * 1000:.0f} ms）"
+		)
+
+### class PushSubscriber END ###
+
+### class PushRequestHandler BEGIN ###
+
+class PushRequestHandler(BaseHTTPRequestHandler):
+	""" WebSub の購読確認（GET）と更新通知（POST）を受け付ける。owner に PushSubscriber を設定して使う。 """
+	owner: PushSubscriber = None
+
+	def do_GET(self) -> None:
+		url = urlparse(self.path)
+		if url.path != self.owner.path:
+			self.send_error(404)
+			return
+
+		query = { k: v[0] for k, v in parse_qs(url.query).items() }
+		challenge = self.owner.Verify(query)
+		if challenge is None:
+			self.send_error(404)
+			return
+
+		body = challenge.encode("utf-8")
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self) -> None:
+		if urlparse(self.path).path != self.owner.path:
+			self.send_error(404)
+			return
+
+		# 本文の大きさは読む前に確かめる（巨大な本文でメモリを使い果たさないように）
+		try:
+			length = int(self.headers.get("Content-Length", 0))
+		except ValueError:
+			self.send_error(400)
+			return
+		if length < 0 or length > self.owner.max_body_bytes:
+			self.send_error(413)
+			return
+
+		body = self.rfile.read(length)
+
+		# 署名が正しくない通知も、ハブに再送させないよう 2xx で応答する（WebSub の仕様）。取得は行わない
+		self.send_response(202)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+		if not self.owner.CheckSignature(body, self.headers.get("X-Hub-Signature")):
+			self.owner.logger.warning(f"WebSub：署名を検証できない通知を破棄しました（{self.client_address[0]}）")
+			return
+
+		self.owner.Notify()
+
+	def log_message(self, format: str, *args) -> None:
+		# アクセスログは標準エラーに出さず、デバッグログに記録する
+		self.owner.logger.debug("WebSub：" + (format % args))
+
+### class PushRequestHandler END ###
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# 気象庁 XML 電文から、あらかじめ宣言した項目を 1 回の走査で取り出す
+
+import re
+import dataclasses
+from xml.etree import ElementTree as ET
+
+# lxml があれば解析に使う（なくても動作する）
+try:
+	from lxml import etree as _lxml
+except ImportError:
+	_lxml = None
+
+# 経路の 1 段。要素名（名前空間なし）と、任意の属性条件 [@属性='値']
+_STEP_PATTERN = re.compile(r"^([^\[\]/]+)(?:\[@([^=\]]+)=['\"]([^'\"]*)['\"]\])?$")
+
+### class Extracted BEGIN ###
+
+@dataclasses.dataclass
+class Extracted:
+	"""
+		Extractor が取り出した結果。
+		fields:  項目名 -> 文書順に現れた要素のテキストのリスト
+		records: レコード名 -> レコード（項目名 -> テキスト）のリスト
+	"""
+	fields: dict[str, list[str | None]]
+	records: dict[str, list[dict[str, str | None]]]
+
+	def Has(self, name: str) -> bool:
+		""" 項目の要素が 1 つ以上存在するかどうか """
+		return len(self.fields[name]) > 0
+
+	def First(self, name: str) -> str | None:
+		""" 最初に現れた要素のテキスト（ElementTree の find に相当） """
+		values = self.fields[name]
+		return values[0] if len(values) > 0 else None
+
+	def Last(self, name: str) -> str | None:
+		""" 最後に現れた要素のテキスト """
+		values = self.fields[name]
+		return values[-1] if len(values) > 0 else None
+
+### class Extracted END ###
+
+### class Extractor BEGIN ###
+
+class _Node:
+	""" 経路の木の節。子の要素名 -> 節のリスト（属性条件の違いで複数ありうる） """
+	__slots__ = ("children", "pred", "fields", "record", "record_fields")
+
+	def __init__(self, pred: tuple[str, str] | None = None) -> None:
+		self.children: dict[str, list[_Node]] = {}
+		self.pred: tuple[str, str] | None = pred		# (属性名, 値)
+		self.fields: list[str] = []						# この要素のテキストを取り出す項目名
+		self.record: str | None = None					# この要素で始まるレコード名
+		self.record_fields: list[tuple[str, str]] = []	# (レコード名, 項目名)
+
+class Extractor:
+	"""
+		宣言した項目（経路）を木にまとめておき、電文の要素を 1 回たどるだけで全項目を取り出す。
+		経路は電文のルート要素（Report）からの要素名（名前空間なし）を "/" でつなげたもの。
+		各段には [@属性='値'] の条件を付けられる。経路の木にない要素の配下はたどらない。
+	"""
+	def __init__(self, fields: dict[str, str], records: dict[str, tuple[str, dict[str, str]]] = None) -> None:
+		"""
+			fields:  項目名 -> 経路
+			records: レコード名 -> (レコードとなる要素の経路, 項目名 -> レコードの要素からの相対経路)
+		"""
+		self.__root = _Node()
+		self.field_names: list[str] = list(fields.keys())
+		self.record_names: list[str] = list((records or {}).keys())
+
+		for name, path in fields.items():
+			self.__Insert(path).fields.append(name)
+
+		for rname, (path, rfields) in (records or {}).items():
+			self.__Insert(path).record = rname
+			for fname, rpath in rfields.items():
+				self.__Insert(path + "/" + rpath).record_fields.append((rname, fname))
+
+	def Extract(self, xml: str | bytes, backend: str = "auto") -> Extracted:
+		"""
+			電文を解析し、宣言した項目を取り出す。
+			xml:     電文
+			backend: "lxml" / "etree" / "auto"（lxml があれば lxml を使う）
+		"""
+		result = Extracted(
+			{ name: [] for name in self.field_names },
+			{ name: [] for name in self.record_names }
+		)
+		self.__Walk(Parse(xml, backend), self.__root, result, {})
+		return result
+
+	def __Insert(self, path: str) -> _Node:
+		node = self.__root
+		for step in path.split("/"):
+			m = _STEP_PATTERN.match(step)
+			if m is None: raise ValueError(f"経路の書式が正しくありません：{path}")
+
+			local = m.group(1)
+			pred  = (m.group(2), m.group(3)) if m.group(2) is not None else None
+
+			nodes = node.children.setdefault(local, [])
+			for n in nodes:
+				if n.pred == pred:
+					node = n
+					break
+			else:
+				node = _Node(pred)
+				nodes.append(node)
+		return node
+
+	def __Walk(self, elem, node: _Node, result: Extracted, current: dict[str, dict]) -> None:
+		for child in elem:
+			tag = child.tag
+			if not isinstance(tag, str): continue	# lxml のコメント・処理命令
+
+			for nxt in node.children.get(tag[tag.rfind("}") + 1:], ()):
+				if nxt.pred is not None and child.get(nxt.pred[0]) != nxt.pred[1]: continue
+
+				cur = current
+				if nxt.record is not None:
+					rec = {}
+					result.records[nxt.record].append(rec)
+					cur = { **current, nxt.record: rec }
+
+				for name in nxt.fields:
+					result.fields[name].append(child.text)
+				# レコード内の項目は最初に現れた要素を使う（find に相当）
+				for rname, fname in nxt.record_fields:
+					if rname in cur: cur[rname].setdefault(fname, child.text)
+
+				if nxt.children: self.__Walk(child, nxt, result, cur)
+
+### class Extractor END ###
+
+
+def LxmlAvailable() -> bool:
+	return _lxml is not None
+
+def Parse(xml: str | bytes, backend: str = "auto"):
+	"""
+		電文を解析してルート要素を返す。解析に失敗した場合は、どちらのバックエンドでも ET.ParseError を送出する。
+		xml:     電文
+		backend: "lxml" / "etree" / "auto"（lxml があれば lxml を使う）
+	"""
+	if backend == "lxml" and _lxml is None:
+		raise ImportError("lxml がインストールされていません")
+
+	if backend == "etree" or _lxml is None:
+		return ET.fromstring(xml)
+
+	# lxml は encoding 宣言付きの str を受け付けないので、バイト列にして渡す
+	if isinstance(xml, str): xml = xml.encode("utf-8")
+	try:
+		return _lxml.fromstring(xml)
+	except _lxml.XMLSyntaxError as e:
+		raise ET.ParseError(str(e)) from e